@@ -1,12 +1,16 @@
 import asyncio
 
-from download_data import download_shares_close_prices, download_bonds_info, download_shares_info
+from download_data import TinkoffSession, download_shares_close_prices, download_bonds_info, download_shares_info
 
 
-async def download_all(force_update: bool):
-    await download_shares_info(force_update=force_update)
-    # await download_bonds_info(force_update=force_update)
-    await download_shares_close_prices(force_update=force_update)
+async def download_all(force_update: bool, incremental: bool = False):
+    """
+    incremental: append only new days to the stored close prices
+    """
+    async with TinkoffSession() as session:
+        await download_shares_info(force_update=force_update, session=session)
+        # await download_bonds_info(force_update=force_update, session=session)
+    await download_shares_close_prices(force_update=force_update, incremental=incremental)
     print('Successfully downloaded all data')
 
 
@@ -1,2 +1,3 @@
 from .moex import download_shares_close_prices
-from .tinkoff import download_bonds_info, download_shares_info, quotation_to_float
+from .tinkoff import TinkoffSession, download_bonds_info, download_shares_info, download_last_prices, quotation_to_float
+from .instruments import ShareInfo, SharesTable, BondsTable, LastPricesTable
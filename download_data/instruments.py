@@ -0,0 +1,172 @@
+import dataclasses
+import datetime
+import json
+import os
+import shutil
+import numpy as np
+from dataclasses import dataclass
+from pathlib import Path
+
+###################################################################################
+# Config
+###################################################################################
+
+INSTRUMENTS_CACHE_VERSION = 1
+INSTRUMENTS_META_FILE = 'meta.json'
+
+###################################################################################
+# Tables
+###################################################################################
+
+
+@dataclass
+class ShareInfo:
+    """
+    Information about one share (the fields used from inv.Share)
+    """
+    figi: str
+    ticker: str
+    name: str
+    sector: str
+    lot: int
+
+
+@dataclass
+class SharesTable:
+    """
+    Shares information: one array for each field
+    """
+    figi: np.ndarray  # (n_shares,) str
+    ticker: np.ndarray  # (n_shares,) str
+    name: np.ndarray  # (n_shares,) str
+    sector: np.ndarray  # (n_shares,) str
+    lot: np.ndarray  # (n_shares,) int64
+
+    def __len__(self) -> int:
+        return len(self.figi)
+
+    def row(self, i: int) -> ShareInfo:
+        return ShareInfo(figi=str(self.figi[i]), ticker=str(self.ticker[i]), name=str(self.name[i]), sector=str(self.sector[i]), lot=int(self.lot[i]))
+
+    def by_ticker(self) -> dict[str, ShareInfo]:
+        return {str(ticker): self.row(i) for i, ticker in enumerate(self.ticker)}
+
+
+@dataclass
+class BondsTable:
+    """
+    Bonds information: one array for each field
+    Coupons of bond i are coupon_*[coupon_offsets[i]:coupon_offsets[i + 1]]
+    Times are UTC
+    """
+    figi: np.ndarray  # (n_bonds,) str
+    ticker: np.ndarray  # (n_bonds,) str
+    name: np.ndarray  # (n_bonds,) str
+    sector: np.ndarray  # (n_bonds,) str
+    maturity_date: np.ndarray  # (n_bonds,) datetime64[us]
+    nominal: np.ndarray  # (n_bonds,) float64
+    aci_value: np.ndarray  # (n_bonds,) float64
+    coupon_offsets: np.ndarray  # (n_bonds + 1,) int64
+    coupon_date: np.ndarray  # (n_coupons,) datetime64[us]
+    coupon_pay: np.ndarray  # (n_coupons,) float64
+
+    def __post_init__(self):
+        assert len(self.coupon_offsets) == len(self.figi) + 1
+        assert len(self.coupon_date) == len(self.coupon_pay) == self.coupon_offsets[-1]
+
+    def __len__(self) -> int:
+        return len(self.figi)
+
+    def coupons(self, i: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return (dates, pays) of the bond coupons (views, no copy)
+        """
+        start, end = self.coupon_offsets[i], self.coupon_offsets[i + 1]
+        return self.coupon_date[start:end], self.coupon_pay[start:end]
+
+
+@dataclass
+class LastPricesTable:
+    """
+    Last prices of instruments (for bonds price is in % of nominal)
+    """
+    figi: np.ndarray  # (n_instruments,) str
+    price: np.ndarray  # (n_instruments,) float64
+
+    def __len__(self) -> int:
+        return len(self.figi)
+
+    def align(self, figi: np.ndarray) -> np.ndarray:
+        """
+        Return prices for the given figi (NaN if there is no price)
+        """
+        price_by_figi = dict(zip(self.figi.tolist(), self.price.tolist()))
+        return np.array([price_by_figi.get(key, np.nan) for key in figi.tolist()], dtype=np.float64)
+
+
+def to_datetime64(dates: list[datetime.datetime]) -> np.ndarray:
+    """
+    Convert timezone-aware datetimes to UTC datetime64[us]
+    """
+    return np.array([date.astimezone(datetime.timezone.utc).replace(tzinfo=None) for date in dates], dtype='datetime64[us]').reshape(-1)
+
+
+def to_str_array(values: list[str]) -> np.ndarray:
+    return np.array(values, dtype=str).reshape(-1)
+
+
+###################################################################################
+# Save and open
+###################################################################################
+
+
+def save_table(table: SharesTable | BondsTable | LastPricesTable, directory: Path):
+    """
+    Write table to directory (one .npy file for each column)
+    The directory is written to the side and replaced as a whole
+    """
+    tmp_directory = directory.with_name(f'{directory.name}.tmp')
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    tmp_directory.mkdir(parents=True)
+    columns = [column.name for column in dataclasses.fields(table)]
+    for column in columns:
+        np.save(tmp_directory / f'{column}.npy', np.ascontiguousarray(getattr(table, column)), allow_pickle=False)
+    meta = {
+        'version': INSTRUMENTS_CACHE_VERSION,
+        'table': type(table).__name__,
+        'columns': columns,
+        'n_rows': len(table),
+        'created_at': datetime.datetime.utcnow().isoformat()
+    }
+    with open(tmp_directory / INSTRUMENTS_META_FILE, 'w') as f:
+        json.dump(meta, f)
+
+    old_directory = directory.with_name(f'{directory.name}.old')
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if directory.exists():
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def open_table(table_class: type, directory: Path) -> SharesTable | BondsTable | LastPricesTable | None:
+    """
+    Open table without copying the data (arrays are read-only memory maps)
+    Return None if there is no valid table of this class and schema version in the directory
+    """
+    meta_path = directory / INSTRUMENTS_META_FILE
+    if not meta_path.exists():
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    columns = [column.name for column in dataclasses.fields(table_class)]
+    if meta.get('version') != INSTRUMENTS_CACHE_VERSION or meta.get('table') != table_class.__name__ or meta.get('columns') != columns:
+        print(f'Table {directory} has incompatible version')
+        return None
+    try:
+        table = table_class(**{column: np.load(directory / f'{column}.npy', mmap_mode='r', allow_pickle=False) for column in columns})
+        assert len(table) == meta['n_rows']
+        return table
+    except (OSError, ValueError, AssertionError) as ex:
+        print(f'Table {directory} is corrupted: {ex}')
+        return None
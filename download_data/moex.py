@@ -1,11 +1,13 @@
 import asyncio
 import aiohttp
 import aiomoex
+import os
 import pandas as pd
 import typing as tp
 from pathlib import Path
 
 from .utility import limited_gather
+from .price_store import migrate_csv_to_price_store, read_ticker_csv
 
 ###################################################################################
 # Config
@@ -14,6 +16,7 @@ from .utility import limited_gather
 MOEX_DATA_DIRECTORY = Path("data/moex")
 MOEX_CLOSE_DIRECTORY = MOEX_DATA_DIRECTORY / "close"
 MOEX_TICKERS_DIRECTORY = MOEX_DATA_DIRECTORY / "tickers"
+MOEX_STORE_DIRECTORY = MOEX_DATA_DIRECTORY / "store"
 
 MOEX_CLOSE_DIRECTORY.mkdir(exist_ok=True, parents=True)
 MOEX_TICKERS_DIRECTORY.mkdir(exist_ok=True)
@@ -37,6 +40,15 @@ async def _load_from_cache(folder: Path, filename: str, function: tp.Callable[..
     result.to_csv(path, index=False)
     return result
 
+
+def _atomic_write_csv(df: pd.DataFrame, path: Path):
+    """
+    Write csv so that readers never see a partially written file
+    """
+    tmp_path = path.with_suffix('.tmp')
+    df.to_csv(tmp_path, index=False, date_format='%Y-%m-%d')
+    os.replace(tmp_path, path)
+
 ###################################################################################
 # Download functions
 ###################################################################################
@@ -66,7 +78,58 @@ def _download_ticker_close_prices(session: aiohttp.ClientSession, ticker: str) -
     return function
 
 
-async def download_shares_close_prices(force_update: bool):
+async def _sync_ticker_close_prices(session: aiohttp.ClientSession, ticker: str):
+    """
+    Download only the days after the last stored TRADEDATE and append them to the ticker's csv
+    Download the full history for new tickers and corrupted files
+    """
+    path = MOEX_CLOSE_DIRECTORY / f"{ticker}.csv"
+    try:
+        df_old = read_ticker_csv(path) if path.exists() else None
+    except (AssertionError, KeyError, ValueError, pd.errors.ParserError) as ex:
+        print(f"Corrupted {path}: {ex!r}. Download full history")
+        df_old = None
+    if df_old is None or len(df_old) == 0:
+        _atomic_write_csv(await _download_ticker_close_prices(session, ticker)(), path)
+        return
+
+    # Request from the last stored day (inclusive): its close could be updated after the previous download
+    start = df_old["TRADEDATE"].iloc[-1].strftime("%Y-%m-%d")
+    df_new = pd.DataFrame(await aiomoex.get_board_history(session, ticker, start=start))
+    if len(df_new) == 0:
+        print(f"Up to date: {ticker}")
+        return
+    df_new["TRADEDATE"] = pd.to_datetime(df_new["TRADEDATE"])
+
+    # Merge and dedupe (new rows override old rows for the same day)
+    df = pd.concat([df_old, df_new[df_old.columns]], ignore_index=True)
+    df = df.drop_duplicates(subset="TRADEDATE", keep="last").sort_values("TRADEDATE")
+    _atomic_write_csv(df, path)
+    print(f"Success: {ticker}: {len(df) - len(df_old)} new observations")
+
+
+async def download_shares_close_prices(force_update: bool, incremental: bool = False):
+    """
+    force_update: download the full history of every ticker
+    incremental: keep stored history and download only the missing days (takes precedence over force_update)
+    """
+    if incremental:
+        async with aiohttp.ClientSession() as session:
+            # Download tickers
+            tickers_df = await _load_from_cache(MOEX_TICKERS_DIRECTORY, 'tickers', _download_tickers(session), force_update=True)
+            tickers = list(tickers_df["SECID"])
+            # Remove tickers that are not traded anymore
+            for file in MOEX_CLOSE_DIRECTORY.iterdir():
+                if file.name.removesuffix('.csv') not in tickers or file.suffix != '.csv':
+                    file.unlink()
+            # Append new close prices for each ticker
+            print(f"Sync tickers: {len(tickers)}")
+            await limited_gather(*[_sync_ticker_close_prices(session, ticker) for ticker in tickers])
+        # Rebuild columnar price store from CSVs
+        migrate_csv_to_price_store(MOEX_CLOSE_DIRECTORY, MOEX_STORE_DIRECTORY, expected_tickers=tickers)
+        print('Successfully synchronized close prices data')
+        return
+
     # Remove old data
     if force_update:
         for file in MOEX_CLOSE_DIRECTORY.iterdir():
@@ -81,6 +144,8 @@ async def download_shares_close_prices(force_update: bool):
         for ticker in tickers:
             tasks.append(_load_from_cache(MOEX_CLOSE_DIRECTORY, ticker, _download_ticker_close_prices(session, ticker), force_update=force_update))
         await limited_gather(*tasks)
+    # Rebuild columnar price store from CSVs
+    migrate_csv_to_price_store(MOEX_CLOSE_DIRECTORY, MOEX_STORE_DIRECTORY, expected_tickers=tickers)
     print('Successfully downloaded close prices data')
 
 
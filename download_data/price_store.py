@@ -0,0 +1,157 @@
+import datetime
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from pathlib import Path
+
+###################################################################################
+# Config
+###################################################################################
+
+PRICE_STORE_VERSION = 1
+PRICE_STORE_COLUMNS = ['CLOSE', 'VOLUME', 'VALUE']
+PRICE_STORE_META_FILE = 'meta.json'
+PRICE_STORE_DATES_FILE = 'dates.npy'
+TICKER_CSV_DTYPES = {'BOARDID': str, 'TRADEDATE': str, 'CLOSE': np.float64, 'VOLUME': np.float64, 'VALUE': np.float64}  # columns read from CSVs
+N_CSV_READERS = min(16, os.cpu_count() or 1)  # threads parsing CSVs (the parser releases the GIL)
+
+###################################################################################
+# Price store
+###################################################################################
+
+
+@dataclass
+class PriceStore:
+    """
+    Columnar storage of daily trading data: (date x ticker) matrix for each column
+    Missing observations are NaNs
+    """
+    dates: np.ndarray  # (n_dates,) datetime64[D]
+    tickers: list[str]  # (n_tickers,)
+    close: np.ndarray  # (n_dates, n_tickers) float64
+    volume: np.ndarray  # (n_dates, n_tickers) float64
+    value: np.ndarray  # (n_dates, n_tickers) float64
+    created_at: str = None
+
+    def __post_init__(self):
+        n_dates, n_tickers = len(self.dates), len(self.tickers)
+        for matrix in [self.close, self.volume, self.value]:
+            assert matrix.shape == (n_dates, n_tickers), f'{matrix.shape} != {(n_dates, n_tickers)}'
+
+
+def _column_file(column: str) -> str:
+    return f'{column.lower()}.npy'
+
+
+def save_price_store(store: PriceStore, directory: Path):
+    """
+    Write price store to directory
+    The directory is written to the side and replaced as a whole: readers never see arrays of different generations
+    (memory maps of the previous store stay valid after the replacement)
+    """
+    tmp_directory = directory.with_name(f'{directory.name}.tmp')
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    tmp_directory.mkdir(parents=True)
+    np.save(tmp_directory / PRICE_STORE_DATES_FILE, store.dates.astype('datetime64[D]'))
+    for column in PRICE_STORE_COLUMNS:
+        np.save(tmp_directory / _column_file(column), np.ascontiguousarray(getattr(store, column.lower()), dtype=np.float64))
+    meta = {
+        'version': PRICE_STORE_VERSION,
+        'columns': PRICE_STORE_COLUMNS,
+        'tickers': list(store.tickers),
+        'n_dates': len(store.dates),
+        'created_at': datetime.datetime.utcnow().isoformat()
+    }
+    with open(tmp_directory / PRICE_STORE_META_FILE, 'w') as f:
+        json.dump(meta, f)
+
+    old_directory = directory.with_name(f'{directory.name}.old')
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if directory.exists():
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def open_price_store(directory: Path) -> PriceStore | None:
+    """
+    Open price store without copying the data (arrays are read-only memory maps)
+    Return None if there is no valid store in the directory
+    """
+    meta_path = directory / PRICE_STORE_META_FILE
+    if not meta_path.exists():
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != PRICE_STORE_VERSION or meta.get('columns') != PRICE_STORE_COLUMNS:
+        print(f'Price store {directory} has incompatible version')
+        return None
+    try:
+        dates = np.load(directory / PRICE_STORE_DATES_FILE, mmap_mode='r')
+        columns = {column.lower(): np.load(directory / _column_file(column), mmap_mode='r') for column in PRICE_STORE_COLUMNS}
+        assert len(dates) == meta['n_dates'], f'{len(dates)} dates != {meta["n_dates"]} in {PRICE_STORE_META_FILE}'
+        return PriceStore(dates=dates, tickers=meta['tickers'], created_at=meta['created_at'], **columns)
+    except (OSError, ValueError, KeyError, AssertionError) as ex:
+        print(f'Price store {directory} is corrupted: {ex}')
+        return None
+
+
+###################################################################################
+# Migration from per-ticker CSVs
+###################################################################################
+
+
+def read_ticker_csv(path: Path) -> pd.DataFrame:
+    """
+    Read and validate close prices of one ticker downloaded from MOEX
+    Only the needed columns are read with explicit dtypes
+    """
+    df = pd.read_csv(path, usecols=list(TICKER_CSV_DTYPES), dtype=TICKER_CSV_DTYPES, engine='c')
+    df['TRADEDATE'] = pd.to_datetime(df['TRADEDATE'], format='%Y-%m-%d')
+    assert not df[['BOARDID', 'TRADEDATE', 'VOLUME', 'VALUE']].isna().to_numpy().any(), path  # no NaNs except close prices
+    dates = df['TRADEDATE'].to_numpy()
+    assert np.all(dates[1:] > dates[:-1]), path  # trade date is strictly increasing (monotonic without duplicates)
+    assert np.all(df['BOARDID'].to_numpy() == 'TQBR'), path  # all tickers are in the TQBR section
+    assert np.array_equal(df['VALUE'].to_numpy() == 0, df['VOLUME'].to_numpy() == 0), path
+    return df
+
+
+def read_tickers_csv(paths: dict[str, Path], n_readers: int = N_CSV_READERS) -> dict[str, pd.DataFrame]:
+    """
+    Read and validate CSVs of many tickers concurrently
+    """
+    with ThreadPoolExecutor(max_workers=max(n_readers, 1)) as executor:
+        return dict(zip(paths, executor.map(read_ticker_csv, paths.values())))
+
+
+def build_price_store(df_by_ticker: dict[str, pd.DataFrame]) -> PriceStore:
+    """
+    Align per-ticker frames into (date x ticker) matrices with one allocation per column
+    """
+    tickers = sorted(df_by_ticker)
+    date_by_ticker = {ticker: df_by_ticker[ticker]['TRADEDATE'].to_numpy(dtype='datetime64[D]') for ticker in tickers}
+    dates = np.unique(np.concatenate([date_by_ticker[ticker] for ticker in tickers])) if tickers else np.array([], dtype='datetime64[D]')
+    columns = {column: np.full((len(dates), len(tickers)), np.nan) for column in PRICE_STORE_COLUMNS}
+    for i, ticker in enumerate(tickers):
+        rows = np.searchsorted(dates, date_by_ticker[ticker])
+        for column, matrix in columns.items():
+            matrix[rows, i] = df_by_ticker[ticker][column].to_numpy(dtype=np.float64)
+    return PriceStore(dates=dates, tickers=tickers, **{column.lower(): matrix for column, matrix in columns.items()})
+
+
+def migrate_csv_to_price_store(close_directory: Path, store_directory: Path, expected_tickers: list[str] | None = None) -> PriceStore:
+    """
+    Build price store from the directory with per-ticker CSVs
+    """
+    tickers = sorted([file.name.removesuffix('.csv') for file in close_directory.iterdir() if file.suffix == '.csv'])
+    if expected_tickers is not None:
+        assert tickers == sorted(expected_tickers)
+    df_by_ticker = read_tickers_csv({ticker: close_directory / f'{ticker}.csv' for ticker in tickers})
+    store = build_price_store(df_by_ticker)
+    save_price_store(store, store_directory)
+    print(f'Price store is saved to {store_directory}: {len(store.dates)} dates, {len(store.tickers)} tickers')
+    return open_price_store(store_directory)
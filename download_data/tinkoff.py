@@ -1,17 +1,19 @@
 import tinkoff.invest as inv
 from tinkoff.invest.async_services import AsyncServices
 from tinkoff.invest.exceptions import AioRequestError
-import pickle
+import numpy as np
 import typing as tp
 import yaml
 import datetime
 import asyncio
+import random
 import time
-from collections import deque
+from collections import defaultdict
+from dataclasses import dataclass
 from pathlib import Path
 from dateutil.relativedelta import relativedelta
 
-from .utility import limited_gather
+from .instruments import SharesTable, BondsTable, LastPricesTable, save_table, open_table, to_datetime64, to_str_array
 
 ###################################################################################
 # Config
@@ -19,6 +21,7 @@ from .utility import limited_gather
 
 TOKEN_FILE = Path("keys.yaml")
 TINKOFF_DATA_DIRECTORY = Path("data/tinkoff")
+LAST_PRICES_BATCH_SIZE = 300  # maximum number of instruments in one get_last_prices request
 
 assert TOKEN_FILE.exists()
 TINKOFF_DATA_DIRECTORY.mkdir(exist_ok=True, parents=True)
@@ -45,84 +48,214 @@ def _get_token(filename: str = TOKEN_FILE) -> str:
     return keys["token"]
 
 
-class RateLimiter:
-    PERIOD_SECONDS = 60
-    N_REQUESTS_PER_PERIOD = 60
-
-    requests_queue = deque()
-    n_waiting_tasks = 0
-    last_message_time = time.time() - 5
-
-    @classmethod
-    async def wait(cls):
-        # Wait on rate limit
-        cls.clear_queue()
-        while len(cls.requests_queue) == cls.N_REQUESTS_PER_PERIOD:
-            last_request_time = cls.requests_queue[0]
-            sleep_time = cls.PERIOD_SECONDS - (time.time() - last_request_time)
-            if time.time() - cls.last_message_time >= 5:
-                cls.last_message_time = time.time()
-                print(f'RateLimiter: {cls.n_waiting_tasks} pending tasks. Sleep for this task: {sleep_time} s')
-            cls.n_waiting_tasks += 1
-            await asyncio.sleep(sleep_time)
-            cls.n_waiting_tasks -= 1
-            cls.clear_queue()
-        # Create new request
-        cls.requests_queue.append(time.time())
-
-    @classmethod
-    def clear_queue(cls):
-        # Clear old requests
-        now = time.time()
-        while cls.requests_queue and now - cls.requests_queue[0] > cls.PERIOD_SECONDS:
-            cls.requests_queue.popleft()
+class TokenBucket:
+    """
+    Async token bucket: allows n_requests_per_minute requests with bursts up to capacity
+    Any 60 seconds contain at most n_requests_per_minute + capacity requests, so the default burst is one request
+    (a full bucket of n_requests_per_minute tokens would allow twice the limit in the first minute)
+    Waiting tasks are served in FIFO order and sleep exactly until the next token is available
+    """
+
+    def __init__(self, n_requests_per_minute: int, capacity: int = 1):
+        self.rate = n_requests_per_minute / 60  # tokens per second
+        self.capacity = capacity
+        self.tokens = float(self.capacity)
+        self.last_refill_time = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill_time) * self.rate)
+        self.last_refill_time = now
+
+    async def acquire(self) -> float:
+        """
+        Take one token, return waiting time in seconds
+        """
+        start_time = time.monotonic()
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+        return time.monotonic() - start_time
+
+
+@dataclass
+class EndpointStats:
+    n_requests: int = 0
+    n_errors: int = 0
+    n_retries: int = 0
+    wait_time: float = 0.0  # time spent waiting for rate limiter and backoff
+    request_time: float = 0.0  # time spent in requests
+
+    def __str__(self) -> str:
+        return f'requests={self.n_requests}, errors={self.n_errors}, retries={self.n_retries}, wait={self.wait_time:.1f} s, request={self.request_time:.1f} s'
+
+
+class TinkoffSession:
+    """
+    One client (gRPC channel) for all Tinkoff API requests
+    Requests are rate-limited per API service, failed requests are retried with exponential backoff
+    (a request holds one of N_PARALLEL_REQUESTS slots only while it waits for a token and runs, not during backoff)
+    """
+    # Limits of requests per minute for each service
+    RATE_LIMITS_PER_MINUTE = {
+        'instruments': 200,
+        'market_data': 600,
+    }
+    N_PARALLEL_REQUESTS = 50
+    MAX_RETRIES = 8
+    BACKOFF_START_SECONDS = 1.0
+    BACKOFF_MAX_SECONDS = 60.0
+
+    def __init__(self, rate_limits_per_minute: dict[str, int] | None = None):
+        rate_limits_per_minute = rate_limits_per_minute or self.RATE_LIMITS_PER_MINUTE
+        self.bucket_by_service = {service: TokenBucket(limit) for service, limit in rate_limits_per_minute.items()}
+        self.stats_by_endpoint: dict[str, EndpointStats] = defaultdict(EndpointStats)
+        self._semaphore = asyncio.Semaphore(self.N_PARALLEL_REQUESTS)
+        self._client_manager = None
+        self.client: AsyncServices = None
+
+    async def __aenter__(self) -> 'TinkoffSession':
+        self._client_manager = inv.AsyncClient(token=_get_token())
+        self.client = await self._client_manager.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+        await self._client_manager.__aexit__(*args)
+        self.client = None
+        self.print_stats()
+
+    async def request(self, service: str, endpoint: str, function: tp.Callable[[AsyncServices], tp.Awaitable]) -> tp.Any:
+        """
+        Make request function(client) to endpoint of the service
+        """
+        stats = self.stats_by_endpoint[endpoint]
+        backoff = self.BACKOFF_START_SECONDS
+        for n_try in range(self.MAX_RETRIES + 1):
+            async with self._semaphore:
+                stats.wait_time += await self.bucket_by_service[service].acquire()
+                start_time = time.monotonic()
+                stats.n_requests += 1
+                try:
+                    return await function(self.client)
+                except AioRequestError as ex:
+                    stats.n_errors += 1
+                    if n_try == self.MAX_RETRIES:
+                        raise
+                    print(f'AioRequestError for {endpoint} (try {n_try + 1}/{self.MAX_RETRIES + 1}): {ex}')
+                finally:
+                    stats.request_time += time.monotonic() - start_time
+            # Exponential backoff with jitter (the slot is released)
+            delay = backoff * random.uniform(0.5, 1.0)
+            stats.n_retries += 1
+            stats.wait_time += delay
+            await asyncio.sleep(delay)
+            backoff = min(2 * backoff, self.BACKOFF_MAX_SECONDS)
+
+    def print_stats(self):
+        for endpoint, stats in self.stats_by_endpoint.items():
+            print(f'TinkoffSession: {endpoint}: {stats}')
+
 
 ###################################################################################
 # Load from cache
 ###################################################################################
 
 
-async def _load_from_cache(filename: str, function: tp.Callable[..., tp.Awaitable], force_update: bool):
+async def _load_from_cache(name: str, table_class: type, function: tp.Callable[..., tp.Awaitable], force_update: bool):
     """
-    Loads function return value from cache
+    Loads function return value (table) from cache
     """
-    path = TINKOFF_DATA_DIRECTORY / f"{filename}.pickle"
-    if path.exists() and not force_update:
-        print(f"Load {filename} from cache")
-        with open(path, "rb") as f:
-            return pickle.load(f)
-    print(f"Create {filename}")
-    result = await function()
-    with open(path, "wb") as f:
-        pickle.dump(result, f)
-    return result
+    directory = TINKOFF_DATA_DIRECTORY / name
+    if not force_update:
+        table = open_table(table_class, directory)
+        if table is not None:
+            print(f"Load {name} from cache")
+            return table
+    print(f"Create {name}")
+    table = await function()
+    assert isinstance(table, table_class)
+    save_table(table, directory)
+    return table
+
+
+###################################################################################
+# Convert responses to tables
+###################################################################################
+
+
+def _shares_table(shares: list[inv.Share]) -> SharesTable:
+    return SharesTable(
+        figi=to_str_array([share.figi for share in shares]),
+        ticker=to_str_array([share.ticker for share in shares]),
+        name=to_str_array([share.name for share in shares]),
+        sector=to_str_array([share.sector for share in shares]),
+        lot=np.array([share.lot for share in shares], dtype=np.int64)
+    )
+
+
+def _bonds_table(bonds: list[inv.Bond], bonds_coupons: list[list[inv.Coupon]]) -> BondsTable:
+    assert len(bonds) == len(bonds_coupons)
+    coupons = [coupon for bond_coupons in bonds_coupons for coupon in bond_coupons]
+    return BondsTable(
+        figi=to_str_array([bond.figi for bond in bonds]),
+        ticker=to_str_array([bond.ticker for bond in bonds]),
+        name=to_str_array([bond.name for bond in bonds]),
+        sector=to_str_array([bond.sector for bond in bonds]),
+        maturity_date=to_datetime64([bond.maturity_date for bond in bonds]),
+        nominal=np.array([quotation_to_float(bond.nominal) for bond in bonds], dtype=np.float64),
+        aci_value=np.array([quotation_to_float(bond.aci_value) for bond in bonds], dtype=np.float64),
+        coupon_offsets=np.cumsum([0] + [len(bond_coupons) for bond_coupons in bonds_coupons], dtype=np.int64),
+        coupon_date=to_datetime64([coupon.coupon_date for coupon in coupons]),
+        coupon_pay=np.array([quotation_to_float(coupon.pay_one_bond) for coupon in coupons], dtype=np.float64)
+    )
+
+
+def _last_prices_table(last_prices: list[inv.LastPrice]) -> LastPricesTable:
+    return LastPricesTable(
+        figi=to_str_array([last_price.figi for last_price in last_prices]),
+        price=np.array([quotation_to_float(last_price.price) for last_price in last_prices], dtype=np.float64)
+    )
 
 
 ###################################################################################
 # Requests
 ###################################################################################
 
-def _download_shares(client: AsyncServices) -> tp.Awaitable:
-    async def function() -> inv.SharesResponse:
-        return await client.instruments.shares()
+def _download_shares(session: TinkoffSession) -> tp.Awaitable:
+    async def function() -> SharesTable:
+        return _shares_table((await session.request('instruments', 'shares', lambda client: client.instruments.shares())).instruments)
 
     return function
 
 
-def _download_last_prices(client: AsyncServices, instruments: list[inv.Share | inv.Bond]) -> tp.Awaitable:
+def _split_into_batches(items: list, max_batch_size: int) -> list[list]:
+    """
+    Split items into the minimum number of batches of almost equal size
+    """
+    n_batches = -(-len(items) // max_batch_size)
+    return [items[i * len(items) // n_batches:(i + 1) * len(items) // n_batches] for i in range(n_batches)]
+
+
+def _download_last_prices(session: TinkoffSession, figi: list[str]) -> tp.Awaitable:
     """
     Download recent price for each instrument
+    Requests are split into batches that are sent concurrently
     """
-    async def function() -> inv.GetLastPricesResponse:
-        await RateLimiter.wait()
-        return (await client.market_data.get_last_prices(
-            figi=[instrument.figi for instrument in instruments]
-        )).last_prices
+    async def request(batch: list[str]) -> list[inv.LastPrice]:
+        return (await session.request('market_data', 'get_last_prices', lambda client: client.market_data.get_last_prices(figi=batch))).last_prices
+
+    async def function() -> LastPricesTable:
+        responses = await asyncio.gather(*[request(batch) for batch in _split_into_batches(figi, LAST_PRICES_BATCH_SIZE)])
+        return _last_prices_table([last_price for last_prices in responses for last_price in last_prices])
 
     return function
 
 
-def _download_bonds_general_info(client: AsyncServices) -> tp.Awaitable:
+def _download_bonds_general_info(session: TinkoffSession) -> tp.Awaitable:
     """
     Download bonds general information
     Filter only standard bonds
@@ -143,15 +276,14 @@ def _download_bonds_general_info(client: AsyncServices) -> tp.Awaitable:
         return True
 
     async def function() -> list[inv.Bond]:
-        await RateLimiter.wait()
-        bonds = (await client.instruments.bonds(instrument_status=inv.InstrumentStatus.INSTRUMENT_STATUS_BASE)).instruments
+        bonds = (await session.request('instruments', 'bonds', lambda client: client.instruments.bonds(instrument_status=inv.InstrumentStatus.INSTRUMENT_STATUS_BASE))).instruments
         bonds = [bond for bond in bonds if is_good_bond(bond)]
         return bonds
 
     return function
 
 
-def _download_bonds_coupons(client: AsyncServices, bonds: list[inv.Bond]) -> tp.Awaitable:
+def _download_bonds_coupons(session: TinkoffSession, bonds: list[inv.Bond]) -> tp.Awaitable:
     """
     Download coupons for each bond
     """
@@ -159,41 +291,73 @@ def _download_bonds_coupons(client: AsyncServices, bonds: list[inv.Bond]) -> tp.
         min_time = datetime.datetime(year=1971, month=1, day=1, hour=0, minute=0, second=0)
         max_time = datetime.datetime(year=2200, month=1, day=1, hour=0, minute=0, second=0)
 
-        async def task(figi: str) -> inv.GetBondCouponsResponse:
-            while True:
-                try:
-                    await RateLimiter.wait()
-                    return await client.instruments.get_bond_coupons(figi=figi, from_=min_time, to=max_time)
-                except AioRequestError as ex:
-                    print(f'AioRequestError for bond: {figi}: {ex}')
+        def task(figi: str) -> tp.Awaitable[inv.GetBondCouponsResponse]:
+            return session.request('instruments', 'get_bond_coupons', lambda client: client.instruments.get_bond_coupons(figi=figi, from_=min_time, to=max_time))
 
         tasks = [task(bond.figi) for bond in bonds]
         print(f'Download coupons for {len(tasks)} bonds')
-        responses: list[inv.GetBondCouponsResponse] = await limited_gather(*tasks)
+        responses: list[inv.GetBondCouponsResponse] = await asyncio.gather(*tasks)
         coupons = [response.events for response in responses]
         return coupons
 
     return function
 
+
+def _download_bonds(session: TinkoffSession) -> tp.Awaitable:
+    """
+    Download bonds general information and coupons
+    """
+    async def function() -> BondsTable:
+        bonds = await _download_bonds_general_info(session)()
+        bonds_coupons = await _download_bonds_coupons(session, bonds)()
+        return _bonds_table(bonds, bonds_coupons)
+
+    return function
+
 ###################################################################################
 # Get bonds
 ###################################################################################
 
 
-async def download_shares_info(force_update: bool) -> list[inv.Share]:
-    async with inv.AsyncClient(token=_get_token()) as client:
-        return (await _load_from_cache('shares', _download_shares(client), force_update=force_update)).instruments
+async def download_shares_info(force_update: bool, session: TinkoffSession | None = None) -> SharesTable:
+    """
+    session: opened session to reuse (a new one is opened if None)
+    """
+    if session is None:
+        async with TinkoffSession() as session:
+            return await download_shares_info(force_update=force_update, session=session)
+    return await _load_from_cache('shares', SharesTable, _download_shares(session), force_update=force_update)
 
 
-async def download_bonds_info(force_update: bool) -> tuple[list[inv.Bond], list[list[inv.Coupon]], list[inv.LastPrice]]:
-    async with inv.AsyncClient(token=_get_token()) as client:
-        bonds: list[inv.Bond] = (await _load_from_cache("bonds", _download_bonds_general_info(client), force_update=force_update))
-        bonds_coupons = (await _load_from_cache("bonds_coupons", _download_bonds_coupons(client, bonds), force_update=force_update))
-        bonds_last_prices = (await _load_from_cache("bonds_last_prices", _download_last_prices(client, bonds), force_update=force_update))
+async def download_bonds_info(force_update: bool, session: TinkoffSession | None = None) -> tuple[BondsTable, LastPricesTable]:
+    """
+    session: opened session to reuse (a new one is opened if None)
+    Return bonds with coupons and their last prices
+    """
+    if session is None:
+        async with TinkoffSession() as session:
+            return await download_bonds_info(force_update=force_update, session=session)
+    bonds = await _load_from_cache('bonds', BondsTable, _download_bonds(session), force_update=force_update)
+    bonds_last_prices = await _load_from_cache('bonds_last_prices', LastPricesTable, _download_last_prices(session, bonds.figi.tolist()), force_update=force_update)
     print('Successfully downloaded bonds info data')
-    return bonds, bonds_coupons, bonds_last_prices
+    return bonds, bonds_last_prices
+
+
+async def download_last_prices(figi: list[str], session: TinkoffSession | None = None) -> LastPricesTable:
+    """
+    Download last prices of the instruments without cache (to refresh prices more often than other data)
+    session: opened session to reuse (a new one is opened if None)
+    """
+    if session is None:
+        async with TinkoffSession() as session:
+            return await download_last_prices(figi, session=session)
+    return await _download_last_prices(session, figi)()
 
 
 if __name__ == "__main__":
-    asyncio.run(download_shares_info(force_update=True))
-    asyncio.run(download_bonds_info(force_update=True))
+    async def _main():
+        async with TinkoffSession() as session:
+            await download_shares_info(force_update=True, session=session)
+            await download_bonds_info(force_update=True, session=session)
+
+    asyncio.run(_main())
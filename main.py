@@ -12,53 +12,130 @@
 # time.sleep(5)
 # print('Start main.py')
 
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 from website import create_app
 import asyncio
 import argparse
+import multiprocessing
+import os
 import typing as tp
 
-from website.library import load_data_to_ram
+from website.library import load_data_to_ram, refresh_bonds_prices, save_data_ram_snapshot, load_data_ram_snapshot
 from download_all import download_all
 
 
-# Define scheduler and app
-scheduler = BackgroundScheduler()
+# Define app
 app = create_app()
 
 
-def get_job_to_run_once_a_day(download_data: bool) -> tp.Callable:
+def get_job_to_run_once_a_day(download_data: bool, publish_snapshot: bool = False) -> tp.Callable:
     """
     download_data: whether to download the data
+    publish_snapshot: whether to publish loaded data as a snapshot for server workers
     """
     def job():
         print('Run job')
         # Download data
         if download_data:
-            asyncio.run(download_all(force_update=True))
+            asyncio.run(download_all(force_update=True, incremental=True))
         # Load data to RAM
         asyncio.run(load_data_to_ram())
+        # Share data with server workers
+        if publish_snapshot:
+            save_data_ram_snapshot()
 
     return job
 
 
+def get_job_to_refresh_bonds_prices(publish_snapshot: bool = False) -> tp.Callable:
+    """
+    publish_snapshot: whether to publish updated data as a snapshot for server workers
+    """
+    def job():
+        print('Run bonds prices job')
+        if asyncio.run(refresh_bonds_prices()) and publish_snapshot:
+            save_data_ram_snapshot()
+
+    return job
+
+
+def _run_refresher(download_on_start: bool, download_every_day: bool, bonds_prices_minutes: int):
+    """
+    Process that loads data on start, refreshes it once a day and publishes snapshots for the server
+    The server keeps serving the last snapshot while the data is refreshed
+    """
+    # Start from the last snapshot to refresh bonds prices before the first load finishes
+    load_data_ram_snapshot(force_check=True)
+    refresher = BlockingScheduler()
+    refresher.add_job(get_job_to_run_once_a_day(download_data=download_on_start, publish_snapshot=True))  # run now
+    refresher.add_job(get_job_to_run_once_a_day(download_data=download_every_day, publish_snapshot=True), 'interval', days=1)
+    if bonds_prices_minutes > 0:
+        refresher.add_job(get_job_to_refresh_bonds_prices(publish_snapshot=True), 'interval', minutes=bonds_prices_minutes)
+    refresher.start()
+
+
+def start_refresher(download_on_start: bool, download_every_day: bool, bonds_prices_minutes: int):
+    """
+    Serve the last published snapshot and refresh data in a separate process
+    """
+    # Server processes switch to the new snapshot between requests
+    @app.before_request
+    def switch_to_last_snapshot():
+        load_data_ram_snapshot()
+
+    # Start immediately from the last snapshot (if any)
+    if not load_data_ram_snapshot(force_check=True):
+        print('There is no data snapshot yet: data is loading')
+
+    refresher = multiprocessing.Process(target=_run_refresher, args=(download_on_start, download_every_day, bonds_prices_minutes), daemon=True)
+    refresher.start()
+
+
+def run_production_server(host: str, port: int, n_workers: int):
+    """
+    Run pre-fork server: workers read data from the last published snapshot (memory-mapped, read-only)
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        def __init__(self, options: dict):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    print(f'Run production server with {n_workers} workers')
+    ProductionServer({'bind': f'{host}:{port}', 'workers': n_workers}).run()
+
+
 def main():
     # Define arguments: debug and download
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
     parser.add_argument('--download_every_day', action='store_true', help='Download data every day')
     parser.add_argument('--download_on_start', action='store_true', help='Download data on start')
+    parser.add_argument('--production', action='store_true', help='Run multi-process production server')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='Number of server processes in production mode')
+    parser.add_argument('--bonds_prices_minutes', type=int, default=0, help='Refresh bonds prices every N minutes (0 to disable)')
 
     # Parse arguments and set debug mode for app
     args = parser.parse_args()
     app.debug = args.debug
 
-    # Run scheduler for every day job
-    scheduler.add_job(get_job_to_run_once_a_day(download_data=args.download_every_day), 'interval', days=1)
-    scheduler.start()
+    # Load and refresh data in a separate process
+    # (in debug mode the reloader process only restarts the server process: start the refresher in the server process)
+    is_reloader_process = args.debug and not args.production and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+    if not is_reloader_process:
+        start_refresher(download_on_start=args.download_on_start, download_every_day=args.download_every_day, bonds_prices_minutes=args.bonds_prices_minutes)
 
-    # Run job on start
-    get_job_to_run_once_a_day(download_data=args.download_on_start)()
+    if args.production:
+        run_production_server(host='0.0.0.0', port=80, n_workers=args.workers)
+        return
 
     # Run app
     print('Run app')
@@ -1,2 +1,3 @@
 from .load import load_data, ClosePricesStatistics, TRADING_DAYS_IN_YEAR
-from .markowitz import get_markowitz_w
+from .markowitz import get_markowitz_w, MarkowitzSolver
+from .rolling import RollingStatistics, WindowStatistics, rolling_statistics
@@ -0,0 +1,486 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.sparse.linalg
+import tempfile
+import typing as tp
+from dataclasses import dataclass
+from pathlib import Path
+
+
+###################################################################################
+# Pairwise returns
+###################################################################################
+
+PAIRWISE_CHUNK_ELEMENTS = 2 ** 24  # size of (dates, tickers, tickers) blocks when correcting returns after gaps
+
+
+def _to_arrays(df_close: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Convert close prices to (prices, days) arrays
+    prices: (n_dates, n_tickers) float array with NaNs
+    days: (n_dates,) number of days since 1970-01-01
+    """
+    prices = df_close.to_numpy(dtype=float)
+    days = _to_days(df_close.index)
+    return prices, days
+
+
+def _to_days(dates: pd.DatetimeIndex | np.ndarray) -> np.ndarray:
+    """
+    Convert dates to the number of days since 1970-01-01
+    """
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+
+def _previous_valid_row(valid: np.ndarray) -> np.ndarray:
+    """
+    For each cell return the index of the previous row where the column is valid (-1 if there is no such row)
+    """
+    rows = np.where(valid, np.arange(len(valid)).reshape(-1, 1), -1)
+    rows = np.maximum.accumulate(rows, axis=0)
+    return np.vstack([np.full((1, valid.shape[1]), -1), rows[:-1]])
+
+
+def _normalized_returns(prices: np.ndarray, days: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Normalized returns of each ticker on its own trading dates
+    Return (returns, mask), where mask shows whether the return is defined
+    """
+    valid = ~np.isnan(prices)
+    previous = _previous_valid_row(valid)
+    mask = valid & (previous >= 0)
+    previous = np.maximum(previous, 0)
+    intervals = days.reshape(-1, 1) - days[previous]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = (prices / np.take_along_axis(prices, previous, axis=0) - 1) / intervals
+    mask &= ~np.isnan(returns)
+    return np.where(mask, returns, 0.0), mask
+
+
+def _add_at(matrix: np.ndarray, i: np.ndarray, j: np.ndarray, values: np.ndarray):
+    """
+    matrix[i, j] += values with repeated pairs (i, j)
+    """
+    matrix += np.bincount(i * matrix.shape[1] + j, weights=values, minlength=matrix.size).reshape(matrix.shape)
+
+
+def _pairwise_sums(prices: np.ndarray, days: np.ndarray, shift: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sums of normalized returns on pairwise-complete observations in a few masked matrix products
+    n[i, j] - number of common returns of (i, j), sums[i, j] - sum of returns of i on the common dates of (i, j),
+    sum_prod[i, j] - sum of products of returns of i and j on their common dates
+    The returns are the same as ClosePricesStatistics._normalize_returns(df_close[[ticker_i, ticker_j]])
+    shift: (n_tickers,) values subtracted from returns of each ticker (for accurate centered sums)
+
+    A return of the pair is the product of own returns except on the dates where the previous dates of i and j differ
+    (one of them was not traded): these entries are replaced by the returns between the previous common dates
+    """
+    n_tickers = prices.shape[1]
+    shift = np.zeros(n_tickers) if shift is None else shift
+    valid = ~np.isnan(prices)
+    returns, mask = _normalized_returns(prices, days)
+    x = np.where(mask, returns - shift, 0.0)
+    m = mask.astype(np.float64)
+    n = m.T @ m
+    sums = x.T @ m
+    sum_prod = x.T @ x
+
+    # Dates where tickers with returns have different previous dates
+    previous = _previous_valid_row(valid)
+    first_previous = np.where(mask, previous, len(prices)).min(axis=1)
+    last_previous = np.where(mask, previous, -1).max(axis=1)
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(valid)).reshape(-1, 1), -1), axis=0)  # last valid row up to the row
+    dirty_rows = np.flatnonzero(first_previous < last_previous)
+    chunk_size = max(1, PAIRWISE_CHUNK_ELEMENTS // n_tickers ** 2)
+    for chunk_start in range(0, len(dirty_rows), chunk_size):
+        rows = dirty_rows[chunk_start:chunk_start + chunk_size]
+        chunk_mask = mask[rows]
+        differ = (chunk_mask[:, :, None] & chunk_mask[:, None, :]) & (previous[rows][:, :, None] != previous[rows][:, None, :])
+        k, i, j = np.nonzero(differ)
+        row = rows[k]
+
+        # Remove products of own returns
+        _add_at(n, i, j, -np.ones(len(row)))
+        _add_at(sums, i, j, -x[row, i])
+        _add_at(sum_prod, i, j, -x[row, i] * x[row, j])
+
+        # Previous common date of each pair: go back to the dates where both tickers are traded
+        common_row = np.minimum(previous[row, i], previous[row, j])
+        while True:
+            last_i, last_j = last_valid[np.maximum(common_row, 0), i], last_valid[np.maximum(common_row, 0), j]
+            moved = (common_row >= 0) & ((last_i != common_row) | (last_j != common_row))
+            if not moved.any():
+                break
+            common_row = np.where(moved, np.minimum(last_i, last_j), common_row)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            interval = days[row] - days[np.maximum(common_row, 0)]
+            x_i = (prices[row, i] / prices[np.maximum(common_row, 0), i] - 1) / interval - shift[i]
+            x_j = (prices[row, j] / prices[np.maximum(common_row, 0), j] - 1) / interval - shift[j]
+        has_return = (common_row >= 0) & ~np.isnan(x_i) & ~np.isnan(x_j)
+        i, j, x_i, x_j = i[has_return], j[has_return], x_i[has_return], x_j[has_return]
+        _add_at(n, i, j, np.ones(len(i)))
+        _add_at(sums, i, j, x_i)
+        _add_at(sum_prod, i, j, x_i * x_j)
+    return np.rint(n).astype(np.int64), sums, sum_prod
+
+
+###################################################################################
+# Statistics
+###################################################################################
+
+
+def returns_mean_std(df_close: pd.DataFrame) -> tuple[pd.Series, pd.Series]:
+    """
+    Mean and std of normalized returns for each ticker
+    """
+    returns, mask = _normalized_returns(*_to_arrays(df_close))
+    n = mask.sum(axis=0)
+    assert np.all(n >= 1)
+    mean = returns.sum(axis=0) / n
+    centered = np.where(mask, returns - mean, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt((centered ** 2).sum(axis=0) / (n - 1))
+    return pd.Series(mean, index=df_close.columns), pd.Series(std, index=df_close.columns)
+
+
+def pairwise_returns_cov(df_close: pd.DataFrame) -> pd.DataFrame:
+    """
+    Covariance matrix of normalized returns
+    Each pair (i, j) uses only the dates where both tickers are traded (pairwise-complete observations)
+    """
+    prices, days = _to_arrays(df_close)
+    mean, _ = returns_mean_std(df_close)
+    n, sums, sum_prod = _pairwise_sums(prices, days, shift=mean.values)  # returns are centered by own means
+    assert np.all(n >= 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Sigma = (sum_prod - sums * sums.T / n) / (n - 1)
+    Sigma[n < 2] = np.nan
+    return pd.DataFrame(Sigma, index=df_close.columns, columns=df_close.columns)
+
+
+def _chain_prices_hash(previous_hash: str, day: int, closes: np.ndarray) -> str:
+    """
+    Hash of price rows up to the day from the hash of the previous rows (NaNs are canonical)
+    """
+    closes = np.asarray(closes, dtype=np.float64)
+    prices_hash = hashlib.blake2b(previous_hash.encode(), digest_size=16)
+    prices_hash.update(np.int64(day).tobytes())
+    prices_hash.update(np.where(np.isnan(closes), np.nan, closes).tobytes())
+    return prices_hash.hexdigest()
+
+
+def _prices_hashes(prices: np.ndarray, days: np.ndarray) -> list[str]:
+    """
+    Chained hashes of all prefixes of price rows
+    """
+    hashes, prices_hash = [], ''
+    for day, closes in zip(days.tolist(), prices):
+        prices_hash = _chain_prices_hash(prices_hash, day, closes)
+        hashes.append(prices_hash)
+    return hashes
+
+
+###################################################################################
+# Sufficient statistics
+###################################################################################
+
+
+@dataclass
+class ReturnsMoments:
+    """
+    Sufficient statistics of normalized returns on pairwise-complete observations
+    Pair (i, i) describes ticker i on its own trading dates
+    Appending a new trading day costs O(n_tickers^2) and does not touch older history
+    """
+    tickers: list[str]
+    last_day: int  # last date included (days since 1970-01-01)
+    n: np.ndarray  # (n_tickers, n_tickers) number of common returns
+    sum: np.ndarray  # (n_tickers, n_tickers) sum[i, j] = sum of returns of i on common dates of (i, j)
+    sum_prod: np.ndarray  # (n_tickers, n_tickers) sum of products of returns of i and j on their common dates
+    last_common_day: np.ndarray  # (n_tickers, n_tickers) last common date of (i, j) (-1 if there is no such date)
+    last_common_price: np.ndarray  # (n_tickers, n_tickers) price of i on the last common date of (i, j)
+    prices_hash: str  # chained hash of all price rows up to last_day (detects rewritten or prepended history)
+
+    @classmethod
+    def from_prices(cls, df_close: pd.DataFrame) -> 'ReturnsMoments':
+        """
+        Compute statistics over the whole history
+        """
+        prices, days = _to_arrays(df_close)
+        valid = ~np.isnan(prices)
+        n_dates, n_tickers = prices.shape
+        n, sums, sum_prod = _pairwise_sums(prices, days)
+
+        # Last common date and prices for each pair
+        last_common_row = np.full((n_tickers, n_tickers), -1, dtype=np.int64)
+        for i in range(n_tickers):
+            common = valid[:, i:i + 1] & valid
+            last_common_row[i] = np.where(common.any(axis=0), n_dates - 1 - np.argmax(common[::-1], axis=0), -1)
+        last_common_day = np.where(last_common_row >= 0, days[np.maximum(last_common_row, 0)], -1)
+        last_common_price = np.where(last_common_row >= 0, prices[np.maximum(last_common_row, 0), np.arange(n_tickers).reshape(-1, 1)], np.nan)
+
+        return cls(tickers=list(df_close.columns), last_day=int(days[-1]), n=n, sum=sums, sum_prod=sum_prod,
+                   last_common_day=last_common_day, last_common_price=last_common_price, prices_hash=_prices_hashes(prices, days)[-1])
+
+    @classmethod
+    def first_day(cls, tickers: list[str], date: pd.Timestamp, closes: np.ndarray) -> 'ReturnsMoments':
+        """
+        Statistics of one trading day (there are no returns yet)
+        """
+        n_tickers = len(tickers)
+        closes = np.asarray(closes, dtype=float)
+        valid = ~np.isnan(closes)
+        common = valid.reshape(-1, 1) & valid.reshape(1, -1)
+        return cls(tickers=list(tickers), last_day=int(_to_days([date])[0]), n=np.zeros((n_tickers, n_tickers), dtype=np.int64),
+                   sum=np.zeros((n_tickers, n_tickers)), sum_prod=np.zeros((n_tickers, n_tickers)),
+                   last_common_day=np.where(common, int(_to_days([date])[0]), -1), last_common_price=np.where(common, closes.reshape(-1, 1), np.nan),
+                   prices_hash=_chain_prices_hash('', int(_to_days([date])[0]), closes))
+
+    def append_day(self, date: pd.Timestamp, closes: np.ndarray, decay: float = 1.0) -> 'ReturnsMoments':
+        """
+        Return new statistics with one more trading day
+        closes: (n_tickers,) close prices (NaN if ticker is not traded)
+        decay: weight of the previous statistics (exponentially weighted statistics if decay < 1)
+        """
+        day = int(_to_days([date])[0])
+        assert day > self.last_day, f'{date} is not after the last date'
+        closes = np.asarray(closes, dtype=float)
+        valid = ~np.isnan(closes)
+        common = valid.reshape(-1, 1) & valid.reshape(1, -1)
+        has_previous = common & (self.last_common_day >= 0)
+
+        # Returns of i on the common dates of (i, j)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = (closes.reshape(-1, 1) / self.last_common_price - 1) / (day - self.last_common_day)
+        x = np.where(has_previous, x, 0.0)
+
+        # Multiplication by decay = 1 is exact (n stays integer without decay)
+        return ReturnsMoments(
+            tickers=self.tickers,
+            last_day=day,
+            n=self.n + has_previous if decay == 1.0 else decay * self.n + has_previous,
+            sum=decay * self.sum + x,
+            sum_prod=decay * self.sum_prod + x * x.T,
+            last_common_day=np.where(common, day, self.last_common_day),
+            last_common_price=np.where(common, closes.reshape(-1, 1), self.last_common_price),
+            prices_hash=_chain_prices_hash(self.prices_hash, day, closes)
+        )
+
+    def extend(self, df_close: pd.DataFrame) -> tp.Optional['ReturnsMoments']:
+        """
+        Append days of df_close after last_day
+        Return None if df_close is not a continuation of the data the statistics were computed on
+        (any price up to last_day was changed, or dates were added before or inside the history)
+        """
+        if list(df_close.columns) != self.tickers:
+            return None
+        days = _to_days(df_close.index)
+        position = np.searchsorted(days, self.last_day)
+        if position == len(days) or days[position] != self.last_day:
+            return None
+        if _prices_hashes(df_close.to_numpy(dtype=float)[:position + 1], days[:position + 1])[-1] != self.prices_hash:
+            return None
+        moments = self
+        for date, closes in zip(df_close.index[position + 1:], df_close.to_numpy(dtype=float)[position + 1:]):
+            moments = moments.append_day(date, closes)
+        return moments
+
+    def mean_std(self) -> tuple[pd.Series, pd.Series]:
+        n, sums, sum_prod = np.diag(self.n), np.diag(self.sum), np.diag(self.sum_prod)
+        assert np.all(n >= 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(np.maximum(sum_prod - sums ** 2 / n, 0) / (n - 1))
+        return pd.Series(sums / n, index=self.tickers), pd.Series(std, index=self.tickers)
+
+    def cov(self) -> pd.DataFrame:
+        assert np.all(self.n >= 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Sigma = (self.sum_prod - self.sum * self.sum.T / self.n) / (self.n - 1)
+        np.fill_diagonal(Sigma, np.maximum(np.diag(Sigma), 0))
+        return pd.DataFrame(Sigma, index=self.tickers, columns=self.tickers)
+
+    def last_prices(self) -> pd.Series:
+        return pd.Series(np.diag(self.last_common_price), index=self.tickers)
+
+    def save(self, path: Path):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_suffix('.tmp.npz')
+        np.savez(tmp_path, tickers=np.array(self.tickers), last_day=self.last_day, n=self.n, sum=self.sum, sum_prod=self.sum_prod,
+                 last_common_day=self.last_common_day, last_common_price=self.last_common_price, prices_hash=self.prices_hash)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> tp.Optional['ReturnsMoments']:
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            if 'prices_hash' not in data:
+                return None  # saved by an older version
+            return cls(tickers=[str(ticker) for ticker in data['tickers']], last_day=int(data['last_day']), n=data['n'], sum=data['sum'], sum_prod=data['sum_prod'],
+                       last_common_day=data['last_common_day'], last_common_price=data['last_common_price'], prices_hash=str(data['prices_hash']))
+
+
+###################################################################################
+# Covariance estimators
+###################################################################################
+
+
+def ledoit_wolf_cov(Sigma: np.ndarray, df_close: pd.DataFrame) -> tuple[np.ndarray, float]:
+    """
+    Ledoit-Wolf shrinkage of the covariance matrix towards the constant correlation target (variances are not changed)
+    Sigma: (n_tickers, n_tickers) pairwise-complete covariance of normalized returns
+    The shrinkage intensity is estimated on pairwise-complete observations: variance of each covariance is divided by the number of common returns
+    Return (shrunk covariance, shrinkage intensity)
+    """
+    returns, mask = _normalized_returns(*_to_arrays(df_close))
+    n_returns = mask.sum(axis=0)
+    x = np.where(mask, returns - returns.sum(axis=0) / n_returns, 0.0)
+    x2 = x * x
+    mask = mask.astype(np.float64)
+    n = mask.T @ mask  # number of common returns of (i, j)
+    xx = x.T @ x
+
+    # Constant correlation target
+    std = np.sqrt(np.diag(Sigma))
+    corr = Sigma / np.outer(std, std)
+    n_tickers = len(std)
+    mean_corr = (corr.sum() - n_tickers) / (n_tickers * (n_tickers - 1)) if n_tickers > 1 else 0.0
+    target = mean_corr * np.outer(std, std)
+    np.fill_diagonal(target, np.diag(Sigma))
+
+    # pi[i, j] - variance of (x_i x_j - Sigma_ij) on common dates, theta[i, j] - covariance of (x_i^2 - Sigma_ii) and (x_i x_j - Sigma_ij)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pi = (x2.T @ x2 - 2 * Sigma * xx + Sigma ** 2 * n) / n
+        theta = ((x2 * x).T @ x - Sigma * (x2.T @ mask) - np.diag(Sigma).reshape(-1, 1) * xx + np.diag(Sigma).reshape(-1, 1) * Sigma * n) / n
+        rho = mean_corr / 2 * (std.reshape(1, -1) / std.reshape(-1, 1) * theta + std.reshape(-1, 1) / std.reshape(1, -1) * theta.T)
+    np.fill_diagonal(rho, np.diag(pi))
+
+    # Optimal intensity: sum of estimation variances over the distance to the target
+    gamma = ((target - Sigma) ** 2).sum()
+    shrinkage = float(np.clip(np.nansum((pi - rho) / n) / gamma, 0, 1)) if gamma > 0 else 1.0
+    return shrinkage * target + (1 - shrinkage) * Sigma, shrinkage
+
+
+MIN_SPECIFIC_VAR_RATIO = 1e-4  # lower bound of specific variance relative to the total variance
+
+
+@dataclass
+class FactorCovariance:
+    """
+    Covariance in the factor form Sigma = F F^T + diag(d): O(n_tickers * n_factors) memory
+    w^T Sigma w = ||F^T w||^2 + sum(d_i w_i^2)
+    """
+    tickers: list[str]
+    loadings: np.ndarray  # (n_tickers, n_factors) F
+    specific_var: np.ndarray  # (n_tickers,) d
+
+    @classmethod
+    def from_prices(cls, df_close: pd.DataFrame, n_factors: int) -> 'FactorCovariance':
+        """
+        Principal components of correlations of normalized returns (scale invariant) without the dense n_tickers x n_tickers matrix
+        Returns are standardized on own dates, set to 0 on other dates and divided by sqrt(n_i - 1), so Z^T Z has unit diagonal
+        and its off-diagonal elements are correlations over common dates: O(n_dates * n_tickers) memory
+        Factors are the top right singular vectors of Z (truncated SVD)
+        Specific variances complete the diagonal, so variances of tickers are not changed
+        """
+        returns, mask = _normalized_returns(*_to_arrays(df_close))
+        n_returns = mask.sum(axis=0)
+        assert np.all(n_returns >= 2)
+        mean = returns.sum(axis=0, where=mask) / n_returns
+        std = np.sqrt(((returns - mean) ** 2).sum(axis=0, where=mask) / (n_returns - 1))
+        z = np.where(mask, (returns - mean) / (std * np.sqrt(n_returns - 1)), 0.0)
+        n_factors = min(n_factors, min(z.shape) - 1)
+        if n_factors > 0:
+            _, singular_values, vt = scipy.sparse.linalg.svds(z, k=n_factors, random_state=0)
+            loadings = std.reshape(-1, 1) * vt.T * singular_values
+        else:
+            loadings = np.zeros((len(std), 0))
+        specific_var = np.maximum(std ** 2 - (loadings ** 2).sum(axis=1), MIN_SPECIFIC_VAR_RATIO * std ** 2)
+        return cls(tickers=list(df_close.columns), loadings=loadings, specific_var=specific_var)
+
+    def outer_correction(self, v: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Exact factor-size form of Sigma - v v^T (positive semidefinite iff v^T Sigma^(-1) v <= 1):
+        w^T (Sigma - v v^T) w = ||F^T w - a_factors (v^T w)||^2 + ||sqrt(d) w - a_specific (v^T w)||^2
+        Sigma = L L^T with L = [F, diag(sqrt(d))]; with u = L^T Sigma^(-1) v (so that L u = v) Sigma - v v^T = L (I - u u^T) L^T
+        and (I - u u^T)^(1/2) = I - alpha u u^T, alpha = 1 / (1 + sqrt(1 - ||u||^2)); Sigma^(-1) v is found with Woodbury identity
+        If ||u|| > 1, Sigma - v v^T is indefinite and has no such form: Sigma - v v^T / ||u||^2 (the closest positive semidefinite
+        matrix of the form Sigma - t v v^T) is used instead
+        Return (a_factors, a_specific) = alpha * u
+        """
+        v = np.asarray(v, dtype=np.float64)
+        scaled_loadings = self.loadings / self.specific_var.reshape(-1, 1)  # D^(-1) F
+        core = np.eye(self.loadings.shape[1]) + self.loadings.T @ scaled_loadings
+        Sigma_inv_v = v / self.specific_var - scaled_loadings @ np.linalg.solve(core, scaled_loadings.T @ v)
+        u_norm2 = float(v @ Sigma_inv_v)
+        if u_norm2 > 1:
+            print(f'Warning: Sigma - v v^T is not positive semidefinite (v^T Sigma^(-1) v = {u_norm2:.3f}), v v^T is scaled by {1 / u_norm2:.3f}')
+        alpha = 1 / (1 + np.sqrt(1 - u_norm2)) if u_norm2 <= 1 else 1 / u_norm2  # (I - u u^T / ||u||^2) is a projection
+        return alpha * (self.loadings.T @ Sigma_inv_v), alpha * np.sqrt(self.specific_var) * Sigma_inv_v
+
+    def total_var(self) -> np.ndarray:
+        return (self.loadings ** 2).sum(axis=1) + self.specific_var
+
+    def dense(self) -> pd.DataFrame:
+        Sigma = self.loadings @ self.loadings.T + np.diag(self.specific_var)
+        return pd.DataFrame(Sigma, index=self.tickers, columns=self.tickers)
+
+
+def _test_factor_covariance():
+    """
+    Check the factor form of Sigma - v v^T against the dense matrix (positive semidefinite and clipped indefinite cases)
+    """
+    rng = np.random.default_rng(0)
+    n_tickers, n_factors = 50, 3
+    tickers = [f't{i}' for i in range(n_tickers)]
+    for common_loading, expected_psd in [(3.0, True), (0.0, False)]:  # strongly correlated and almost uncorrelated tickers
+        loadings = 0.3 * rng.normal(size=(n_tickers, n_factors)) + common_loading
+        factor_cov = FactorCovariance(tickers=tickers, loadings=loadings, specific_var=rng.uniform(0.5, 1, n_tickers))
+        v = 0.5 * np.sqrt(factor_cov.total_var())
+        Sigma = factor_cov.dense().values
+        u_norm2 = v @ np.linalg.solve(Sigma, v)
+        assert (u_norm2 <= 1) == expected_psd, u_norm2
+        Sigma_minus = Sigma - np.outer(v, v) / max(u_norm2, 1)
+        a_factors, a_specific = factor_cov.outer_correction(v)
+        for _ in range(10):
+            w = rng.normal(size=n_tickers)
+            risk = np.sum((factor_cov.loadings.T @ w - a_factors * (v @ w)) ** 2) + np.sum((np.sqrt(factor_cov.specific_var) * w - a_specific * (v @ w)) ** 2)
+            assert np.isclose(risk, w @ Sigma_minus @ w, rtol=1e-9, atol=1e-12), (risk, w @ Sigma_minus @ w)
+    print('FactorCovariance.outer_correction: OK')
+
+
+def _test_returns_moments_extend():
+    """
+    Check that extended statistics match the full recompute and that rewritten history is not reused
+    """
+    rng = np.random.default_rng(0)
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (300, 5)), axis=0))
+    prices[rng.random(prices.shape) < 0.1] = np.nan
+    df_close = pd.DataFrame(prices, index=pd.bdate_range('2020-01-01', periods=len(prices)), columns=[f't{i}' for i in range(5)])
+    moments = ReturnsMoments.from_prices(df_close.iloc[:250])
+    with tempfile.TemporaryDirectory() as directory:
+        moments.save(Path(directory) / 'moments.npz')
+        moments = ReturnsMoments.load(Path(directory) / 'moments.npz')
+
+    extended = moments.extend(df_close)
+    expected = ReturnsMoments.from_prices(df_close)
+    assert extended.prices_hash == expected.prices_hash
+    assert np.array_equal(extended.n, expected.n)
+    assert np.allclose(extended.cov(), expected.cov(), rtol=1e-9, atol=0)
+
+    # Edited old close, edited last close, new date before the history
+    edited = df_close.copy()
+    edited.iloc[100, 2] = 77.0
+    assert moments.extend(edited) is None
+    edited = df_close.copy()
+    edited.iloc[249, 0] = 123.0
+    assert moments.extend(edited) is None
+    earlier = pd.DataFrame(df_close.iloc[:1].values, index=[df_close.index[0] - pd.Timedelta(days=3)], columns=df_close.columns)
+    assert moments.extend(pd.concat([earlier, df_close])) is None
+    print('ReturnsMoments.extend: OK')
+
+
+if __name__ == '__main__':
+    _test_factor_covariance()
+    _test_returns_moments_extend()
@@ -2,11 +2,14 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+import hashlib
 import time
-from dataclasses import dataclass
-from tqdm import tqdm
+from dataclasses import dataclass, field
+from pathlib import Path
 
-from download_data.moex import MOEX_CLOSE_DIRECTORY, MOEX_TICKERS_DIRECTORY
+from .covariance import ReturnsMoments, FactorCovariance, returns_mean_std, pairwise_returns_cov, ledoit_wolf_cov
+from download_data.moex import MOEX_DATA_DIRECTORY, MOEX_CLOSE_DIRECTORY, MOEX_TICKERS_DIRECTORY, MOEX_STORE_DIRECTORY
+from download_data.price_store import PriceStore, open_price_store, migrate_csv_to_price_store
 
 
 ###################################################################################
@@ -18,6 +21,12 @@ N_MIN_TRADING_YEARS = 8
 # N_MIN_TRADING_YEARS = 9.5 # for debug
 MIN_OBSERVATIONS = TRADING_DAYS_IN_YEAR * N_MIN_TRADING_YEARS  # number of observations per ticker
 
+RETURNS_MOMENTS_DIRECTORY = MOEX_DATA_DIRECTORY / 'returns_moments'  # sufficient statistics of returns from previous loads (one file per set of tickers)
+N_RETURNS_MOMENTS_TO_KEEP = 4  # number of the last used sets of tickers
+
+COVARIANCE_ESTIMATORS = ['sample', 'ledoit_wolf', 'factor']  # pairwise-complete sample, shrinkage to constant correlation, k-factor (PCA) model
+N_FACTORS = 10  # number of factors of the factor model
+
 ###################################################################################
 # Load Data
 ###################################################################################
@@ -32,8 +41,13 @@ class ClosePricesStatistics:
     last_prices: pd.Series = None
     mean_returns: pd.Series = None  # mean returns
     std_returns: pd.Series = None  # returns std
-    Sigma_cov: pd.DataFrame = None  # return's covariance matrix
-    Sigma_corr: pd.DataFrame = None  # return's correlation matrix
+    moments: ReturnsMoments = None  # sufficient statistics of returns (computed from df_close if not provided, not used by the factor model)
+    covariance_estimator: str = 'sample'  # one of COVARIANCE_ESTIMATORS
+    n_factors: int = N_FACTORS  # number of factors for covariance_estimator='factor'
+    factor_cov: FactorCovariance = None  # factor form of the covariance for covariance_estimator='factor': O(n_tickers * n_factors) memory
+    shrinkage: float = None  # shrinkage intensity for covariance_estimator='ledoit_wolf'
+    _Sigma_cov: pd.DataFrame = field(default=None, repr=False)  # dense covariance (not stored for the factor model)
+    _Sigma_corr: pd.DataFrame = field(default=None, repr=False)
 
     def __post_init__(self):
         """
@@ -42,50 +56,96 @@ class ClosePricesStatistics:
         # Calculate tickers
         self.tickers = list(self.df_close.columns)
 
-        # Calculate last_prices
-        self.last_prices = self.df_close.apply(lambda x: x.dropna().iloc[-1])
-
         # Do not calculate statistics if not needed
         if not self.with_statistics:
+            # Calculate last_prices
+            self.last_prices = self.df_close.apply(lambda x: x.dropna().iloc[-1])
+            return
+
+        # The factor model is estimated from returns directly (sufficient statistics are n_tickers x n_tickers)
+        assert self.covariance_estimator in COVARIANCE_ESTIMATORS, self.covariance_estimator
+        if self.covariance_estimator == 'factor':
+            self.last_prices = self.df_close.apply(lambda x: x.dropna().iloc[-1])
+            self.mean_returns, self.std_returns = returns_mean_std(self.df_close)
+            self.factor_cov = FactorCovariance.from_prices(self.df_close, self.n_factors)
+            assert np.all(self.factor_cov.specific_var > 0)
+            assert np.all(self.factor_cov.total_var() >= self.std_returns.values ** 2 * (1 - 1e-8))  # specific variances are at least MIN_SPECIFIC_VAR_RATIO
+            self._remove_outliers()
             return
 
+        # Calculate sufficient statistics of returns
+        if self.moments is None:
+            self.moments = ReturnsMoments.from_prices(self.df_close)
+        assert self.moments.tickers == self.tickers
+
+        # Calculate last_prices
+        self.last_prices = self.moments.last_prices()
+
         # Calculate mean and std returns
-        mean_returns = []
-        std_returns = []
-        for ticker in self.tickers:
-            returns = self._normalize_returns(self.df_close[ticker])
-            mean_returns.append(returns.mean())
-            std_returns.append(returns.std())
-        self.mean_returns = pd.Series(mean_returns, index=self.tickers)
-        self.std_returns = pd.Series(std_returns, index=self.tickers)
-
-        # Calculate Sigma_cov
-        Sigma = pd.DataFrame(columns=self.tickers, index=self.tickers, dtype=float)
-        for ticker_1 in (pbar := tqdm(self.tickers)):
-            pbar.set_description(ticker_1)
-            for ticker_2 in self.tickers:
-                if self.tickers.index(ticker_2) <= self.tickers.index(ticker_1):
-                    continue
-                returns = self._normalize_returns(self.df_close[[ticker_1, ticker_2]])
-                cov = returns.cov().loc[ticker_1, ticker_2]
-                Sigma.loc[ticker_1, ticker_2] = cov
-                Sigma.loc[ticker_2, ticker_1] = cov
-        for ticker in self.tickers:
-            Sigma.loc[ticker, ticker] = self._normalize_returns(self.df_close[ticker]).var()
-        self.Sigma_cov = Sigma
+        self.mean_returns, self.std_returns = self.moments.mean_std()
+
+        # Calculate covariance of normalized returns
+        Sigma_cov = self.moments.cov()
+        if self.covariance_estimator == 'ledoit_wolf':
+            Sigma, self.shrinkage = ledoit_wolf_cov(Sigma_cov.values, self.df_close)
+            Sigma_cov = pd.DataFrame(Sigma, index=self.tickers, columns=self.tickers)
+        self._Sigma_cov = Sigma_cov
 
         # Calculate Sigma_corr
-        self.Sigma_corr = (1 / self.std_returns.values.reshape(-1, 1)) * Sigma * (1 / self.std_returns.values.reshape(1, -1))
+        std = self.std_returns.values
+        self._Sigma_corr = (1 / std.reshape(-1, 1)) * self._Sigma_cov * (1 / std.reshape(1, -1))
 
         # Checks for correlation and covariance matrices
-        assert np.allclose(np.sqrt(np.diag(self.Sigma_cov)), self.std_returns)
-        assert np.allclose(np.diag(self.Sigma_corr), 1)
-        assert np.allclose(self.Sigma_corr, self.Sigma_corr.T)
-        assert np.allclose(self.Sigma_cov, self.Sigma_cov.T)
+        assert np.allclose(np.sqrt(np.diag(self._Sigma_cov)), std)
+        assert np.allclose(np.diag(self._Sigma_corr), 1)
+        assert np.allclose(self._Sigma_corr, self._Sigma_corr.T)
+        assert np.allclose(self._Sigma_cov, self._Sigma_cov.T)
 
         # Remove outliers
         self._remove_outliers()
 
+    @property
+    def Sigma_cov(self) -> pd.DataFrame:
+        """
+        Return's covariance matrix (for the factor model the dense matrix is built on each call and not stored)
+        """
+        if self.factor_cov is not None:
+            return self.factor_cov.dense()
+        return self._Sigma_cov
+
+    @property
+    def Sigma_corr(self) -> pd.DataFrame:
+        """
+        Return's correlation matrix (for the factor model the dense matrix is built on each call and not stored)
+        """
+        if self.factor_cov is not None:
+            std = np.sqrt(self.factor_cov.total_var())
+            return (1 / std.reshape(-1, 1)) * self.factor_cov.dense() * (1 / std.reshape(1, -1))
+        return self._Sigma_corr
+
+    def append_day(self, date: pd.Timestamp, closes: pd.Series) -> 'ClosePricesStatistics':
+        """
+        Return statistics with one more trading day without recomputing older history (the factor model is estimated again)
+        closes: close prices by ticker (missing tickers are not traded on this day)
+        """
+        assert self.with_statistics
+        closes = closes.reindex(self.tickers).astype(float)
+        df_close = pd.concat([self.df_close, closes.to_frame(date).T])
+        df_close.index.name = self.df_close.index.name
+        return ClosePricesStatistics(df_close, with_statistics=True, moments=self.moments.append_day(date, closes.values) if self.moments is not None else None,
+                                     covariance_estimator=self.covariance_estimator, n_factors=self.n_factors)
+
+    def check_against_full_recompute(self):
+        """
+        Check that statistics match the full recompute over df_close
+        """
+        assert self.covariance_estimator == 'sample'
+        mean_returns, std_returns = returns_mean_std(self.df_close)
+        assert np.allclose(self.mean_returns, mean_returns, rtol=1e-8, atol=0)
+        assert np.allclose(self.std_returns, std_returns, rtol=1e-8, atol=0)
+        assert np.allclose(self.Sigma_cov, pairwise_returns_cov(self.df_close), rtol=1e-6, atol=1e-14, equal_nan=True)
+        assert np.allclose(self.last_prices, self.df_close.apply(lambda x: x.dropna().iloc[-1]), rtol=0, atol=0)
+
     def _remove_outliers(self):
         # TODO:
         # sharpe = self.mean_returns / self.std_returns
@@ -108,70 +168,94 @@ class ClosePricesStatistics:
         return returns
 
 
-def load_data(verbose: bool = False, tickers_subset: list[str] | None = None, with_statistics: bool = True) -> ClosePricesStatistics:
+def open_store() -> PriceStore:
+    """
+    Open columnar price store (build it from CSVs once if it does not exist)
+    """
+    store = open_price_store(MOEX_STORE_DIRECTORY)
+    if store is None:
+        store = migrate_csv_to_price_store(MOEX_CLOSE_DIRECTORY, MOEX_STORE_DIRECTORY, expected_tickers=list(pd.read_csv(MOEX_TICKERS_DIRECTORY / 'tickers.csv')['SECID']))
+    return store
+
+
+def _returns_moments_path(tickers: list[str]) -> Path:
+    """
+    File of statistics for the set of tickers (loads of different subsets do not overwrite each other)
+    """
+    return RETURNS_MOMENTS_DIRECTORY / f'{hashlib.blake2b(",".join(tickers).encode(), digest_size=8).hexdigest()}.npz'
+
+
+def _save_returns_moments(moments: ReturnsMoments):
+    """
+    Save statistics and remove files of the sets of tickers that were not used recently
+    """
+    moments.save(_returns_moments_path(moments.tickers))
+    paths = sorted(RETURNS_MOMENTS_DIRECTORY.glob('*.npz'), key=lambda path: path.stat().st_mtime)
+    for path in paths[:-N_RETURNS_MOMENTS_TO_KEEP]:
+        path.unlink(missing_ok=True)
+
+
+def load_data(verbose: bool = False, tickers_subset: list[str] | None = None, with_statistics: bool = True,
+              covariance_estimator: str = 'sample', n_factors: int = N_FACTORS) -> ClosePricesStatistics:
     """
     Return daily close prices for all assets
+    covariance_estimator: one of COVARIANCE_ESTIMATORS
     """
     start_time = time.time()
 
+    # Open columnar price store
+    store = open_store()
+
     # Find all tickers presented
-    tickers = sorted([file.name.removesuffix('.csv') for file in MOEX_CLOSE_DIRECTORY.iterdir()])
-    assert tickers == sorted(pd.read_csv(MOEX_TICKERS_DIRECTORY / 'tickers.csv')['SECID'])
+    tickers = list(store.tickers)
     if verbose:
         print(f'Number of tickers in data: {len(tickers)}')
     if tickers_subset is not None:
         tickers = sorted(set(tickers) & set(tickers_subset))
         if verbose:
             print(f'Number of tickers after taking subset: {len(tickers)} (subset size is {len(tickers_subset)})')
+    column_by_ticker = {ticker: i for i, ticker in enumerate(store.tickers)}
+    columns = np.array([column_by_ticker[ticker] for ticker in tickers], dtype=np.int64)
 
-    # Load df by ticker
-    df_by_ticker = {ticker: pd.read_csv(MOEX_CLOSE_DIRECTORY / f'{ticker}.csv', parse_dates=['TRADEDATE']) for ticker in tickers}
-    columns = next(iter(df_by_ticker.values())).columns
-
-    for ticker, df in df_by_ticker.items():
-        # Checks
-        assert df.isna().sum().sum() == df['CLOSE'].isna().sum()  # no NaNs except close prices
-        assert np.all(columns == df.columns)  # the same columns
-        assert len(df['TRADEDATE']) == len(df['TRADEDATE'].drop_duplicates())  # trade date does not have duplicates
-        assert df['TRADEDATE'].is_monotonic_increasing  # trade date is monotonic
-        assert np.all(df['BOARDID'] == 'TQBR')  # all tickers are in the TQBR section
-        assert np.all((df['VALUE'] == 0) == (df['VOLUME'] == 0))
-        # Drop NaNs and days without volume
-        df = df.dropna()
-        df = df[(df['VOLUME'] != 0)]
-        # Set date index
-        df = df.set_index('TRADEDATE')
-        df.index.names = ['date']
-        assert len(df) != 0
-        # Update df
-        df_by_ticker[ticker] = df
+    # Take close prices on days with volume (drop NaNs and days without volume)
+    close = store.close[:, columns]
+    valid = ~np.isnan(close) & (store.volume[:, columns] != 0)
+    n_observations = valid.sum(axis=0)
+    assert np.all(n_observations != 0)
+    last_rows = len(store.dates) - 1 - np.argmax(valid[::-1], axis=0)
 
     # Get date range from data
-    start_date = min(map(lambda df: df.index[0], df_by_ticker.values()))
-    finish_date = max(map(lambda df: df.index[-1], df_by_ticker.values()))
+    start_date = pd.Timestamp(store.dates[np.argmax(valid.any(axis=1))])
+    finish_date = pd.Timestamp(store.dates[last_rows.max()])
     if verbose:
         print(f'Data from {start_date.date()} to {finish_date.date()}')
 
-    # Filter dfs
-    df_by_ticker = {ticker: df for ticker, df in df_by_ticker.items() if len(df) >= MIN_OBSERVATIONS}
+    # Filter tickers
+    taken = n_observations >= MIN_OBSERVATIONS
     if verbose:
-        print(f'Number of tickers after filtering by minimum number of observations: {len(df_by_ticker)}')
+        print(f'Number of tickers after filtering by minimum number of observations: {taken.sum()}')
 
     # Filter
-    df_by_ticker = {ticker: df for ticker, df in df_by_ticker.items() if (finish_date - df.index[-1]).days == 0}
+    taken &= last_rows == last_rows.max()
     if verbose:
-        print(f'Number of tickers after filtering by final date: {len(df_by_ticker)}')
+        print(f'Number of tickers after filtering by final date: {taken.sum()}')
 
     # Plot number of observations for each ticker
     if verbose:
-        sns.histplot([len(df) for df in df_by_ticker.values()])
+        sns.histplot(n_observations[taken])
         plt.axvline(MIN_OBSERVATIONS, label=f'Minimum number of observations: {MIN_OBSERVATIONS}', linestyle='--')
         plt.xlabel('Number of observations for ticker')
         plt.legend()
         plt.show()
 
-    # Merge time series for all tickers
-    df_prices = pd.concat([df['CLOSE'].rename(ticker) for ticker, df in df_by_ticker.items()], axis=1)
+    # Merge time series for all tickers (keep only dates with at least one observation)
+    close, valid = close[:, taken], valid[:, taken]
+    rows = valid.any(axis=1)
+    df_prices = pd.DataFrame(
+        np.where(valid[rows], close[rows], np.nan),
+        index=pd.DatetimeIndex(store.dates[rows].astype('datetime64[ns]'), name='date'),
+        columns=[ticker for ticker, is_taken in zip(tickers, taken) if is_taken]
+    )
     if verbose:
         print(f'df_prices.shape={df_prices.shape}')
 
@@ -180,6 +264,36 @@ def load_data(verbose: bool = False, tickers_subset: list[str] | None = None, wi
         for year, value in df_prices.index.year.value_counts().sort_index().items():
             print(f'{year} year: {value} observations ({df_prices[df_prices.index.year == year].notna().any().sum()}/{len(df_prices.columns)})')
 
-    return_value = ClosePricesStatistics(df_prices, with_statistics=with_statistics)
+    # Reuse statistics from the previous load if only new days were appended (the factor model does not use them)
+    moments = None
+    with_moments = with_statistics and covariance_estimator != 'factor'
+    if with_moments:
+        moments = ReturnsMoments.load(_returns_moments_path(list(df_prices.columns)))
+        moments = moments.extend(df_prices) if moments is not None else None
+        if verbose:
+            print(f'Statistics are {"updated incrementally" if moments is not None else "computed from scratch"}')
+
+    return_value = ClosePricesStatistics(df_prices, with_statistics=with_statistics, moments=moments, covariance_estimator=covariance_estimator, n_factors=n_factors)
+    if with_moments:
+        _save_returns_moments(return_value.moments)
     print(f'load_data: {time.time() - start_time:.1f} s')
     return return_value
+
+
+def _test_incremental_statistics(n_days: int = 5):
+    """
+    Check that appending days to statistics gives the same result as the full recompute
+    """
+    stat = load_data(with_statistics=True)
+    df_close = stat.df_close
+    incremental = ClosePricesStatistics(df_close.iloc[:-n_days], with_statistics=True)
+    for date, closes in df_close.iloc[-n_days:].iterrows():
+        incremental = incremental.append_day(date, closes.dropna())
+    incremental.check_against_full_recompute()
+    assert np.allclose(incremental.Sigma_cov, stat.Sigma_cov, rtol=1e-6, atol=1e-14, equal_nan=True)
+    print('Incremental statistics match the full recompute')
+
+
+if __name__ == '__main__':
+    # Run as module: python -m research.library.load
+    _test_incremental_statistics()
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import cvxpy as cp
+import threading
 import time
 
 from .load import TRADING_DAYS_IN_YEAR, ClosePricesStatistics
@@ -13,59 +14,196 @@ def _year_return_pct_to_day_return(year_return: float) -> float:
     return year_return / TRADING_DAYS_IN_YEAR / 100
 
 
-def get_markowitz_w(stat: ClosePricesStatistics, bond_year_return_pct: float, bond_year_return_std_pct: float, bond_share_corr: float, mu_year_pct: float, include_bonds: bool) -> pd.Series:
+def _year_std_pct_to_day_std(year_std: float) -> float:
     """
-    Get markowitz portfolio optimization result
-    Use assets from stat
-    Add bond asset to portfolio if include_bonds=True
+    Convert year std in % to daily std in ratio
     """
-    start_time = time.time()
-    assert bond_year_return_pct >= 0
-
-    # Convert mu to ratio return in 1 day
-    mu = _year_return_pct_to_day_return(mu_year_pct)
-    bond_day_return_mean = _year_return_pct_to_day_return(bond_year_return_pct)
-    bond_day_return_std = bond_year_return_std_pct / 100 / np.sqrt(TRADING_DAYS_IN_YEAR)
-
-    # Get required statistics
-    n_assets = len(stat.tickers)
-    Sigma = stat.Sigma_cov.values
-    returns = stat.mean_returns.values
-    index = stat.tickers
-    if include_bonds:
-        n_assets += 1
-        corr_col = (bond_share_corr * bond_day_return_std * stat.std_returns.values).reshape(-1, 1)
-        Sigma = np.block([[np.full((1, 1), bond_day_return_std ** 2), corr_col.T], [corr_col, Sigma]])
-        returns = np.append(bond_day_return_mean, returns)
-        index = ['bond'] + index
-
-    # Define optimized variable
-    w = cp.Variable(n_assets)
-
-    # Define objective (w.T @ Sigma @ w -> min)
-    objective = cp.Minimize((1/2) * cp.quad_form(w, Sigma))
-
-    # Define constraints (0 <= w_i <= 1, sum(w_i) = 1, returns @ w = mu)
-    constraints = [w >= 0, w <= 1, w @ np.ones(n_assets) == 1, returns @ w == mu]
-
-    # Define problem
-    problem = cp.Problem(objective, constraints)
+    return year_std / 100 / np.sqrt(TRADING_DAYS_IN_YEAR)
 
-    # Solve problem
-    problem.solve()
-    assert problem.status == cp.OPTIMAL, f'{problem.status}: {n_assets=}, {bond_year_return_pct=}, {bond_year_return_std_pct=}, {bond_share_corr=}, {mu_year_pct=}'
 
-    # Convert to pd.Series
-    solution = pd.Series(w.value, index=index)
-
-    # Remove values below 0
-    solution[solution < 0] = 0
-
-    # Do sanity checks
-    assert np.isclose(solution.sum(), 1)
-    assert np.all((0 <= solution) & (solution <= 1))
-    assert np.isclose(solution @ returns, mu)
+class MarkowitzSolver:
+    """
+    Markowitz problem for fixed statistics (build once per data load)
+    mu and bond parameters are cvxpy Parameters: the problem is canonicalized once and every OSQP solve is warm-started
+    Parameters are shared, so solves are serialized with a lock (safe to use from server threads)
+    Add bond asset to portfolio if include_bonds=True (its correlation with shares is fixed)
+
+    Bond block of the covariance matrix is written as
+    w^T Sigma w = (bond_std * w_bond + corr * std^T w_shares)^2 + w_shares^T (Sigma_shares - corr^2 * std std^T) w_shares
+    so that it is affine in the parameters
+
+    If statistics have the factor form Sigma_shares = F F^T + diag(d), the risk of shares is ||F^T w||^2 + sum(d_i w_i^2):
+    the problem has O(n_assets * n_factors) nonzeros instead of O(n_assets^2)
+    (with bonds the term -corr^2 * (std^T w_shares)^2 is kept exactly, see FactorCovariance.outer_correction)
+    """
+    # OSQP tolerances: daily returns are about 1e-4, so the default 1e-3 is not enough for the return constraint
+    OSQP_SETTINGS = {'eps_abs': 1e-9, 'eps_rel': 1e-9, 'max_iter': 100_000, 'polish': True}
+    WEIGHTS_TOLERANCE = 1e-6  # tolerance of sanity checks in weights (return is checked relative to the largest return)
+
+    def __init__(self, stat: ClosePricesStatistics, include_bonds: bool, bond_share_corr: float):
+        self.include_bonds = include_bonds
+        self.bond_share_corr = bond_share_corr
+        self.index = (['bond'] if include_bonds else []) + stat.tickers
+        self.n_assets = len(self.index)
+
+        # Parameters (daily returns in ratio)
+        self.mu = cp.Parameter()
+        self.bond_day_return_mean = cp.Parameter()
+        self.bond_day_return_std = cp.Parameter(nonneg=True)
+
+        # Define optimized variable
+        self.w = cp.Variable(self.n_assets)
+
+        # Define objective (w.T @ Sigma @ w -> min) and expected return
+        returns = stat.mean_returns.values
+        w_shares = self.w[1:] if include_bonds else self.w
+        std = stat.std_returns.values
+        constraints = []
+        if stat.factor_cov is not None:
+            factor_cov = stat.factor_cov
+            factors_risk, specific_risk = factor_cov.loadings.T @ w_shares, cp.multiply(np.sqrt(factor_cov.specific_var), w_shares)
+            if include_bonds:
+                # Exact Sigma_shares - corr^2 * std std^T with the auxiliary variable s = corr * std^T w_shares (keeps O(n_assets * n_factors) nonzeros)
+                a_factors, a_specific = factor_cov.outer_correction(bond_share_corr * std)
+                s = cp.Variable()
+                constraints.append(s == bond_share_corr * (std @ w_shares))
+                factors_risk, specific_risk = factors_risk - a_factors * s, specific_risk - a_specific * s
+            shares_risk = cp.sum_squares(factors_risk) + cp.sum_squares(specific_risk)
+        else:
+            Sigma = stat.Sigma_cov.values
+            shares_risk = cp.quad_form(w_shares, cp.psd_wrap(Sigma - bond_share_corr ** 2 * np.outer(std, std))) if include_bonds else cp.quad_form(w_shares, Sigma)
+        if include_bonds:
+            w_bond = self.w[0]
+            risk = cp.square(self.bond_day_return_std * w_bond + bond_share_corr * (std @ w_shares)) + shares_risk
+            expected_return = self.bond_day_return_mean * w_bond + returns @ w_shares
+        else:
+            risk = shares_risk
+            expected_return = returns @ self.w
+        objective = cp.Minimize((1/2) * risk)
+
+        # Define constraints (0 <= w_i <= 1, sum(w_i) = 1, returns @ w = mu)
+        constraints += [self.w >= 0, self.w <= 1, self.w @ np.ones(self.n_assets) == 1, expected_return == self.mu]
+
+        # Define problem
+        self.problem = cp.Problem(objective, constraints)
+        assert self.problem.is_dpp()
+
+        # Returns (for sanity checks)
+        self._shares_returns = returns
+
+        # Cache of solutions and efficient frontiers
+        self._solutions: dict[tuple, pd.Series] = {}
+        self._frontiers: dict[tuple, tuple[np.ndarray, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def _solve(self, mu_year_pct: float, bond_year_return_pct: float, bond_year_return_std_pct: float) -> pd.Series | None:
+        """
+        Solve problem for given parameters (warm-started from the previous solution)
+        Return None if the problem is not solved
+        Call with self._lock held
+        """
+        self.mu.value = _year_return_pct_to_day_return(mu_year_pct)
+        self.bond_day_return_mean.value = _year_return_pct_to_day_return(bond_year_return_pct)
+        self.bond_day_return_std.value = _year_std_pct_to_day_std(bond_year_return_std_pct)
+        self.problem.solve(solver=cp.OSQP, warm_start=True, **self.OSQP_SETTINGS)
+        if self.problem.status != cp.OPTIMAL:
+            return None
+
+        # Convert to pd.Series
+        solution = pd.Series(self.w.value, index=self.index)
+
+        # Remove values below 0
+        solution[solution < 0] = 0
+        return solution
+
+    def _check(self, solution: pd.Series, mu_year_pct: float, bond_year_return_pct: float):
+        """
+        Do sanity checks (within the solver tolerance)
+        """
+        returns = self._shares_returns
+        if self.include_bonds:
+            returns = np.append(_year_return_pct_to_day_return(bond_year_return_pct), returns)
+        tolerance = self.WEIGHTS_TOLERANCE
+        assert abs(solution.sum() - 1) <= tolerance, solution.sum()
+        assert np.all((0 <= solution) & (solution <= 1 + tolerance))
+        return_error = abs(solution @ returns - _year_return_pct_to_day_return(mu_year_pct))
+        assert return_error <= tolerance * np.abs(returns).max(), return_error
+
+    def _bond_parameters(self, bond_year_return_pct: float, bond_year_return_std_pct: float) -> tuple[float, float]:
+        """
+        Bond parameters do not affect the problem without bond asset
+        """
+        if not self.include_bonds:
+            return 0.0, 0.0
+        return bond_year_return_pct, bond_year_return_std_pct
+
+    def precompute_frontier(self, mu_year_pcts: list[float] | np.ndarray, bond_year_return_pct: float, bond_year_return_std_pct: float):
+        """
+        Solve problem on the grid of mu for given bond parameters
+        Later solves with mu inside the grid interpolate between the neighbouring solutions
+        """
+        bond_year_return_pct, bond_year_return_std_pct = self._bond_parameters(bond_year_return_pct, bond_year_return_std_pct)
+        with self._lock:
+            if (bond_year_return_pct, bond_year_return_std_pct) in self._frontiers:
+                return
+            mus, solutions = [], []
+            for mu_year_pct in sorted(map(float, mu_year_pcts)):
+                solution = self._solve(mu_year_pct, bond_year_return_pct, bond_year_return_std_pct)
+                if solution is None:
+                    continue
+                self._solutions[(mu_year_pct, bond_year_return_pct, bond_year_return_std_pct)] = solution
+                mus.append(mu_year_pct)
+                solutions.append(solution.values)
+            if mus:
+                self._frontiers[(bond_year_return_pct, bond_year_return_std_pct)] = (np.array(mus), np.array(solutions))
+
+    def _interpolate(self, mu_year_pct: float, bond_year_return_pct: float, bond_year_return_std_pct: float) -> pd.Series | None:
+        """
+        Interpolate linearly between the frontier points (convex combination of feasible points is feasible)
+        """
+        frontier = self._frontiers.get((bond_year_return_pct, bond_year_return_std_pct))
+        if frontier is None:
+            return None
+        mus, solutions = frontier
+        if not (mus[0] <= mu_year_pct <= mus[-1]):
+            return None
+        right = min(np.searchsorted(mus, mu_year_pct), len(mus) - 1)
+        left = max(right - 1, 0)
+        alpha = 0.0 if mus[right] == mus[left] else (mu_year_pct - mus[left]) / (mus[right] - mus[left])
+        return pd.Series((1 - alpha) * solutions[left] + alpha * solutions[right], index=self.index)
+
+    def solve(self, mu_year_pct: float, bond_year_return_pct: float = 0.0, bond_year_return_std_pct: float = 0.0) -> pd.Series:
+        """
+        Get markowitz portfolio optimization result
+        Bond parameters are ignored if include_bonds=False
+        """
+        start_time = time.time()
+        assert bond_year_return_pct >= 0
+        bond_year_return_pct, bond_year_return_std_pct = self._bond_parameters(bond_year_return_pct, bond_year_return_std_pct)
+        key = (mu_year_pct, bond_year_return_pct, bond_year_return_std_pct)
+
+        with self._lock:
+            # Take solution from cache or frontier
+            solution = self._solutions.get(key)
+            if solution is None:
+                solution = self._interpolate(*key)
+            # Solve problem
+            if solution is None:
+                solution = self._solve(*key)
+                assert solution is not None, f'{self.problem.status}: n_assets={self.n_assets}, {bond_year_return_pct=}, {bond_year_return_std_pct=}, bond_share_corr={self.bond_share_corr}, {mu_year_pct=}'
+                print(f'Optimization time: {time.time() - start_time:.2f} s. n_assets={self.n_assets}')
+            self._solutions[key] = solution
+
+        self._check(solution, mu_year_pct, bond_year_return_pct)
+        return solution.copy()
 
-    print(f'Optimization time: {time.time() - start_time:.2f} s. n_assets={n_assets}')
 
-    return solution
+def get_markowitz_w(stat: ClosePricesStatistics, bond_year_return_pct: float, bond_year_return_std_pct: float, bond_share_corr: float, mu_year_pct: float, include_bonds: bool) -> pd.Series:
+    """
+    Get markowitz portfolio optimization result
+    Use assets from stat
+    Add bond asset to portfolio if include_bonds=True
+    Build MarkowitzSolver once to solve the problem for many parameters
+    """
+    solver = MarkowitzSolver(stat, include_bonds=include_bonds, bond_share_corr=bond_share_corr)
+    return solver.solve(mu_year_pct, bond_year_return_pct=bond_year_return_pct, bond_year_return_std_pct=bond_year_return_std_pct)
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+import typing as tp
+from dataclasses import dataclass
+from pathlib import Path
+
+from .covariance import ReturnsMoments, _to_days
+
+
+###################################################################################
+# Rolling statistics
+###################################################################################
+
+
+@dataclass
+class WindowStatistics:
+    """
+    Statistics of one window with the fields of ClosePricesStatistics used by MarkowitzSolver
+    """
+    tickers: list[str]
+    mean_returns: pd.Series
+    std_returns: pd.Series
+    Sigma_cov: pd.DataFrame
+    factor_cov: None = None
+
+
+@dataclass
+class RollingStatistics:
+    """
+    Mean and covariance of normalized returns (pairwise-complete, as in ReturnsMoments) for many window end dates
+    A window of W days has W + 1 prices: its returns are the returns of ReturnsMoments.from_prices on these prices
+    Covariance matrices are stacked as packed upper triangles: cov_packed[k] is the upper triangle of the k-th matrix
+    """
+    tickers: list[str]
+    dates: np.ndarray  # (n_ends,) datetime64[D] window end dates
+    window: int | None  # number of trading days in window (None for exponentially weighted statistics)
+    halflife: float | None  # halflife in trading days of exponentially weighted statistics (None for windows)
+    n_observations: np.ndarray  # (n_ends, n_tickers) number of returns of each ticker (sum of weights for EWMA)
+    mean: np.ndarray  # (n_ends, n_tickers) float64
+    cov_packed: np.ndarray  # (n_ends, n_tickers * (n_tickers + 1) / 2) float32, NaN if the pair has less than 2 common returns
+
+    def __post_init__(self):
+        n_tickers = len(self.tickers)
+        assert self.mean.shape == (len(self.dates), n_tickers)
+        assert self.cov_packed.shape == (len(self.dates), n_tickers * (n_tickers + 1) // 2)
+
+    def index(self, date: pd.Timestamp | np.datetime64) -> int:
+        """
+        Index of the last window that ends on or before date
+        """
+        k = int(np.searchsorted(self.dates, np.datetime64(date, 'D'), side='right')) - 1
+        assert k >= 0, f'There are no statistics before {date}'
+        return k
+
+    def cov(self, k: int) -> pd.DataFrame:
+        n_tickers = len(self.tickers)
+        rows, columns = np.triu_indices(n_tickers)
+        Sigma = np.empty((n_tickers, n_tickers))
+        Sigma[rows, columns] = Sigma[columns, rows] = self.cov_packed[k]
+        return pd.DataFrame(Sigma, index=self.tickers, columns=self.tickers)
+
+    def mean_std(self, k: int) -> tuple[pd.Series, pd.Series]:
+        diagonal = np.cumsum(np.arange(len(self.tickers), 0, -1)) - np.arange(len(self.tickers), 0, -1)  # positions of (i, i) in the triangle
+        std = np.sqrt(self.cov_packed[k, diagonal].astype(np.float64))
+        return pd.Series(self.mean[k], index=self.tickers), pd.Series(std, index=self.tickers)
+
+    def window_statistics(self, k: int, columns: np.ndarray | None = None) -> WindowStatistics:
+        """
+        Statistics of the k-th window for a subset of tickers (all tickers by default)
+        """
+        columns = np.arange(len(self.tickers)) if columns is None else np.asarray(columns)
+        tickers = [self.tickers[i] for i in columns]
+        mean, std = self.mean_std(k)
+        Sigma = self.cov(k).values[np.ix_(columns, columns)]
+        return WindowStatistics(tickers=tickers, mean_returns=pd.Series(mean.values[columns], index=tickers), std_returns=pd.Series(std.values[columns], index=tickers),
+                                Sigma_cov=pd.DataFrame(Sigma, index=tickers, columns=tickers))
+
+    def save(self, path: Path):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_suffix('.tmp.npz')
+        np.savez(tmp_path, tickers=np.array(self.tickers), dates=self.dates, window=-1 if self.window is None else self.window,
+                 halflife=np.nan if self.halflife is None else self.halflife, n_observations=self.n_observations, mean=self.mean, cov_packed=self.cov_packed)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> tp.Optional['RollingStatistics']:
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return cls(tickers=[str(ticker) for ticker in data['tickers']], dates=data['dates'],
+                       window=None if int(data['window']) < 0 else int(data['window']), halflife=None if np.isnan(data['halflife']) else float(data['halflife']),
+                       n_observations=data['n_observations'], mean=data['mean'], cov_packed=data['cov_packed'])
+
+
+def _window_moments(n: np.ndarray, sums: np.ndarray, sum_prod: np.ndarray, sum_squared_weights: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Mean (n_tickers,) and covariance (n_tickers, n_tickers) from (weighted) sums of returns on pairwise-complete observations
+    n is the sum of weights: the unbiased covariance divides by n - sum_squared_weights / n (n - 1 for unit weights)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.diag(sums) / np.diag(n)
+        denominator = n - sum_squared_weights / n
+        Sigma = (sum_prod - sums * sums.T / n) / denominator
+    Sigma[~(denominator > 0)] = np.nan
+    np.fill_diagonal(Sigma, np.maximum(np.diag(Sigma), 0))
+    return mean, Sigma
+
+
+def _next_valid_rows(valid: np.ndarray) -> np.ndarray:
+    """
+    For each cell return the index of the next row (the row itself included) where the column is valid (n_rows if there is no such row)
+    """
+    rows = np.where(valid, np.arange(len(valid)).reshape(-1, 1), len(valid))
+    return np.minimum.accumulate(rows[::-1], axis=0)[::-1]
+
+
+def _first_returns_outside(lagging: ReturnsMoments, prices: np.ndarray, days: np.ndarray, next_valid: np.ndarray,
+                           start: int, end: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (n, sum, sum_prod) of the returns in rows (start, end] whose previous common price is before row start
+    (the first return of a pair in the window if the pair is not traded on row start)
+    lagging: statistics up to row start
+    """
+    n_tickers = prices.shape[1]
+    n, sums, sum_prod = np.zeros((n_tickers, n_tickers), dtype=np.int64), np.zeros((n_tickers, n_tickers)), np.zeros((n_tickers, n_tickers))
+    # Pairs traded before row start, but not on it, with both tickers traded in the window
+    traded = next_valid[start + 1] <= end if start + 1 < len(prices) else np.zeros(n_tickers, dtype=bool)
+    pending = (lagging.last_common_day >= 0) & (lagging.last_common_day < days[start]) & traded.reshape(-1, 1) & traded.reshape(1, -1)
+    columns = np.flatnonzero(pending.any(axis=1))
+    if len(columns) == 0:
+        return n, sums, sum_prod
+
+    # Find the first common row of each pair (usually the next rows)
+    block = np.ix_(columns, columns)
+    pending = pending[block]
+    last_common_day, last_common_price = lagging.last_common_day[block], lagging.last_common_price[block]
+    n_block, sums_block, sum_prod_block = n[block], sums[block], sum_prod[block]
+    for row in range(next_valid[start + 1, columns].min(), end + 1):
+        valid = ~np.isnan(prices[row, columns])
+        common = valid.reshape(-1, 1) & valid.reshape(1, -1)
+        found = pending & common
+        if found.any():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = np.where(found, (prices[row, columns].reshape(-1, 1) / last_common_price - 1) / (days[row] - last_common_day), 0.0)
+            n_block += found
+            sums_block += x
+            sum_prod_block += x * x.T
+            pending &= ~common
+        if not pending.any():
+            break
+    n[block], sums[block], sum_prod[block] = n_block, sums_block, sum_prod_block
+    return n, sums, sum_prod
+
+
+def rolling_statistics(df_close: pd.DataFrame, window: int | None = None, halflife: float | None = None,
+                       end_dates: tp.Iterable | None = None, dtype: type = np.float32) -> RollingStatistics:
+    """
+    Statistics of normalized returns for each window end date in one pass over df_close
+    window: number of trading days (rows of df_close) in window: prices of the window end date and window days before it
+    halflife: halflife in trading days of exponentially weighted statistics (instead of window)
+    end_dates: window end dates (all dates of df_close by default)
+
+    Sums of returns are updated per day with O(n_tickers^2) state: window sums are the difference of the sums
+    up to the end date and the sums up to the first day of the window (the second ReturnsMoments lags window days behind)
+    without the returns that bridge a gap over the first day of the window (their previous price is outside the window)
+    Exponentially weighted covariance is unbiased for reliability weights (the sum of squared weights is tracked per pair)
+    """
+    assert (window is None) != (halflife is None), 'Set either window or halflife'
+    decay = 1.0 if halflife is None else 0.5 ** (1 / halflife)
+    dates = df_close.index
+    prices = df_close.to_numpy(dtype=float)
+    days = _to_days(dates)
+    next_valid = _next_valid_rows(~np.isnan(prices)) if window is not None else None
+    is_end = np.ones(len(dates), dtype=bool) if end_dates is None else dates.isin(pd.DatetimeIndex(end_dates))
+
+    n_tickers = len(df_close.columns)
+    rows, columns = np.triu_indices(n_tickers)
+    n_observations, means, covs = [], [], []
+    leading = ReturnsMoments.first_day(list(df_close.columns), dates[0], prices[0])
+    lagging = leading
+    sum_squared_weights = np.zeros((n_tickers, n_tickers))  # of exponentially weighted statistics
+    for t in range(len(dates)):
+        if t > 0:
+            previous_n = leading.n
+            leading = leading.append_day(dates[t], prices[t], decay=decay)
+            if window is None:
+                sum_squared_weights = decay ** 2 * sum_squared_weights + np.rint(leading.n - decay * previous_n)
+        if window is not None and t - window > 0:
+            lagging = lagging.append_day(dates[t - window], prices[t - window])
+        if not is_end[t]:
+            continue
+        if window is None:
+            n, sums, sum_prod = leading.n, leading.sum, leading.sum_prod
+        else:
+            outside_n, outside_sum, outside_sum_prod = _first_returns_outside(lagging, prices, days, next_valid, max(t - window, 0), t)
+            n = leading.n - lagging.n - outside_n
+            sums = leading.sum - lagging.sum - outside_sum
+            sum_prod = leading.sum_prod - lagging.sum_prod - outside_sum_prod
+            sum_squared_weights = n
+        mean, Sigma = _window_moments(n, sums, sum_prod, sum_squared_weights)
+        n_observations.append(np.diag(n).copy())
+        means.append(mean)
+        covs.append(Sigma[rows, columns].astype(dtype))
+
+    return RollingStatistics(
+        tickers=list(df_close.columns),
+        dates=dates[is_end].to_numpy(dtype='datetime64[D]'),
+        window=window,
+        halflife=halflife,
+        n_observations=np.array(n_observations).reshape(-1, n_tickers),
+        mean=np.array(means).reshape(-1, n_tickers),
+        cov_packed=np.array(covs, dtype=dtype).reshape(-1, len(rows))
+    )
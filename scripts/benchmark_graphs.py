@@ -0,0 +1,62 @@
+import sys
+import os
+sys.path.append(os.getcwd())  # noqa: run from the repository root
+
+import time
+import numpy as np
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+from types import SimpleNamespace
+
+from website.library.graphs import create_pie_chart
+
+N_REPEATS = 50
+SECTORS = ['потребительский', 'энергия', 'финансы', 'IT', 'сырье', 'недвижимость', 'телекоммуникации']
+
+
+def create_pie_chart_html(portfolio) -> str:
+    """
+    Previous implementation: build the whole figure and serialize it to html on every request
+    """
+    n_pies = bool(portfolio.stocks) + bool(portfolio.bonds)
+    fig = make_subplots(rows=1, cols=n_pies, specs=[[{'type': 'domain'}] * n_pies])
+    annotations = []
+    for i, (instruments, text) in enumerate([(instruments, text) for instruments, text in [(portfolio.stocks, 'Акции'), (portfolio.bonds, 'Облигации')] if instruments]):
+        total_capital = sum(instrument.invested_capital for instrument in instruments)
+        fig.add_trace(go.Pie(labels=[instrument.sector for instrument in instruments], values=[instrument.invested_capital / total_capital * 100 for instrument in instruments]), 1, i + 1)
+        annotations += [dict(text=text, x=[0.18, 0.85][i] if n_pies == 2 else 0.5, y=0.5, font_size=20, showarrow=False)]
+    fig.update_traces(hole=0.4, hoverinfo="label+percent")
+    fig.update_layout(title="Распределение по секторам", annotations=annotations)
+    return fig.to_html(include_plotlyjs='cdn', full_html=False)
+
+
+def make_portfolio(n_stocks: int, n_bonds: int, seed: int = 0) -> SimpleNamespace:
+    rng = np.random.default_rng(seed)
+
+    def instruments(n: int) -> list[SimpleNamespace]:
+        return [SimpleNamespace(sector=rng.choice(SECTORS), invested_capital=float(rng.uniform(1e3, 1e5))) for _ in range(n)]
+
+    return SimpleNamespace(stocks=instruments(n_stocks), bonds=instruments(n_bonds))
+
+
+def benchmark(function, portfolio) -> tuple[float, int]:
+    """
+    Return (mean time in ms, size of the result in bytes)
+    """
+    result = function(portfolio)  # warm up
+    start_time = time.perf_counter()
+    for _ in range(N_REPEATS):
+        function(portfolio)
+    return (time.perf_counter() - start_time) / N_REPEATS * 1000, len(result.encode())
+
+
+def main():
+    for n_stocks, n_bonds in [(5, 5), (10, 0), (0, 10), (50, 50)]:
+        portfolio = make_portfolio(n_stocks, n_bonds)
+        old_ms, old_bytes = benchmark(create_pie_chart_html, portfolio)
+        new_ms, new_bytes = benchmark(create_pie_chart, portfolio)
+        print(f'stocks={n_stocks}, bonds={n_bonds}: fig.to_html: {old_ms:.2f} ms, {old_bytes} bytes. Template: {new_ms:.3f} ms, {new_bytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import sys
+import os
+sys.path.append(os.getcwd())  # noqa: run from the repository root
+
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from download_data.price_store import PRICE_STORE_COLUMNS, read_tickers_csv, build_price_store
+
+N_DATES = 2500
+FILE_COUNTS = [25, 100, 250]
+
+
+def read_ticker_csv_old(path: Path) -> pd.DataFrame:
+    """
+    Previous implementation: read all columns, infer dtypes and validate in separate passes
+    """
+    df = pd.read_csv(path, parse_dates=['TRADEDATE'])
+    assert df.isna().sum().sum() == df['CLOSE'].isna().sum(), path
+    assert len(df['TRADEDATE']) == len(df['TRADEDATE'].drop_duplicates()), path
+    assert df['TRADEDATE'].is_monotonic_increasing, path
+    assert np.all(df['BOARDID'] == 'TQBR'), path
+    assert np.all((df['VALUE'] == 0) == (df['VOLUME'] == 0)), path
+    return df
+
+
+def load_old(paths: dict[str, Path]) -> dict[str, pd.DataFrame]:
+    """
+    Previous implementation: read files one at a time and align them with pd.concat
+    """
+    df_by_ticker = {ticker: read_ticker_csv_old(path) for ticker, path in paths.items()}
+    return {column: pd.concat({ticker: df.set_index('TRADEDATE')[column] for ticker, df in df_by_ticker.items()}, axis=1, sort=True) for column in PRICE_STORE_COLUMNS}
+
+
+def load_new(paths: dict[str, Path]):
+    return build_price_store(read_tickers_csv(paths))
+
+
+def write_csvs(directory: Path, n_files: int, seed: int = 0) -> dict[str, Path]:
+    """
+    Write synthetic MOEX CSVs with different histories
+    """
+    rng = np.random.default_rng(seed)
+    all_dates = pd.bdate_range('2014-01-01', periods=N_DATES)
+    paths = {}
+    for i in range(n_files):
+        dates = all_dates[rng.integers(0, N_DATES // 2):]
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        volume = rng.integers(0, 1000, len(dates)).astype(np.float64)
+        df = pd.DataFrame({'BOARDID': 'TQBR', 'TRADEDATE': dates, 'CLOSE': close, 'VOLUME': volume, 'VALUE': volume * close})
+        df.loc[df.sample(frac=0.01, random_state=i).index, 'CLOSE'] = np.nan
+        paths[f'T{i:04d}'] = directory / f'T{i:04d}.csv'
+        df.to_csv(paths[f'T{i:04d}'], index=False, date_format='%Y-%m-%d')
+    return paths
+
+
+def benchmark(function, paths: dict[str, Path]) -> float:
+    """
+    Return the best time in seconds
+    """
+    times = []
+    for _ in range(3):
+        start_time = time.perf_counter()
+        function(paths)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main():
+    for n_files in FILE_COUNTS:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_csvs(Path(directory), n_files)
+            old_time, new_time = benchmark(load_old, paths), benchmark(load_new, paths)
+            print(f'files={n_files}: sequential + concat: {old_time:.3f} s ({old_time / n_files * 1000:.1f} ms/file). '
+                  f'Parallel + aligned: {new_time:.3f} s ({new_time / n_files * 1000:.1f} ms/file). Speedup: {old_time / new_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,12 @@ sys.path.append('d:/Projects/invest-symphony/')  # noqa
 import pandas as pd
 import numpy as np
 import asyncio
-import tinkoff.invest as inv
 import requests
 import argparse
 from pathlib import Path
 from functools import partial
 
-from download_data import download_shares_info, download_shares_close_prices
+from download_data import ShareInfo, download_shares_info, download_shares_close_prices
 from research import load_data, ClosePricesStatistics
 
 IMOEX_DATA_DIRECTORY = Path("data/imoex")
@@ -88,7 +87,7 @@ def download_imoex_components(force_update: bool):
     return table.set_index('ticker')
 
 
-def merge_ordinary_and_preference_shares(imoex: pd.DataFrame, share_by_ticker: dict[str, inv.Share]) -> pd.DataFrame:
+def merge_ordinary_and_preference_shares(imoex: pd.DataFrame, share_by_ticker: dict[str, ShareInfo]) -> pd.DataFrame:
     imoex = imoex.copy()
 
     tickers = imoex.index.to_list()
@@ -169,7 +168,7 @@ def main(force_update: bool):
 
     # Load shares from tinkoff
     tinkoff_shares = asyncio.run(download_shares_info(force_update=force_update))
-    share_by_ticker = {share.ticker: share for share in tinkoff_shares}
+    share_by_ticker = tinkoff_shares.by_ticker()
 
     # Load close prices
     asyncio.run(download_shares_close_prices(force_update=force_update))
@@ -1,2 +1,2 @@
-from .portfolio import create_portfolio, RISK_VALUES, load_data_to_ram
+from .portfolio import create_portfolio, create_portfolios, PortfolioRequest, portfolio_to_dict, RISK_VALUES, TIME_VALUES, MAX_INSTRUMENTS_VALUES, BONDS_OR_SHARES_VALUES, load_data_to_ram, refresh_bonds_prices, save_data_ram_snapshot, load_data_ram_snapshot, parse_time_answer, parse_max_instruments_answer, get_dataset
 from .graphs import create_graphs
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+
+from .ytm import DAYS_IN_YEAR
+
+###################################################################################
+# Config
+###################################################################################
+
+BACKTEST_YEARS = 5  # length of the history for the backtest
+MAX_CHART_POINTS = 200  # number of points of the cumulative return chart
+
+###################################################################################
+# Backtest
+###################################################################################
+
+
+@dataclass
+class BacktestReturns:
+    """
+    Daily returns of shares aligned by date (computed once per data load)
+    Returns before the first price of a share are zeros
+    """
+    dates: np.ndarray  # (n_dates,) datetime64[D]
+    returns: np.ndarray  # (n_dates, n_tickers) float64, returns[0] = 0
+    days: np.ndarray  # (n_dates,) calendar days since the previous date, days[0] = 0
+    column_by_ticker: dict[str, int]
+
+    @classmethod
+    def from_close_prices(cls, df_close: pd.DataFrame, years: int = BACKTEST_YEARS) -> 'BacktestReturns':
+        df_close = df_close.loc[df_close.index >= df_close.index[-1] - pd.DateOffset(years=years)] if len(df_close) else df_close
+        prices = df_close.ffill().to_numpy(dtype=np.float64)
+        returns = np.zeros_like(prices)
+        returns[1:] = prices[1:] / prices[:-1] - 1
+        returns[~np.isfinite(returns)] = 0.0
+        dates = df_close.index.to_numpy(dtype='datetime64[D]')
+        days = np.zeros(len(dates), dtype=np.float64)
+        days[1:] = np.diff(dates).astype(np.float64)
+        return cls(dates=dates, returns=returns, days=days, column_by_ticker={ticker: i for i, ticker in enumerate(df_close.columns)})
+
+    def cumulative_return(self, tickers: list[str], stock_weights: np.ndarray, bond_ytm_pct: np.ndarray, bond_weights: np.ndarray) -> np.ndarray:
+        """
+        Cumulative return of the portfolio rebalanced daily to constant weights
+        Bonds grow with their YTM
+        Return (n_dates,) array (0 at the first date)
+        """
+        columns = [self.column_by_ticker[ticker] for ticker in tickers]
+        daily_returns = self.returns[:, columns] @ np.asarray(stock_weights, dtype=np.float64)
+        if len(bond_weights):
+            bond_year_growth = 1 + np.asarray(bond_ytm_pct, dtype=np.float64) / 100
+            daily_returns += (bond_year_growth.reshape(1, -1) ** (self.days.reshape(-1, 1) / DAYS_IN_YEAR) - 1) @ np.asarray(bond_weights, dtype=np.float64)
+        return np.cumprod(1 + daily_returns) - 1
+
+
+def downsample_indices(n: int, max_points: int = MAX_CHART_POINTS) -> np.ndarray:
+    """
+    Evenly spaced indices of at most max_points points (the first and the last points are included)
+    """
+    if n <= max_points:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, max_points).round().astype(np.int64))
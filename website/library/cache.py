@@ -0,0 +1,87 @@
+import threading
+import time
+import typing as tp
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+
+###################################################################################
+# LRU cache with TTL
+###################################################################################
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0  # entries removed because of size limit, TTL or a new data version
+    size: int = 0
+
+
+class ResponseCache:
+    """
+    In-process LRU cache with time to live
+    Entries belong to a data version: the cache is cleared when a newer version is seen
+    Versions are ordered strings (timestamps): requests that still use an older version do not flush the cache
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.version: str = None
+        self._entries: OrderedDict[tp.Hashable, tuple[float, tp.Any]] = OrderedDict()  # key -> (expiration time, value)
+        self._stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def _switch_version(self, version: str) -> bool:
+        """
+        Clear the cache for a newer version, return whether version is the current one
+        """
+        if self.version is not None and version < self.version:
+            return False
+        if version != self.version:
+            self._stats.evictions += len(self._entries)
+            self._entries.clear()
+            self.version = version
+        return True
+
+    def get(self, key: tp.Hashable, version: str) -> tp.Any | None:
+        """
+        Return cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key) if self._switch_version(version) else None
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self._stats.evictions += 1
+                entry = None
+            if entry is None:
+                self._stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+            return entry[1]
+
+    def put(self, key: tp.Hashable, version: str, value: tp.Any):
+        with self._lock:
+            if not self._switch_version(version):
+                return  # value of an older version
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+
+    def get_or_create(self, key: tp.Hashable, version: str, create: tp.Callable[[], tp.Any]) -> tp.Any:
+        """
+        Return cached value or create and cache it (the value is created outside the lock)
+        """
+        value = self.get(key, version)
+        if value is None:
+            value = create()
+            self.put(key, version, value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._stats.size = len(self._entries)
+            return asdict(self._stats) | {'version': self.version}
@@ -1,45 +1,117 @@
+import copy
+import numpy as np
 from dataclasses import dataclass
 import plotly.graph_objects as go
+from plotly.offline import get_plotlyjs_version
 from plotly.subplots import make_subplots
+from jinja2.utils import htmlsafe_json_dumps
 
-from .portfolio import Portfolio, Bond, Stock
+from .portfolio import Portfolio, Bond, Stock, Dataset, get_dataset
+from .backtest import downsample_indices
+
+PLOTLYJS_URL = f'https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js'
 
 
 @dataclass
 class Graphs:
-    pie_chart: str
-    cum_return_chart: str = None
+    pie_chart: str  # JSON with data and layout of the figure for Plotly.newPlot ('' if there is no chart)
+    cum_return_chart: str = None  # JSON with data and layout of the figure for Plotly.newPlot ('' if there is no chart)
+    plotlyjs_url: str = PLOTLYJS_URL
 
 
-def add_trace_for_pie_chart(fig, instruments: list[Bond | Stock], graph_number: int):
+def _sector_percentages(instruments: list[Bond | Stock]) -> tuple[list[str], list[float]]:
     total_capital = sum(instrument.invested_capital for instrument in instruments)
     sector_percentages = [(instrument.sector, instrument.invested_capital / total_capital * 100) for instrument in instruments]
     labels, sizes = zip(*sector_percentages)
-    fig.add_trace(go.Pie(labels=labels, values=sizes), 1, graph_number)
+    return list(labels), list(sizes)
 
 
-def create_pie_chart(portfolio: Portfolio):
-    n_pies = bool(portfolio.stocks) + bool(portfolio.bonds)
-    if n_pies == 0:
-        return ''
+def _create_pie_chart_template(with_stocks: bool, with_bonds: bool) -> tuple[list[dict], str]:
+    """
+    Build figure without data once: return (traces, layout in JSON)
+    """
+    n_pies = with_stocks + with_bonds
     fig = make_subplots(rows=1, cols=n_pies, specs=[[{'type': 'domain'}] * n_pies])
 
     annotations = []
-    if portfolio.stocks:
-        add_trace_for_pie_chart(fig, portfolio.stocks, min(1, n_pies))
-        annotations += [dict(text='Акции', x=0.18 if portfolio.bonds else 0.5, y=0.5, font_size=20, showarrow=False)]
-    if portfolio.bonds:
-        add_trace_for_pie_chart(fig, portfolio.bonds, min(2, n_pies))
-        annotations += [dict(text='Облигации', x=0.85 if portfolio.stocks else 0.5, y=0.5, font_size=20, showarrow=False)]
+    if with_stocks:
+        fig.add_trace(go.Pie(labels=[], values=[]), 1, min(1, n_pies))
+        annotations += [dict(text='Акции', x=0.18 if with_bonds else 0.5, y=0.5, font_size=20, showarrow=False)]
+    if with_bonds:
+        fig.add_trace(go.Pie(labels=[], values=[]), 1, min(2, n_pies))
+        annotations += [dict(text='Облигации', x=0.85 if with_stocks else 0.5, y=0.5, font_size=20, showarrow=False)]
 
     fig.update_traces(hole=0.4, hoverinfo="label+percent")
     fig.update_layout(title="Распределение по секторам", annotations=annotations)
 
-    return fig.to_html(include_plotlyjs='cdn', full_html=False)
+    figure = fig.to_plotly_json()
+    return figure['data'], htmlsafe_json_dumps(figure['layout'], ensure_ascii=False)
+
+
+# (with_stocks, with_bonds) -> (traces, layout in JSON)
+_pie_chart_templates: dict[tuple[bool, bool], tuple[list[dict], str]] = {}
+
+
+def create_pie_chart(portfolio: Portfolio) -> str:
+    """
+    Fill precomputed figure with sectors of the portfolio (the figure is drawn on the client)
+    """
+    key = (bool(portfolio.stocks), bool(portfolio.bonds))
+    if not any(key):
+        return ''
+    if key not in _pie_chart_templates:
+        _pie_chart_templates[key] = _create_pie_chart_template(*key)
+    traces, layout = _pie_chart_templates[key]
+
+    traces = copy.deepcopy(traces)
+    for trace, instruments in zip(traces, [instruments for instruments in [portfolio.stocks, portfolio.bonds] if instruments]):
+        trace['labels'], trace['values'] = _sector_percentages(instruments)
+    return f'{{"data": {htmlsafe_json_dumps(traces, ensure_ascii=False)}, "layout": {layout}}}'
+
+
+def _create_cum_return_chart_layout() -> str:
+    fig = go.Figure()
+    fig.update_layout(title='Доходность портфеля на истории', yaxis_title='Доходность, %', yaxis_ticksuffix='%', showlegend=False)
+    return htmlsafe_json_dumps(fig.to_plotly_json()['layout'], ensure_ascii=False)
+
+
+_cum_return_chart_layout: str = None
+
+
+def create_cum_return_chart(portfolio: Portfolio, dataset: Dataset) -> str:
+    """
+    Cumulative return of the portfolio on history (weights are shares of invested capital)
+    """
+    global _cum_return_chart_layout
+    stocks_value = sum(stock.invested_capital for stock in portfolio.stocks)
+    bonds_value = sum(bond.invested_capital for bond in portfolio.bonds)
+    total_value = stocks_value + bonds_value
+    if dataset.backtest is None or total_value == 0 or len(dataset.backtest.dates) < 2:
+        return ''
+    if _cum_return_chart_layout is None:
+        _cum_return_chart_layout = _create_cum_return_chart_layout()
+
+    cum_return = dataset.backtest.cumulative_return(
+        tickers=[stock.info.ticker for stock in portfolio.stocks],
+        stock_weights=[stock.invested_capital / total_value for stock in portfolio.stocks],
+        bond_ytm_pct=[bond.info.real_ytm_pct for bond in portfolio.bonds],
+        bond_weights=[bond.invested_capital / total_value for bond in portfolio.bonds]
+    )
+    indices = downsample_indices(len(cum_return))
+    trace = {
+        'type': 'scatter',
+        'mode': 'lines',
+        'x': np.datetime_as_string(dataset.backtest.dates[indices]).tolist(),
+        'y': np.round(cum_return[indices] * 100, 2).tolist(),
+        'hovertemplate': '%{x}: %{y:.2f}%<extra></extra>'
+    }
+    return f'{{"data": {htmlsafe_json_dumps([trace], ensure_ascii=False)}, "layout": {_cum_return_chart_layout}}}'
 
 
-def create_graphs(portfolio: Portfolio) -> Graphs:
+def create_graphs(portfolio: Portfolio, dataset: Dataset | None = None) -> Graphs:
     """
     Make graphs of the portfolio
     """
-    return Graphs(pie_chart=create_pie_chart(portfolio))
+    if dataset is None:
+        dataset = get_dataset()
+    return Graphs(pie_chart=create_pie_chart(portfolio), cum_return_chart=create_cum_return_chart(portfolio, dataset))
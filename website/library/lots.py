@@ -0,0 +1,249 @@
+import heapq
+import math
+import time
+import tracemalloc
+import numpy as np
+
+###################################################################################
+# Integer lots allocation
+###################################################################################
+
+
+def _select_stocks(capital: float, w: np.ndarray, lot_prices: np.ndarray, max_stocks: int | float) -> np.ndarray:
+    """
+    Select the largest number of stocks (at most max_stocks) such that each of them gets at least one lot
+    when weights are renormalized over the selected stocks
+    Renormalization does not change the order of stocks by lots, so the selected stocks are the top stocks by lots
+    Return indices of the selected stocks
+    """
+    support = np.flatnonzero(w > 0)
+    if len(support) == 0:
+        return support
+    lots = capital * w[support] / lot_prices[support]
+    order = support[np.argsort(-lots, kind='stable')]
+    # Number of lots of the k-th stock when weights of the first k stocks are renormalized
+    min_lots = np.sort(lots)[::-1] * w.sum() / np.cumsum(w[order])
+    min_lots = min_lots[:int(min(max_stocks, len(min_lots)))]
+    n_selected = np.flatnonzero(min_lots >= 1)
+    n_selected = n_selected[-1] + 1 if len(n_selected) else 0
+    return np.sort(order[:n_selected])
+
+
+def allocate_lots(capital: float, w: np.ndarray, lot_prices: np.ndarray, max_stocks: int | float) -> np.ndarray:
+    """
+    Allocate integer number of lots to follow target weights w (sum(w) <= 1 is the share of capital in stocks)
+    1. Select stocks that get at least one lot (at most max_stocks), renormalize their weights
+    2. Round lots down
+    3. Spend the rest of capital * sum(w) on lots that reduce tracking error sum((value - target)^2) the most
+    Return number of lots for each stock
+    """
+    w = np.asarray(w, dtype=np.float64)
+    lot_prices = np.asarray(lot_prices, dtype=np.float64)
+    n_lots = np.zeros(len(w), dtype=np.int64)
+    selected = _select_stocks(capital, w, lot_prices, max_stocks)
+    if len(selected) == 0:
+        return n_lots
+
+    # Target value of each selected stock
+    target = capital * w[selected] / w[selected].sum() * w.sum()
+    prices = lot_prices[selected]
+    lots = np.floor(target / prices).astype(np.int64)
+    remaining = capital * w.sum() - (lots * prices).sum()
+
+    # Adding a lot with price p to a stock with deficit d changes the error by p^2 - 2 p d
+    deficit = target - lots * prices
+    heap = [(price * price - 2 * price * d, i) for i, (price, d) in enumerate(zip(prices, deficit))]
+    heapq.heapify(heap)
+    while heap:
+        gain, i = heapq.heappop(heap)
+        if gain >= 0:
+            break
+        if prices[i] > remaining:
+            continue  # remaining capital only decreases
+        lots[i] += 1
+        remaining -= prices[i]
+        deficit[i] -= prices[i]
+        heapq.heappush(heap, (prices[i] * prices[i] - 2 * prices[i] * deficit[i], i))
+
+    n_lots[selected] = lots
+    return n_lots
+
+
+def _select_stocks_batch(capitals: np.ndarray, w: np.ndarray, lot_prices: np.ndarray, max_stocks: int | float) -> list[np.ndarray]:
+    """
+    _select_stocks for many capitals at once (the same operations row by row)
+    """
+    support = np.flatnonzero(w > 0)
+    if len(support) == 0:
+        return [support] * len(capitals)
+    lots = capitals.reshape(-1, 1) * w[support] / lot_prices[support]
+    order = support[np.argsort(-lots, axis=1, kind='stable')]
+    min_lots = np.sort(lots, axis=1)[:, ::-1] * w.sum() / np.cumsum(w[order], axis=1)
+    min_lots = min_lots[:, :int(min(max_stocks, min_lots.shape[1]))]
+    is_valid = min_lots >= 1
+    n_selected = np.where(is_valid.any(axis=1), min_lots.shape[1] - np.argmax(is_valid[:, ::-1], axis=1), 0)
+    return [np.sort(row[:n]) for row, n in zip(order, n_selected)]
+
+
+def allocate_lots_batch(capitals: np.ndarray, w: np.ndarray, lot_prices: np.ndarray, max_stocks: int | float) -> np.ndarray:
+    """
+    allocate_lots for many capitals with the same weights (gives exactly the same lots)
+    Capitals with the same selected stocks are processed together: each greedy step adds one lot for every capital
+    After rounding down the deficit of each stock is less than its price, so each stock gets at most one more lot
+    Return (n_capitals, n_stocks) number of lots
+    """
+    capitals = np.asarray(capitals, dtype=np.float64)
+    w = np.asarray(w, dtype=np.float64)
+    lot_prices = np.asarray(lot_prices, dtype=np.float64)
+    n_lots = np.zeros((len(capitals), len(w)), dtype=np.int64)
+    groups: dict[tuple, list[int]] = {}
+    for row, selected in enumerate(_select_stocks_batch(capitals, w, lot_prices, max_stocks)):
+        groups.setdefault(tuple(selected), []).append(row)
+
+    for selected, rows in groups.items():
+        if len(selected) == 0:
+            continue
+        selected, rows = np.array(selected), np.array(rows)
+        capital = capitals[rows].reshape(-1, 1)
+        target = capital * w[selected] / w[selected].sum() * w.sum()
+        prices = lot_prices[selected]
+        lots = np.floor(target / prices).astype(np.int64)
+        remaining = capital[:, 0] * w.sum() - (lots * prices).sum(axis=1)
+
+        # Greedy steps: the lot with the smallest error change (ties by index) among the lots that fit into the remaining capital
+        deficit = target - lots * prices
+        gain = prices * prices - 2 * prices * deficit
+        active = np.arange(len(rows))
+        while len(active):
+            candidates = np.where((gain[active] < 0) & (prices <= remaining[active].reshape(-1, 1)), gain[active], np.inf)
+            best = np.argmin(candidates, axis=1)
+            found = np.isfinite(candidates[np.arange(len(active)), best])
+            active, best = active[found], best[found]
+            lots[active, best] += 1
+            remaining[active] -= prices[best]
+            deficit[active, best] -= prices[best]
+            gain[active, best] = prices[best] * prices[best] - 2 * prices[best] * deficit[active, best]
+        n_lots[np.ix_(rows, selected)] = lots
+    return n_lots
+
+
+def _round_robin_pass(capital: float, prices: list[float], n_lots: np.ndarray) -> tuple[float, bool]:
+    """
+    One pass of round_robin_lots, return the remaining capital and whether any lot was bought
+    """
+    added = False
+    for i, price in enumerate(prices):
+        if capital >= price:
+            n_lots[i] += 1
+            capital -= price
+            added = True
+    return capital, added
+
+
+def round_robin_lots(capital: float, prices: np.ndarray) -> np.ndarray:
+    """
+    Number of lots bought in passes over prices: in each pass buy one lot of every instrument that fits into the remaining capital
+    The result is exactly the same as of the passes with the same floating point subtractions:
+    while capital stays in [2^e, 2^(e+1)), every subtraction rounds to multiples of ulp(2^e) and the rounding of ties
+    depends only on parity of capital / ulp, so after the first pass two passes always subtract the same amount
+    These pairs of passes are skipped at once: O(n_instruments) per power of 2 of capital
+    """
+    n_lots = np.zeros(len(prices), dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64).tolist()
+    capital = float(capital)
+    pass_cost = math.fsum(prices)
+
+    # Full passes far from zero: simulate three passes, skip pairs of passes while capital stays in the same power of 2
+    while 0 < pass_cost and 8 * pass_cost < capital:
+        capital, _ = _round_robin_pass(capital, prices, n_lots)
+        start = capital
+        for _ in range(2):
+            capital, _ = _round_robin_pass(capital, prices, n_lots)
+        bottom = 2.0 ** (math.frexp(start)[1] - 1)
+        if capital < bottom:
+            continue  # crossed a power of 2
+        step = start - capital  # exact: both are multiples of ulp(bottom)
+        n_steps = int((capital - max(bottom, 8 * pass_cost)) // step) - 1
+        if n_steps > 0:
+            capital -= n_steps * step
+            n_lots += 2 * n_steps
+
+    # Remaining passes
+    added = True
+    while added:
+        capital, added = _round_robin_pass(capital, prices, n_lots)
+    return n_lots
+
+
+def _round_robin_lots_loop(capital: float, prices: np.ndarray) -> np.ndarray:
+    """
+    Reference: passes one lot at a time
+    """
+    n_lots = np.zeros(len(prices), dtype=np.int64)
+    added = True
+    while added:
+        added = False
+        for i, price in enumerate(prices.tolist()):
+            if capital >= price:
+                n_lots[i] += 1
+                capital -= price
+                added = True
+    return n_lots
+
+
+def _test_round_robin_lots():
+    """
+    Compare with the simulation of all passes (random and exact ties) and check that large capitals cost the same as small ones
+    """
+    rng = np.random.default_rng(0)
+    for _ in range(1000):
+        prices = np.round(rng.uniform(100, 1500, rng.integers(1, 10)), 2)
+        capital = float(np.round(rng.uniform(0, 50 * prices.sum()), 2))
+        assert np.array_equal(round_robin_lots(capital, prices), _round_robin_lots_loop(capital, prices)), (capital, prices)
+
+    # Capital is a multiple of the pass cost (plus a few prices): the last comparisons are exact ties in decimals
+    cases = [(392.32, np.array([1.28, 2.48])), (865.8, np.array([2.75, 0.13, 1.59, 1.38]))]
+    for _ in range(3000):
+        prices = np.round(rng.uniform(0.01, 5, rng.integers(1, 6)), 2)
+        n_prices = int(rng.integers(0, len(prices) + 1))
+        capital = round(float(rng.integers(1, 5000) * prices.sum() + prices[:n_prices].sum()), 2)
+        cases.append((capital, prices))
+    for capital, prices in cases:
+        assert np.array_equal(round_robin_lots(capital, prices), _round_robin_lots_loop(capital, prices)), (capital, prices)
+
+    prices = np.array([1000.5, 998.25, 1003.75])
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    n_lots = round_robin_lots(1e13, prices)
+    elapsed = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert 0 <= 1e13 - n_lots @ prices < prices.max() * len(prices)
+    assert elapsed < 0.1, elapsed
+    assert peak_memory < 1e5, peak_memory
+    print(f'round_robin_lots: {len(cases) + 1000} cases match, capital=1e13 in {elapsed * 1000:.2f} ms, peak memory {peak_memory / 1e3:.1f} KB')
+
+
+def _test_allocate_lots_batch():
+    """
+    Compare allocate_lots_batch with allocate_lots for random weights and capitals
+    """
+    rng = np.random.default_rng(0)
+    n_cases = 0
+    for _ in range(100):
+        n_stocks = int(rng.integers(1, 40))
+        w = rng.dirichlet(np.ones(n_stocks)) * rng.uniform(0.3, 1)
+        w[rng.random(n_stocks) < 0.3] = 0
+        lot_prices = np.round(np.exp(rng.uniform(np.log(10), np.log(1e5), n_stocks)), 2)
+        max_stocks = rng.choice([1, 5, 10, np.inf])
+        capitals = np.round(np.exp(rng.uniform(np.log(1e3), np.log(1e8), 60)), 2)
+        n_lots = allocate_lots_batch(capitals, w, lot_prices, max_stocks)
+        for capital, lots in zip(capitals, n_lots):
+            assert np.array_equal(lots, allocate_lots(capital, w, lot_prices, max_stocks)), (capital, w, lot_prices, max_stocks)
+            n_cases += 1
+    print(f'allocate_lots_batch: {n_cases} cases match allocate_lots')
+
+
+if __name__ == '__main__':
+    _test_round_robin_lots()
+    _test_allocate_lots_batch()
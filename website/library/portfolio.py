@@ -6,18 +6,32 @@ if __name__ == '__main__':
 
 import numpy as np
 import pandas as pd
+import copy
+import dataclasses
 import datetime
+import hashlib
+import json
+import os
+import threading
+import time
 import typing as tp
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from pathlib import Path
 
-import tinkoff.invest as inv
 from research import load_data, ClosePricesStatistics
-from research.library.markowitz import get_markowitz_w
-from download_data import download_shares_info, download_bonds_info, quotation_to_float
+from research.library.load import MIN_OBSERVATIONS, open_store
+from research.library.markowitz import MarkowitzSolver
+from download_data.moex import MOEX_STORE_DIRECTORY
+from download_data.tinkoff import TINKOFF_DATA_DIRECTORY
+from download_data import TinkoffSession, ShareInfo, BondsTable, LastPricesTable, download_shares_info, download_bonds_info, download_last_prices
+from website.library.ytm import BondsCashFlows, get_ytm_pct
+from website.library.lots import allocate_lots, allocate_lots_batch, round_robin_lots
+from website.library.backtest import BacktestReturns, BACKTEST_YEARS
+from website.library.snapshot import write_snapshot, read_snapshot, current_snapshot_version, snapshot_exists
 
 
 ###################################################################################
-# Form risk values
+# Form values
 ###################################################################################
 
 RISK_VALUES = [
@@ -26,9 +40,83 @@ RISK_VALUES = [
     {'value': 'low', 'label': 'Не готов терпеть риски, согласен на скромную доходность'}
 ]
 
+TIME_VALUES = [
+    {'value': 'month_1', 'label': '1 месяц'},
+    {'value': 'month_6', 'label': '6 месяцев'},
+    {'value': 'year_1', 'label': '1 год'},
+    {'value': 'year_2', 'label': '2 года'},
+    {'value': 'year_3', 'label': '3 года'},
+    {'value': 'year_more', 'label': 'больше 3 лет'},
+]
+
+MAX_INSTRUMENTS_VALUES = [
+    {'value': '5', 'label': 'Не более 5'},
+    {'value': '10', 'label': 'Не более 10'},
+    {'value': '20', 'label': 'Не более 20'},
+    {'value': '-1', 'label': 'Мне не важно'},
+]
+
+BONDS_OR_SHARES_VALUES = [
+    {'value': 'both', 'label': 'И акции, и облигации'},
+    {'value': 'shares', 'label': 'Только акции'},
+    {'value': 'bonds', 'label': 'Только облигации'},
+]
+
 MAX_TIME_ANSWER = datetime.timedelta(days=3 * 365)
 
 
+def parse_time_answer(time_answer: str) -> datetime.timedelta | None:
+    if time_answer.startswith('month_'):
+        months = int(time_answer.removeprefix('month_'))
+        return datetime.timedelta(days=30 * months)
+    elif time_answer.startswith('year_'):
+        if time_answer == 'year_more':
+            return None
+        years = int(time_answer.removeprefix('year_'))
+        return datetime.timedelta(days=365 * years)
+    else:
+        assert False, 'Unreachable'
+
+
+def parse_max_instruments_answer(max_instruments_answer: str) -> int | None:
+    max_instruments = int(max_instruments_answer)
+    return None if max_instruments == -1 else max_instruments
+
+
+###################################################################################
+# Markowitz optimization parameters
+###################################################################################
+
+MU_PCT_BY_RISK = {
+    'high': 30.0,
+    'medium': 15.0,
+    'low': 7.5
+}
+BOND_RATE_BOUNDS_BY_RISK = {
+    'high': [11, 15],
+    'medium': [9, 11],
+    'low': [8, 9]
+}
+BOND_MEAN_RATE_BY_RISK = {
+    'high': 13,
+    'medium': 10,
+    'low': 8.5
+}
+BOND_STD_BY_RISK = {
+    'high': 2.0,
+    'medium': 1.0,
+    'low': 0.5
+}
+BOND_SHARE_CORR = 0.1
+
+# Covariance estimator of shares returns (see research.library.load.COVARIANCE_ESTIMATORS)
+COVARIANCE_ESTIMATOR = 'sample'
+N_FACTORS = 10  # number of factors for COVARIANCE_ESTIMATOR = 'factor'
+
+# Grid of mu to precompute efficient frontier on data load
+FRONTIER_MU_PCT = np.arange(5.0, 30.0 + 1e-9, 2.5)
+
+
 ###################################################################################
 # tinkoff API sectors
 ###################################################################################
@@ -59,94 +147,107 @@ SECTOR_TRANSLATION = {
 class BondInfo:
     """
     Container to store bond information
+    Yields are set for all bonds at once with create_bonds_info()
     """
-    RATE_LOWER_BOUND_PCT = -10
-    RATE_UPPER_BOUND_PCT = 10000
-    RATE_EPS_PCT = 0.001  # 0.001%
-
-    TAX_RATE_PCT = 13
 
-    def __init__(self, bond: inv.Bond, coupons: list[inv.Coupon], last_price: inv.LastPrice) -> None:
+    def __init__(self, bonds: BondsTable, i: int, price_pct: float, now: np.datetime64) -> None:
         # Extract (maturity date) and (acquired coupon interest)
-        self.maturity_date = bond.maturity_date.date()
-        self.aci_value = quotation_to_float(bond.aci_value)
+        self.maturity_date: datetime.date = bonds.maturity_date[i].astype('datetime64[D]').item()
+        self.aci_value = float(bonds.aci_value[i])
 
         # Filter only futures coupons
-        coupons = list(filter(lambda coupon: coupon.coupon_date >= datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc), coupons))
+        coupon_dates, coupon_pays = bonds.coupons(i)
+        future = coupon_dates >= now
         # Extract coupon pays and dates from coupons
-        self.coupon_pays = [quotation_to_float(coupon.pay_one_bond) for coupon in coupons]
-        self.coupon_dates = [coupon.coupon_date.date() for coupon in coupons]
+        self.coupon_pays: list[float] = coupon_pays[future].tolist()
+        self.coupon_dates: list[datetime.date] = coupon_dates[future].astype('datetime64[D]').tolist()
 
         # Extract nominal and price
-        self.nominal = quotation_to_float(bond.nominal)
-        self.price = quotation_to_float(last_price.price) * self.nominal / 100
+        self.nominal = float(bonds.nominal[i])
+        self.price = float(price_pct) * self.nominal / 100
+
+        # Yield to maturity (real ytm is ytm with taxes)
+        self.ytm_pct: float = None
+        self.real_ytm_pct: float = None
+        self.real_ytm_pct_str: str = None
+
+        # Information about company's name, ticker and sector
+        self.figi = str(bonds.figi[i])
+        self.name = str(bonds.name[i])
+        self.ticker = str(bonds.ticker[i])
+        self.sector = str(bonds.sector[i])
 
-        # Calculate ytm (real ytm is ytm with taxes)
-        self.ytm_pct = self._get_ytm_pct(self._raw_present_value, self.price)
-        self.real_ytm_pct = self._get_ytm_pct(self._real_present_value, self.price)
+    def set_ytm(self, ytm_pct: float, real_ytm_pct: float):
+        self.ytm_pct = float(ytm_pct)
+        self.real_ytm_pct = float(real_ytm_pct)
 
         # String for formatting rate
         self.real_ytm_pct_str = f'{self.real_ytm_pct:.1f}%'
 
-        # Information about company's name, ticker and sector
-        self.name = bond.name
-        self.ticker = bond.ticker
-        self.sector = bond.sector
 
-    @staticmethod
-    def _year_diff(date: datetime.date) -> float:
-        """
-        Return distance between date and now in years
-        """
-        days = (date - datetime.datetime.utcnow().date()).days
-        assert days >= 0, days
-        return days / 365
+def _pack_bonds_cash_flows(infos: list[BondInfo], today: datetime.date) -> BondsCashFlows:
+    return BondsCashFlows.pack(
+        nominals=[info.nominal for info in infos],
+        aci_values=[info.aci_value for info in infos],
+        maturity_dates=[info.maturity_date for info in infos],
+        coupon_dates=[info.coupon_dates for info in infos],
+        coupon_pays=[info.coupon_pays for info in infos],
+        today=today
+    )
+
+
+def _set_bonds_ytm(infos: list[BondInfo], cash_flows: BondsCashFlows) -> tuple[list[BondInfo], BondsCashFlows]:
+    """
+    Solve yields of all bonds at once
+    Return bonds and their cash flows sorted by real_ytm (descending)
+    """
+    ytm_pct, real_ytm_pct = get_ytm_pct(cash_flows, [info.price for info in infos])
+    for info, ytm, real_ytm in zip(infos, ytm_pct, real_ytm_pct):
+        info.set_ytm(ytm, real_ytm)
+    order = np.argsort(-real_ytm_pct, kind='stable')
+    return [infos[i] for i in order], cash_flows.take(order)
+
+
+def create_bonds_info(bonds: BondsTable, bonds_last_prices: LastPricesTable) -> tuple[list[BondInfo], BondsCashFlows]:
+    """
+    Create BondInfo for bonds that are not matured and have last price, solve their yields together
+    Time reference is fixed once for all bonds
+    Return bonds and their cash flows sorted by real_ytm (descending)
+    """
+    now = np.datetime64(datetime.datetime.utcnow(), 'us')
+    prices_pct = bonds_last_prices.align(bonds.figi)
+    indices = np.flatnonzero((bonds.maturity_date >= now) & np.isfinite(prices_pct))
+    infos = [BondInfo(bonds, i, prices_pct[i], now) for i in indices]
+    return _set_bonds_ytm(infos, _pack_bonds_cash_flows(infos, today=now.astype('datetime64[D]').item()))
 
-    @classmethod
-    def _get_ytm_pct(cls, present_value_func: tp.Callable[[float], float], price: float):
-        """
-        Return yield to maturity
-        Perform binary search to find [present_value(rate_pct) == cls.price]
-        """
-        # Start conditions
-        lower = cls.RATE_LOWER_BOUND_PCT
-        upper = cls.RATE_UPPER_BOUND_PCT
-
-        # Binary search
-        while upper - lower >= cls.RATE_EPS_PCT:
-            middle = (lower + upper) / 2
-            if present_value_func(middle) > float(price):
-                lower = middle
-            else:
-                upper = middle
-
-        # Return middle value
-        return (lower + upper) / 2
-
-    def _raw_present_value(self, rate_pct: float) -> float:
-        """
-        D(nominal) - aci + D(coupons)
-        """
-        value = self._discount(self.nominal, self.maturity_date, rate_pct) - self.aci_value
-        for coupon_day, coupon_pay in zip(self.coupon_dates, self.coupon_pays):
-            value += self._discount(coupon_pay, coupon_day, rate_pct)
-        return value
 
-    def _real_present_value(self, rate_pct: float) -> float:
+class BondsIndex:
+    """
+    Indexes over bonds (positions in Dataset.bonds) for fast selection
+    Bonds are sorted by real YTM, YTM bands are bucketed and sorted by maturity date
+    """
+
+    def __init__(self, bonds: list[BondInfo], rate_bounds: tp.Iterable[tuple[float, float]] = ()):
+        self.maturity = np.array([bond.maturity_date.toordinal() for bond in bonds], dtype=np.int64)
+        real_ytm_pct = np.array([bond.real_ytm_pct for bond in bonds], dtype=np.float64)
+        self.order_by_real_ytm = np.argsort(real_ytm_pct, kind='stable')
+        self.sorted_real_ytm_pct = real_ytm_pct[self.order_by_real_ytm]
+        self._band_by_rate_bounds: dict[tuple[float, float], tuple[np.ndarray, np.ndarray]] = {}
+        for lower_rate_pct, upper_rate_pct in rate_bounds:
+            self.band(lower_rate_pct, upper_rate_pct)
+
+    def band(self, lower_rate_pct: float, upper_rate_pct: float) -> tuple[np.ndarray, np.ndarray]:
         """
-        D(nominal) - aci + (1 - tax) * D(coupons) - tax * D(max(0, nominal - price - aci))
+        Return (positions, maturities) of bonds with real YTM in [lower_rate_pct, upper_rate_pct] sorted by maturity (then by position)
         """
-        tax_rate = self.TAX_RATE_PCT / 100
-        value = -self.aci_value
-        for coupon_day, coupon_pay in zip(self.coupon_dates, self.coupon_pays):
-            value += (1 - tax_rate) * self._discount(coupon_pay, coupon_day, rate_pct)
-        value += self._discount(self.nominal, self.maturity_date, rate_pct) - self._discount(tax_rate * max(0.0, float(self.nominal - self.price - self.aci_value)), self.maturity_date, rate_pct)
-        return value
-
-    @classmethod
-    def _discount(cls, payment: float, date: datetime.date, rate_pct: float) -> float:
-        discount_factor = 1 / (1 + rate_pct / 100)
-        return payment * discount_factor ** cls._year_diff(date)
+        key = (lower_rate_pct, upper_rate_pct)
+        if key not in self._band_by_rate_bounds:
+            start = np.searchsorted(self.sorted_real_ytm_pct, lower_rate_pct, side='left')
+            end = np.searchsorted(self.sorted_real_ytm_pct, upper_rate_pct, side='right')
+            positions = np.sort(self.order_by_real_ytm[start:end])
+            positions = positions[np.argsort(self.maturity[positions], kind='stable')]
+            self._band_by_rate_bounds[key] = (positions, self.maturity[positions])
+        return self._band_by_rate_bounds[key]
 
 
 @dataclass
@@ -181,10 +282,10 @@ class Bond:
 class Stock:
     # init params
     number: int
-    info: inv.Share
+    info: ShareInfo
+    price: float
 
     # post init params
-    price: float = None
     invested_capital: float = None
     sector: str = None
     ratio: float = None  # is filled inside the Portfolio class
@@ -196,7 +297,6 @@ class Stock:
 
     def __post_init__(self):
         assert self.number % self.info.lot == 0
-        self.price = DataRAM.stat.last_prices[self.info.ticker]
         self.invested_capital = self.number * self.price
         self.sector = SECTOR_TRANSLATION.get(self.info.sector)
         if self.sector is None:
@@ -251,122 +351,347 @@ class Portfolio:
 # Data container for storing it in RAM
 ###################################################################################
 
+@dataclass(frozen=True)
+class Dataset:
+    """
+    Immutable data to construct portfolios
+    A new dataset is built off to the side and published with one reference swap (DataRAM.dataset)
+    """
+    version: str  # unique version of the data (timestamp)
+    created_at: datetime.datetime
+    stat: ClosePricesStatistics  # shares statistics to do markowitz optimization
+    share_by_ticker: dict[str, ShareInfo]  # shares info
+    bonds: list[BondInfo]  # bonds info sorted by real_ytm
+    bonds_cash_flows: BondsCashFlows = None  # cash flows of bonds (in the same order)
+    backtest: BacktestReturns = None  # aligned daily returns of shares for backtest charts
+    answers: dict[tuple, 'PrecomputedAnswer'] = field(default_factory=dict)  # precomputed answers for each combination of form answers
+    solver_by_include_bonds: dict[bool, MarkowitzSolver] = field(default_factory=dict)  # markowitz solvers (built on demand, not stored in snapshot)
+    bonds_index: BondsIndex = field(init=False, repr=False)  # indexes over bonds (built from bonds)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'bonds_index', BondsIndex(self.bonds, rate_bounds=BOND_RATE_BOUNDS_BY_RISK.values()))
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['solver_by_include_bonds'] = {}
+        return state
+
+    def __setstate__(self, state: dict):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+
 class DataRAM:
-    stat: ClosePricesStatistics = None  # shares statistics to do markowitz optimization
-    share_by_ticker: dict[str, inv.Share] = None  # shares info
-    bonds: list[BondInfo] = None  # bonds info sorted by real_ytm
+    dataset: Dataset = None  # current dataset (requests take the reference once and use it until the end)
+    update_lock = threading.Lock()  # lock to publish new dataset
+    solvers_lock = threading.Lock()  # lock to build markowitz solvers of datasets once (server threads share datasets)
+    last_snapshot_check: float = 0.0  # time of the last check for a new snapshot
 
 
-async def load_data_to_ram():
-    # Load shares info
-    shares = await download_shares_info(force_update=False)
-    DataRAM.share_by_ticker = {share.ticker: share for share in shares}
+###################################################################################
+# Cache of computed datasets
+###################################################################################
+
+DATASET_CACHE_DIRECTORY = Path('data/dataset_cache')
+DATASET_CONFIG_VERSION = 2  # increment when the computation of the dataset changes
+DATASET_INPUT_DIRECTORIES = [MOEX_STORE_DIRECTORY] + [TINKOFF_DATA_DIRECTORY / name for name in ['shares', 'bonds', 'bonds_last_prices']]
+
+
+def _dataset_inputs_key() -> str | None:
+    """
+    Hash of the input files content (except write times in metadata), config and the current date (yields depend on it)
+    Return None if some inputs are missing
+    """
+    config = (DATASET_CONFIG_VERSION, MIN_OBSERVATIONS, MU_PCT_BY_RISK, BOND_RATE_BOUNDS_BY_RISK, BOND_MEAN_RATE_BY_RISK, BOND_STD_BY_RISK,
+              BOND_SHARE_CORR, COVARIANCE_ESTIMATOR, N_FACTORS, FRONTIER_MU_PCT.tolist(), BACKTEST_YEARS, datetime.datetime.utcnow().date())
+    inputs_hash = hashlib.blake2b(repr(config).encode(), digest_size=16)
+    for directory in DATASET_INPUT_DIRECTORIES:
+        if not directory.is_dir():
+            return None
+        for path in sorted(directory.iterdir()):
+            if path.suffix not in ['.npy', '.json']:
+                continue
+            inputs_hash.update(f'{directory.name}/{path.name}'.encode())
+            if path.suffix == '.json':
+                # Metadata without the write time (rewriting equal data must not change the key)
+                with open(path) as f:
+                    meta = {key: value for key, value in json.load(f).items() if key != 'created_at'}
+                inputs_hash.update(json.dumps(meta, sort_keys=True).encode())
+                continue
+            with open(path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    inputs_hash.update(chunk)
+    return inputs_hash.hexdigest()
+
+
+def get_dataset() -> Dataset:
+    """
+    Return the current dataset (take it once per request)
+    """
+    return DataRAM.dataset
+
+
+def _new_dataset_version() -> str:
+    return datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+
+
+async def build_dataset() -> Dataset:
+    """
+    Load all data into a new dataset without touching the current one
+    """
+    async with TinkoffSession() as session:
+        # Load shares info
+        shares = await download_shares_info(force_update=False, session=session)
+        share_by_ticker = shares.by_ticker()
+
+        # Load bonds info
+        bonds, bonds_last_prices = await download_bonds_info(force_update=False, session=session)
+
+    # Take computed dataset from cache if inputs did not change
+    open_store()
+    inputs_key = _dataset_inputs_key()
+    if inputs_key is not None and snapshot_exists(inputs_key, directory=DATASET_CACHE_DIRECTORY):
+        dataset = read_snapshot(inputs_key, directory=DATASET_CACHE_DIRECTORY)
+        print(f'Dataset is loaded from cache {inputs_key}')
+        return dataclasses.replace(dataset, version=_new_dataset_version())
 
     # Load close prices
-    DataRAM.stat = load_data(verbose=False, tickers_subset=list(DataRAM.share_by_ticker.keys()))
+    stat = load_data(verbose=False, tickers_subset=list(share_by_ticker.keys()), covariance_estimator=COVARIANCE_ESTIMATOR, n_factors=N_FACTORS)
+
+    bonds, bonds_cash_flows = create_bonds_info(bonds, bonds_last_prices)
+
+    dataset = Dataset(version=_new_dataset_version(), created_at=datetime.datetime.utcnow(), stat=stat, share_by_ticker=share_by_ticker, bonds=bonds, bonds_cash_flows=bonds_cash_flows,
+                      backtest=BacktestReturns.from_close_prices(stat.df_close))
+
+    # Build markowitz solvers and precompute efficient frontiers for each risk
+    for include_bonds in [True, False]:
+        for risk in MU_PCT_BY_RISK:
+            _get_solver(dataset, include_bonds).precompute_frontier(FRONTIER_MU_PCT, bond_year_return_pct=BOND_MEAN_RATE_BY_RISK[risk], bond_year_return_std_pct=BOND_STD_BY_RISK[risk])
+
+    # Precompute optimization results and bond candidates for every combination of form answers
+    dataset.answers.update(_precompute_answers(dataset))
+
+    # Save computed dataset
+    if inputs_key is not None:
+        write_snapshot(dataset, version=inputs_key, directory=DATASET_CACHE_DIRECTORY)
+    return dataset
+
+
+async def load_data_to_ram():
+    """
+    Build new dataset and publish it atomically
+    """
+    dataset = await build_dataset()
+    with DataRAM.update_lock:
+        DataRAM.dataset = dataset
+    print(f'Dataset {dataset.version} is loaded to RAM')
+
 
-    # Load bonds info
-    bonds, bonds_coupons, bonds_last_prices = await download_bonds_info(force_update=False)
-    now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-    DataRAM.bonds = [BondInfo(bond, coupons, last_price) for bond, coupons, last_price in zip(bonds, bonds_coupons, bonds_last_prices) if bond.maturity_date >= now]
-    DataRAM.bonds.sort(key=lambda bond: bond.real_ytm_pct, reverse=True)
+def update_bonds_prices(dataset: Dataset, last_prices: LastPricesTable) -> Dataset:
+    """
+    Return new dataset with new bond prices
+    Only prices, yields, order of bonds and answers are recomputed (bonds without a new price keep the old one)
+    """
+    infos = [copy.copy(info) for info in dataset.bonds]
+    cash_flows = dataset.bonds_cash_flows
+    today = datetime.datetime.utcnow().date()
+    if cash_flows.today != today:
+        # Times of cash flows are relative to the day of packing: drop past payments and pack again
+        infos = [info for info in infos if info.maturity_date >= today]
+        for info in infos:
+            future = [i for i, date in enumerate(info.coupon_dates) if date >= today]
+            info.coupon_dates = [info.coupon_dates[i] for i in future]
+            info.coupon_pays = [info.coupon_pays[i] for i in future]
+        cash_flows = _pack_bonds_cash_flows(infos, today=today)
+
+    # Set new prices
+    prices_pct = last_prices.align(np.array([info.figi for info in infos], dtype=str))
+    for info, price_pct in zip(infos, prices_pct):
+        if np.isfinite(price_pct):
+            info.price = float(price_pct) * info.nominal / 100
+    bonds, bonds_cash_flows = _set_bonds_ytm(infos, cash_flows)
+
+    # Shares data and markowitz solvers are reused
+    new_dataset = dataclasses.replace(dataset, version=_new_dataset_version(), bonds=bonds, bonds_cash_flows=bonds_cash_flows, answers={})
+    new_dataset.answers.update(_precompute_answers(new_dataset))
+    return new_dataset
+
+
+async def refresh_bonds_prices() -> bool:
+    """
+    Download last prices of bonds and publish dataset with new prices
+    Return whether the dataset was updated (it is not if another dataset was published meanwhile)
+    """
+    dataset = DataRAM.dataset
+    if dataset is None or not dataset.bonds:
+        return False
+    last_prices = await download_last_prices([info.figi for info in dataset.bonds])
+    new_dataset = update_bonds_prices(dataset, last_prices)
+    with DataRAM.update_lock:
+        if DataRAM.dataset is not dataset:
+            print('Dataset was replaced during bonds prices refresh')
+            return False
+        DataRAM.dataset = new_dataset
+    print(f'Dataset {new_dataset.version} with new bonds prices is loaded to RAM')
+    return True
+
+
+###################################################################################
+# Snapshots of the data shared between server processes
+###################################################################################
+
+SNAPSHOT_CHECK_INTERVAL_SECONDS = 5
+
+
+def save_data_ram_snapshot() -> str:
+    """
+    Publish the current dataset as a read-only snapshot (solvers are rebuilt by each process on demand)
+    """
+    version = write_snapshot(DataRAM.dataset, version=DataRAM.dataset.version)
+    print(f'Data snapshot {version} is published')
+    return version
+
+
+def load_data_ram_snapshot(force_check: bool = False) -> bool:
+    """
+    Switch DataRAM to the last published snapshot if it is new
+    Checks the snapshot pointer at most once in SNAPSHOT_CHECK_INTERVAL_SECONDS
+    Return whether the data was switched
+    """
+    if not force_check and time.time() - DataRAM.last_snapshot_check < SNAPSHOT_CHECK_INTERVAL_SECONDS:
+        return False
+    DataRAM.last_snapshot_check = time.time()
+    version = current_snapshot_version()
+    if version is None or (DataRAM.dataset is not None and version == DataRAM.dataset.version):
+        return False
+    DataRAM.dataset = read_snapshot(version)
+    print(f'Process {os.getpid()}: switched to data snapshot {version}')
+    return True
+
+
+def _get_solver(dataset: Dataset, include_bonds: bool) -> MarkowitzSolver:
+    """
+    Return markowitz solver for the dataset (build it on the first call)
+    The problem is canonicalized once: concurrent first calls wait for the same solver
+    """
+    solvers = dataset.solver_by_include_bonds
+    solver = solvers.get(include_bonds)
+    if solver is None:
+        with DataRAM.solvers_lock:
+            solver = solvers.get(include_bonds)
+            if solver is None:
+                solver = MarkowitzSolver(dataset.stat, include_bonds=include_bonds, bond_share_corr=BOND_SHARE_CORR)
+                solvers[include_bonds] = solver
+    return solver
 
 
 ###################################################################################
 # Portfolio construction
 ###################################################################################
 
-def _create_stocks_portfolio(total_capital: float, w: pd.Series, max_stocks: int | float) -> list[Stock]:
+def allocate_capital(total_capital: float, w_shares: np.ndarray, prices: np.ndarray, lot_sizes: np.ndarray, max_stocks: int | float) -> tuple[np.ndarray, float]:
     """
-    Create stocks portfolio from results of markowitz optimization
-    Include top max_stocks into portfolio
-    Important: total_capital is capital in both stocks and bonds (remove w['bond'] weight to obtain stocks capital)
+    Split capital between shares and bonds (used by the website and the walk-forward backtest)
+    Shares take at most total_capital * sum(w_shares) = total_capital * (1 - w_bond) rounded down to lots,
+    the rest (total_capital * w_bond and the lot-rounding remainder of shares) is capital in bonds (or money without bonds)
+    Return (number of lots of each share, capital not invested in shares)
+    """
+    n_lots = allocate_lots(total_capital, w_shares, prices * lot_sizes, max_stocks)
+    return n_lots, total_capital - _invested_in_shares(n_lots, prices, lot_sizes)
+
+
+def _invested_in_shares(n_lots: np.ndarray, prices: np.ndarray, lot_sizes: np.ndarray) -> float:
+    return float((n_lots * lot_sizes * prices).sum())
+
+
+def _shares_weights(w: pd.Series) -> pd.Series:
+    """
+    Remove bond weight (capital in stocks is w.sum())
     """
     if w.index[0] == 'bond':
         w = w.iloc[1:]
         assert 'bond' not in w.index
-        w = w.values
-    w_sum = w.sum()
-    prices = DataRAM.stat.last_prices.values
-    tickers = np.array(DataRAM.stat.tickers)
-    lot_size = pd.Series([DataRAM.share_by_ticker[ticker].lot for ticker in tickers], index=tickers)
-
-    # Remove stocks from (w, prices, lot_size) until all stocks are taken into portfolio
-    while True:
-        # Calculate number of lots to buy
-        lots = total_capital * w / prices / lot_size
-        # Floor number of lots
-        numbers = np.floor(lots) * lot_size
-        # Check that all stocks are taken
-        n_taken = (numbers > 0).sum()
-        if n_taken == len(numbers) and len(w) <= max_stocks:
-            break
-        # Drop stock with the minimum number of lots
-        drop_ind = np.argmin(lots)
-        w = np.delete(w, drop_ind)
-        prices = np.delete(prices, drop_ind)
-        tickers = np.delete(tickers, drop_ind)
-        lot_size = np.delete(lot_size, drop_ind)
-        # Normalize weights
-        w = w / w.sum() * w_sum
-
-    # Construct Stocks
-    stocks = [Stock(number=int(number), info=DataRAM.share_by_ticker[ticker]) for number, ticker in zip(numbers, tickers)]
-    # Sort by sector
+    return w
+
+
+def _shares_lot_prices(dataset: Dataset) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return (prices, lot sizes) of shares in the order of dataset.stat.tickers
+    """
+    prices = dataset.stat.last_prices.values
+    lot_sizes = np.array([dataset.share_by_ticker[ticker].lot for ticker in dataset.stat.tickers])
+    return prices, lot_sizes
+
+
+def _stocks_from_lots(dataset: Dataset, n_lots: np.ndarray, prices: np.ndarray, lot_sizes: np.ndarray) -> list[Stock]:
+    """
+    Construct Stocks sorted by sector from number of lots of each share (prices and lot_sizes are from _shares_lot_prices)
+    """
+    stocks = [Stock(number=int(n_lots[i] * lot_sizes[i]), info=dataset.share_by_ticker[dataset.stat.tickers[i]], price=prices[i]) for i in np.flatnonzero(n_lots)]
     return sorted(stocks, key=lambda stock: stock.sector)
 
 
-def _create_bonds_portfolio(capital_in_bonds: float, time_answer: datetime.timedelta | None, max_bonds: int | float, lower_rate_pct: float, upper_rate_pct: float) -> list[Bond]:
+def _select_bonds(dataset: Dataset, time_answer: datetime.timedelta | None, max_bonds: int | float, lower_rate_pct: float, upper_rate_pct: float) -> list[BondInfo]:
     """
-    Create bonds portfolio from bonds with real YTM in [lower_rate_pct, upper_rate_pct]
+    Select bonds with real YTM in [lower_rate_pct, upper_rate_pct] sorted by closeness to time_answer
+    Take bonds with YTM in the band from the index and find the maturity window with binary search
     """
     now = datetime.date.today()
-    # Filter bonds with YTM in [lower_rate_pct, upper_rate_pct]
+    # Bonds with YTM in [lower_rate_pct, upper_rate_pct] sorted by maturity date
+    positions, maturities = dataset.bonds_index.band(lower_rate_pct, upper_rate_pct)
+
+    # Only bonds that are traded now and match time_answer
     if time_answer is not None:
         MAX_TIME_DEVIATION = datetime.timedelta(days=2 * 30) if time_answer < datetime.timedelta(days=365) else datetime.timedelta(days=30 * 6)
-        expected_maturity_day = now + time_answer if time_answer is not None else None
+        expected_maturity_day = (now + time_answer).toordinal()
+        first_day = max(expected_maturity_day - MAX_TIME_DEVIATION.days, now.toordinal() + 1)
+        last_day = expected_maturity_day + MAX_TIME_DEVIATION.days
+    else:
+        first_day = max((now + MAX_TIME_ANSWER).toordinal(), now.toordinal() + 1)
+        last_day = np.iinfo(np.int64).max
+    start, end = np.searchsorted(maturities, first_day, side='left'), np.searchsorted(maturities, last_day, side='right')
+    positions, maturities = positions[start:end], maturities[start:end]
 
-    def filter_bond_condition(info: BondInfo) -> bool:
-        # Only bonds that are traded now
-        if info.maturity_date <= now:
-            return False
-        # YTM filter
-        if not (lower_rate_pct <= info.real_ytm_pct <= upper_rate_pct):
-            return False
-        # time_answer filter
-        if time_answer is not None:
-            if abs(info.maturity_date - expected_maturity_day) > MAX_TIME_DEVIATION:
-                return False
-        else:
-            if info.maturity_date < now + MAX_TIME_ANSWER:
-                return False
-        return True
-
-    # Filter bonds by YTM and time_answer
-    bonds = [bond for bond in DataRAM.bonds if filter_bond_condition(bond)]
-    # Sort bonds by time_answer
-    bonds.sort(key=lambda bond: abs(bond.maturity_date - expected_maturity_day) if time_answer else -(bond.maturity_date - now))
-    if max_bonds < len(bonds):
-        bonds = bonds[:max_bonds]  # do not take more than max_bonds
-
-    # How many bonds of each type to take
-    n_bonds_taken = [0] * len(bonds)
-    added_bond = True  # flag whether new bond was added to portfolio
-    while added_bond:
-        added_bond = False
-        for i, bond in enumerate(bonds):
-            dirty_price = bond.price + bond.aci_value
-            if capital_in_bonds >= dirty_price:
-                n_bonds_taken[i] += 1
-                capital_in_bonds -= dirty_price
-                added_bond = True
-
-    bonds = [Bond(number=number, info=bond) for number, bond in zip(n_bonds_taken, bonds) if number > 0]
+    # Sort bonds by time_answer (ties keep the order of dataset.bonds)
+    distance = np.abs(maturities - expected_maturity_day) if time_answer is not None else -maturities
+    positions = positions[np.lexsort((positions, distance))]
+    if max_bonds < len(positions):
+        positions = positions[:max_bonds]  # do not take more than max_bonds
+    return [dataset.bonds[i] for i in positions]
+
+
+def _create_bonds_portfolio(capital_in_bonds: float, bonds: list[BondInfo], bond_prices: np.ndarray | None = None) -> list[Bond]:
+    """
+    Create bonds portfolio from selected bonds
+    Bonds are bought one by one in round-robin order while capital allows
+    bond_prices: prices with aci of bonds (computed from bonds if not passed)
+    """
+    if bond_prices is None:
+        bond_prices = np.array([bond.price + bond.aci_value for bond in bonds])
+    n_bonds_taken = round_robin_lots(capital_in_bonds, bond_prices)
+    bonds = [Bond(number=int(number), info=bond) for number, bond in zip(n_bonds_taken, bonds) if number > 0]
     bonds.sort(key=lambda bond: bond.sector)
     return bonds
 
 
-def create_portfolio(total_capital: float, risk: str, max_instruments: int | None, time_answer: datetime.timedelta, bonds_or_shares_answer: str):
+@dataclass
+class PrecomputedAnswer:
+    """
+    Capital-independent part of the portfolio for one combination of form answers
+    """
+    w: pd.Series | None  # markowitz weights (None if shares are not included)
+    max_stocks: int | float
+    bonds: list[BondInfo] | None  # selected bonds (None if bonds are not included)
+
+
+def _answer_key(risk: str, max_instruments: int | None, time_answer: datetime.timedelta | None, bonds_or_shares_answer: str) -> tuple:
+    return risk, max_instruments, time_answer, bonds_or_shares_answer
+
+
+def _compute_answer(dataset: Dataset, risk: str, max_instruments: int | None, time_answer: datetime.timedelta | None, bonds_or_shares_answer: str) -> PrecomputedAnswer:
+    """
+    Do markowitz optimization and select bonds for given answers
+    """
     # Check parameters
     assert risk in ['high', 'medium', 'low'], 'Incorrect risk value'
     assert bonds_or_shares_answer in ['both', 'shares', 'bonds']
@@ -381,43 +706,57 @@ def create_portfolio(total_capital: float, risk: str, max_instruments: int | Non
             max_stocks = max_instruments
             max_bonds = max_instruments
 
-    # markowitz optimization parameters
-    MU_PCT_BY_RISK = {
-        'high': 30.0,
-        'medium': 15.0,
-        'low': 7.5
-    }
-    BOND_RATE_BOUNDS_BY_RISK = {
-        'high': [11, 15],
-        'medium': [9, 11],
-        'low': [8, 9]
-    }
-    BOND_MEAN_RATE_BY_RISK = {
-        'high': 13,
-        'medium': 10,
-        'low': 8.5
-    }
-    BOND_STD_BY_RISK = {
-        'high': 2.0,
-        'medium': 1.0,
-        'low': 0.5
-    }
-    BOND_SHARE_CORR = 0.1
-
+    w = None
     if bonds_or_shares_answer in ['both', 'shares']:
         # Find optimal portfolio
         include_bonds = True if bonds_or_shares_answer == 'both' else False
-        w = get_markowitz_w(DataRAM.stat, bond_year_return_pct=BOND_MEAN_RATE_BY_RISK[risk], bond_year_return_std_pct=BOND_STD_BY_RISK[risk], bond_share_corr=BOND_SHARE_CORR, mu_year_pct=MU_PCT_BY_RISK[risk], include_bonds=include_bonds)
-        # Create stocks portfolio from weights
-        stocks = _create_stocks_portfolio(total_capital, w, max_stocks)
+        w = _get_solver(dataset, include_bonds).solve(MU_PCT_BY_RISK[risk], bond_year_return_pct=BOND_MEAN_RATE_BY_RISK[risk], bond_year_return_std_pct=BOND_STD_BY_RISK[risk])
+
+    bonds = None
+    if bonds_or_shares_answer in ['both', 'bonds']:
+        lower_rate, upper_rate = BOND_RATE_BOUNDS_BY_RISK[risk]
+        bonds = _select_bonds(dataset, time_answer, max_bonds, lower_rate, upper_rate)
+
+    return PrecomputedAnswer(w=w, max_stocks=max_stocks, bonds=bonds)
+
+
+def _precompute_answers(dataset: Dataset) -> dict[tuple, PrecomputedAnswer]:
+    """
+    Compute answers for all combinations of form answers (only capital is not discrete)
+    """
+    answers = {}
+    for risk in RISK_VALUES:
+        for time_value in TIME_VALUES:
+            for max_instruments_value in MAX_INSTRUMENTS_VALUES:
+                for bonds_or_shares_value in BONDS_OR_SHARES_VALUES:
+                    key = _answer_key(risk['value'], parse_max_instruments_answer(max_instruments_value['value']), parse_time_answer(time_value['value']), bonds_or_shares_value['value'])
+                    answers[key] = _compute_answer(dataset, *key)
+    return answers
+
+
+def create_portfolio(total_capital: float, risk: str, max_instruments: int | None, time_answer: datetime.timedelta, bonds_or_shares_answer: str, dataset: Dataset | None = None):
+    # Use one dataset for the whole request
+    if dataset is None:
+        dataset = DataRAM.dataset
+
+    # Take precomputed answer (compute it if the answers are not from the form)
+    key = _answer_key(risk, max_instruments, time_answer, bonds_or_shares_answer)
+    answer = dataset.answers.get(key)
+    if answer is None:
+        answer = _compute_answer(dataset, *key)
+
+    # Create stocks portfolio from weights
+    capital_in_bonds = total_capital
+    if answer.w is not None:
+        prices, lot_sizes = _shares_lot_prices(dataset)
+        n_lots, capital_in_bonds = allocate_capital(total_capital, _shares_weights(answer.w).values, prices, lot_sizes, answer.max_stocks)
+        stocks = _stocks_from_lots(dataset, n_lots, prices, lot_sizes)
     else:
         stocks = []
 
     # Create bonds portfolio
-    if bonds_or_shares_answer in ['both', 'bonds']:
-        capital_in_bonds = total_capital - sum([stock.invested_capital for stock in stocks])
-        lower_rate, upper_rate = BOND_RATE_BOUNDS_BY_RISK[risk]
-        bonds = _create_bonds_portfolio(capital_in_bonds, time_answer, max_bonds, lower_rate, upper_rate)
+    if answer.bonds is not None:
+        bonds = _create_bonds_portfolio(capital_in_bonds, answer.bonds)
     else:
         bonds = []
 
@@ -425,6 +764,77 @@ def create_portfolio(total_capital: float, risk: str, max_instruments: int | Non
     return portfolio
 
 
+###################################################################################
+# Batch portfolio construction
+###################################################################################
+
+@dataclass(frozen=True)
+class PortfolioRequest:
+    """
+    Answers of one user
+    """
+    total_capital: float
+    risk: str
+    max_instruments: int | None
+    time_answer: datetime.timedelta | None
+    bonds_or_shares_answer: str
+
+
+def create_portfolios(requests: list[PortfolioRequest], dataset: Dataset | None = None) -> list[Portfolio]:
+    """
+    Construct portfolios for many users (the same portfolios as create_portfolio)
+    Requests with the same answers are grouped: the optimization problem and bonds selection are done once per group
+    (solutions are also cached by optimizer parameters) and lots of stocks are allocated for all capitals of the group at once
+    """
+    # Use one dataset for the whole batch
+    if dataset is None:
+        dataset = DataRAM.dataset
+
+    # Group requests by answers
+    rows_by_key: dict[tuple, list[int]] = {}
+    for row, portfolio_request in enumerate(requests):
+        key = _answer_key(portfolio_request.risk, portfolio_request.max_instruments, portfolio_request.time_answer, portfolio_request.bonds_or_shares_answer)
+        rows_by_key.setdefault(key, []).append(row)
+
+    portfolios: list[Portfolio | None] = [None] * len(requests)
+    prices, lot_sizes = _shares_lot_prices(dataset)
+    for key, rows in rows_by_key.items():
+        # Take precomputed answer (compute it if the answers are not from the form)
+        answer = dataset.answers.get(key)
+        if answer is None:
+            answer = _compute_answer(dataset, *key)
+        capitals = np.array([requests[row].total_capital for row in rows], dtype=np.float64)
+
+        # Allocate lots of stocks for all capitals at once
+        if answer.w is not None:
+            n_lots = allocate_lots_batch(capitals, _shares_weights(answer.w).values, prices * lot_sizes, answer.max_stocks)
+        if answer.bonds is not None:
+            bond_prices = np.array([bond.price + bond.aci_value for bond in answer.bonds])
+        for i, row in enumerate(rows):
+            stocks = _stocks_from_lots(dataset, n_lots[i], prices, lot_sizes) if answer.w is not None else []
+            bonds = []
+            if answer.bonds is not None:
+                capital_in_bonds = capitals[i] - _invested_in_shares(n_lots[i], prices, lot_sizes) if answer.w is not None else capitals[i]
+                bonds = _create_bonds_portfolio(capital_in_bonds, answer.bonds, bond_prices)
+            portfolios[row] = Portfolio(total_capital=requests[row].total_capital, stocks=stocks, bonds=bonds)
+    return portfolios
+
+
+def portfolio_to_dict(portfolio: Portfolio) -> dict:
+    """
+    JSON-serializable description of the portfolio
+    """
+    return {
+        'total_capital': portfolio.total_capital,
+        'money': portfolio.money,
+        'stocks': [{'ticker': stock.info.ticker, 'figi': stock.info.figi, 'name': stock.info.name, 'sector': stock.sector, 'number': stock.number,
+                    'price': float(stock.price), 'invested_capital': float(stock.invested_capital)} for stock in portfolio.stocks],
+        'bonds': [{'ticker': bond.info.ticker, 'figi': bond.info.figi, 'name': bond.info.name, 'sector': bond.sector, 'number': bond.number,
+                   'price': bond.price, 'invested_capital': bond.invested_capital, 'maturity_date': bond.info.maturity_date.isoformat(),
+                   'real_ytm_pct': bond.info.real_ytm_pct} for bond in portfolio.bonds]
+    }
+
+
 def _test_portfolio():
     """
     Function to test portfolio construction
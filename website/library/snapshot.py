@@ -0,0 +1,115 @@
+import datetime
+import mmap
+import os
+import pickle
+import shutil
+import typing as tp
+from pathlib import Path
+
+###################################################################################
+# Config
+###################################################################################
+
+SNAPSHOT_DIRECTORY = Path('data/snapshots')
+SNAPSHOT_POINTER_FILE = 'CURRENT'  # file with the version of the current snapshot
+SNAPSHOT_HISTORY_FILE = 'HISTORY'  # versions in the order of publishing (the last one is the newest)
+SNAPSHOT_INDEX_FILE = 'index.pickle'  # pickled object with out-of-band buffers replaced by references
+SNAPSHOT_BUFFERS_FILE = 'buffers.bin'  # concatenated out-of-band buffers (numpy arrays)
+N_SNAPSHOTS_TO_KEEP = 3
+BUFFER_ALIGNMENT = 64
+
+
+###################################################################################
+# Snapshots
+###################################################################################
+
+
+def _new_version() -> str:
+    return datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+
+
+def write_snapshot(obj: tp.Any, version: str | None = None, directory: Path = SNAPSHOT_DIRECTORY) -> str:
+    """
+    Write immutable versioned snapshot of obj and publish it as the current one
+    Large buffers (numpy arrays, pandas blocks) are stored out-of-band so readers can map them without copying
+    Return version of the snapshot
+    """
+    version = version or _new_version()
+    directory.mkdir(exist_ok=True, parents=True)
+    tmp_directory = directory / f'{version}.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    tmp_directory.mkdir()
+
+    # Pickle object with protocol 5 and write buffers one after another
+    offsets = []
+    with open(tmp_directory / SNAPSHOT_BUFFERS_FILE, 'wb') as f:
+        def buffer_callback(buffer: pickle.PickleBuffer):
+            raw = buffer.raw()
+            f.write(b'\0' * (-f.tell() % BUFFER_ALIGNMENT))
+            offsets.append((f.tell(), raw.nbytes))
+            f.write(raw)
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    with open(tmp_directory / SNAPSHOT_INDEX_FILE, 'wb') as f:
+        pickle.dump({'version': version, 'offsets': offsets, 'data': data}, f)
+
+    # Publish snapshot: rename directory, then atomically replace the pointer
+    if (directory / version).exists():
+        shutil.rmtree(tmp_directory)  # snapshots are immutable: the existing one has the same content
+    else:
+        os.replace(tmp_directory, directory / version)
+    tmp_pointer = directory / f'{SNAPSHOT_POINTER_FILE}.tmp'
+    tmp_pointer.write_text(version)
+    os.replace(tmp_pointer, directory / SNAPSHOT_POINTER_FILE)
+
+    _remove_old_snapshots(directory, version)
+    return version
+
+
+def _remove_old_snapshots(directory: Path, published_version: str):
+    """
+    Keep only the last published snapshots (readers that still map removed files keep working on Linux)
+    Snapshots are ordered by publishing (a republished version becomes the newest), not by directory mtime:
+    the published version and the version in the pointer file are never removed
+    """
+    history_path = directory / SNAPSHOT_HISTORY_FILE
+    history = history_path.read_text().split() if history_path.exists() else []
+    history = [version for version in history if version != published_version and (directory / version).is_dir()] + [published_version]
+    tmp_history = directory / f'{SNAPSHOT_HISTORY_FILE}.tmp'
+    tmp_history.write_text('\n'.join(history[-N_SNAPSHOTS_TO_KEEP:]))
+    os.replace(tmp_history, history_path)
+
+    versions_to_keep = set(history[-N_SNAPSHOTS_TO_KEEP:]) | {published_version, current_snapshot_version(directory)}
+    for path in directory.iterdir():
+        if path.is_dir() and not path.name.endswith('.tmp') and path.name not in versions_to_keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def snapshot_exists(version: str, directory: Path = SNAPSHOT_DIRECTORY) -> bool:
+    return (directory / version / SNAPSHOT_INDEX_FILE).exists()
+
+
+def current_snapshot_version(directory: Path = SNAPSHOT_DIRECTORY) -> str | None:
+    """
+    Return version of the last published snapshot
+    """
+    try:
+        return (directory / SNAPSHOT_POINTER_FILE).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_snapshot(version: str, directory: Path = SNAPSHOT_DIRECTORY) -> tp.Any:
+    """
+    Read snapshot: buffers are read-only memory maps shared between all processes
+    """
+    directory = directory / version
+    with open(directory / SNAPSHOT_INDEX_FILE, 'rb') as f:
+        index = pickle.load(f)
+    assert index['version'] == version
+    with open(directory / SNAPSHOT_BUFFERS_FILE, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            buffers = []
+        else:
+            memory = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            buffers = [memory[start:start + size] for start, size in index['offsets']]
+    return pickle.loads(index['data'], buffers=buffers)
@@ -0,0 +1,272 @@
+import numpy as np
+import pandas as pd
+import cvxpy as cp
+import os
+import sys
+import time
+import typing as tp
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+
+from research.library.load import TRADING_DAYS_IN_YEAR
+from research.library.markowitz import MarkowitzSolver
+from research.library.rolling import RollingStatistics, rolling_statistics
+from website.library import portfolio as portfolio_config
+from website.library.portfolio import allocate_capital
+from website.library.ytm import DAYS_IN_YEAR
+
+###################################################################################
+# Config
+###################################################################################
+
+ESTIMATION_WINDOW = 3 * TRADING_DAYS_IN_YEAR  # trading days of history used at each rebalance date
+MIN_WINDOW_COVERAGE = 0.8  # share of the window a ticker must be traded to be included
+REBALANCE_EVERY = 21  # trading days between rebalances
+BACKTEST_CAPITAL = 1e6
+
+###################################################################################
+# Scenarios
+###################################################################################
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """
+    Parameters of one recommendation replayed at every rebalance date
+    The bond part of the portfolio grows with bond_year_return_pct (there is no history of bonds prices)
+    """
+    mu_year_pct: float
+    include_bonds: bool = False
+    bond_year_return_pct: float = 0.0
+    bond_year_return_std_pct: float = 0.0
+    max_stocks: int | float = float('+inf')
+
+    @classmethod
+    def from_answers(cls, risk: str, bonds_or_shares_answer: str = 'shares', max_instruments: int | None = None) -> 'Scenario':
+        """
+        Scenario of the website answers (parameters are taken from the current tables of website.library.portfolio)
+        """
+        assert bonds_or_shares_answer in ['both', 'shares']
+        include_bonds = bonds_or_shares_answer == 'both'
+        max_stocks = float('+inf') if max_instruments is None else (max_instruments // 2 if include_bonds else max_instruments)
+        return cls(mu_year_pct=portfolio_config.MU_PCT_BY_RISK[risk], include_bonds=include_bonds, bond_year_return_pct=portfolio_config.BOND_MEAN_RATE_BY_RISK[risk],
+                   bond_year_return_std_pct=portfolio_config.BOND_STD_BY_RISK[risk], max_stocks=max_stocks)
+
+
+@dataclass
+class WalkForwardResult:
+    scenario: Scenario
+    dates: np.ndarray  # (n_dates,) datetime64[D] from the first rebalance date
+    values: np.ndarray  # (n_dates,) portfolio value
+    rebalance_dates: np.ndarray  # (n_rebalances,) datetime64[D]
+    turnover: np.ndarray  # (n_rebalances,) one-way turnover as a share of the portfolio value
+    n_infeasible: int  # rebalance dates where the problem was not solved (the portfolio is kept)
+    metrics: dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self):
+        returns = self.values[1:] / self.values[:-1] - 1
+        years = max((self.dates[-1] - self.dates[0]).astype(np.int64) / DAYS_IN_YEAR, 1e-9)
+        drawdown = 1 - self.values / np.maximum.accumulate(self.values)
+        metrics = {
+            'total_return_pct': (self.values[-1] / self.values[0] - 1) * 100,
+            'year_return_pct': ((self.values[-1] / self.values[0]) ** (1 / years) - 1) * 100,
+            'year_std_pct': returns.std(ddof=1) * np.sqrt(TRADING_DAYS_IN_YEAR) * 100 if len(returns) > 1 else 0.0,
+            'sharpe': returns.mean() / returns.std(ddof=1) * np.sqrt(TRADING_DAYS_IN_YEAR) if len(returns) > 1 and returns.std() > 0 else 0.0,
+            'max_drawdown_pct': drawdown.max() * 100,
+            'mean_turnover_pct': self.turnover.mean() * 100 if len(self.turnover) else 0.0
+        }
+        self.metrics = {name: float(value) for name, value in metrics.items()}
+
+
+###################################################################################
+# Shared memory
+###################################################################################
+
+
+class _SharedArrays:
+    """
+    Copy arrays to shared memory once: worker processes map them by name without pickling
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.blocks = {}
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = block
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+
+
+_worker_blocks: list[shared_memory.SharedMemory] = []  # keep shared memory mapped in worker processes
+_worker_data: dict[str, tp.Any] = {}
+
+
+def _attach_shared_arrays(specs: dict[str, tuple], tickers: list[str], scenarios: list[Scenario], bond_share_corr: float):
+    """
+    Initializer of worker processes
+    """
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        # The parent process owns the blocks: do not track them in workers where possible (the tracker of older versions is shared with the parent)
+        block = shared_memory.SharedMemory(name=block_name, track=False) if sys.version_info >= (3, 13) else shared_memory.SharedMemory(name=block_name)
+        _worker_blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _worker_data.update(arrays=arrays, tickers=tickers, scenarios=scenarios, bond_share_corr=bond_share_corr)
+
+
+###################################################################################
+# Walk-forward
+###################################################################################
+
+
+def _target_weights(k: int) -> list[np.ndarray | None]:
+    """
+    Solve markowitz problem of every scenario at the k-th rebalance date using only the data up to this date
+    The problem is built once per date (and per include_bonds) and re-solved for the scenarios
+    Return share weights over all tickers for each scenario (None if the problem is not solved), the bond weight is 1 - sum of them
+    """
+    arrays, tickers, scenarios = _worker_data['arrays'], _worker_data['tickers'], _worker_data['scenarios']
+    stat = RollingStatistics(tickers=tickers, dates=arrays['rebalance_dates'], window=None, halflife=None,
+                             n_observations=arrays['n_observations'], mean=arrays['mean'], cov_packed=arrays['cov_packed'])
+    row = arrays['rebalance_rows'][k]
+
+    # Tickers traded on the rebalance date with enough history in the window
+    n_tickers = len(tickers)
+    columns = np.flatnonzero((stat.n_observations[k] >= arrays['min_observations'][0]) & ~np.isnan(arrays['prices'][row]) & np.isfinite(stat.mean[k]))
+    window_stat = stat.window_statistics(k, columns)
+    finite = np.isfinite(window_stat.Sigma_cov.values).all(axis=0)
+    if not finite.all():
+        columns = columns[finite]
+        window_stat = stat.window_statistics(k, columns)
+
+    solvers: dict[bool, MarkowitzSolver] = {}
+    results = []
+    for scenario in scenarios:
+        if len(columns) == 0:
+            results.append(None)
+            continue
+        try:
+            if scenario.include_bonds not in solvers:
+                solvers[scenario.include_bonds] = MarkowitzSolver(window_stat, include_bonds=scenario.include_bonds, bond_share_corr=_worker_data['bond_share_corr'])
+            w = solvers[scenario.include_bonds].solve(scenario.mu_year_pct, bond_year_return_pct=scenario.bond_year_return_pct,
+                                                      bond_year_return_std_pct=scenario.bond_year_return_std_pct)
+        except (AssertionError, cp.error.SolverError, cp.error.DCPError) as ex:  # infeasible mu or non-convex problem
+            print(f'Rebalance {k}: {scenario} is not solved: {ex!r}')
+            results.append(None)
+            continue
+        w_shares = np.zeros(n_tickers)
+        w_shares[columns] = w.values[1:] if scenario.include_bonds else w.values
+        results.append(w_shares)
+    return results
+
+
+def _simulate(scenario: Scenario, targets: list[np.ndarray | None], prices: np.ndarray, days: np.ndarray,
+              rebalance_rows: np.ndarray, lot_sizes: np.ndarray, capital: float) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Replay the portfolio: at each rebalance date split the value as create_portfolio does (allocate_capital):
+    shares are bought in lots, the rest (bond weight and the lot-rounding remainder) goes to bonds if they are included and stays money otherwise
+    Return (values from the first rebalance date, turnover of each rebalance, number of infeasible rebalances)
+    """
+    first_row = rebalance_rows[0]
+    n_shares = np.zeros(prices.shape[1])
+    bonds_value, cash = 0.0, capital
+    bond_year_growth = 1 + scenario.bond_year_return_pct / 100
+    values = np.empty(len(prices) - first_row)
+    turnover = np.zeros(len(rebalance_rows))
+    n_infeasible = 0
+    rebalance_index = {row: k for k, row in enumerate(rebalance_rows)}
+    for row in range(first_row, len(prices)):
+        if row > first_row:
+            bonds_value *= bond_year_growth ** ((days[row] - days[row - 1]) / DAYS_IN_YEAR)
+        shares_values = n_shares * prices[row]
+        value = shares_values.sum() + bonds_value + cash
+        k = rebalance_index.get(row)
+        if k is not None:
+            if targets[k] is None:
+                n_infeasible += 1
+            else:
+                # Weights are zero for tickers without prices (price 0 before the first trade)
+                n_lots, not_invested = allocate_capital(value, np.where(prices[row] > 0, targets[k], 0.0), prices[row], lot_sizes, scenario.max_stocks)
+                new_shares_values = n_lots * lot_sizes * prices[row]
+                new_bonds_value, new_cash = (not_invested, 0.0) if scenario.include_bonds else (0.0, not_invested)
+                turnover[k] = (np.abs(new_shares_values - shares_values).sum() + abs(new_bonds_value - bonds_value) + abs(new_cash - cash)) / 2 / value
+                n_shares, bonds_value, cash = n_lots * lot_sizes, new_bonds_value, new_cash
+                value = new_shares_values.sum() + bonds_value + cash
+        values[row - first_row] = value
+    return values, turnover, n_infeasible
+
+
+def run_walk_forward(df_close: pd.DataFrame, scenarios: list[Scenario], lot_by_ticker: dict[str, int] | None = None,
+                     window: int = ESTIMATION_WINDOW, rebalance_every: int = REBALANCE_EVERY, capital: float = BACKTEST_CAPITAL,
+                     n_processes: int | None = None) -> list[WalkForwardResult]:
+    """
+    Walk-forward backtest of recommendations: at every rebalance date statistics are estimated on the last window of data,
+    markowitz weights are found and lots are bought, then the portfolio is held until the next rebalance date
+    df_close: close prices (date x ticker) with NaNs, e.g. load_data(with_statistics=False).df_close
+    (it keeps only tickers that are traded today, so the universe has survivorship bias)
+
+    Statistics of all windows are computed in one pass (rolling_statistics)
+    Rebalance dates are solved in parallel: prices and statistics are shared with the worker processes via shared memory
+    """
+    start_time = time.time()
+    tickers = list(df_close.columns)
+    lot_sizes = np.array([(lot_by_ticker or {}).get(ticker, 1) for ticker in tickers], dtype=np.float64)
+    prices = df_close.to_numpy(dtype=np.float64)
+    days = df_close.index.to_numpy(dtype='datetime64[D]').astype(np.int64)
+    rebalance_rows = np.arange(window, len(prices), rebalance_every)
+    assert len(rebalance_rows) > 0, f'History is shorter than the estimation window: {len(prices)} <= {window}'
+
+    # Statistics of the windows ending at rebalance dates
+    stat = rolling_statistics(df_close, window=window, end_dates=df_close.index[rebalance_rows], dtype=np.float64)
+    shared = _SharedArrays({
+        'prices': prices,
+        'rebalance_rows': rebalance_rows,
+        'rebalance_dates': stat.dates,
+        'n_observations': stat.n_observations,
+        'mean': stat.mean,
+        'cov_packed': stat.cov_packed,
+        'min_observations': np.array([MIN_WINDOW_COVERAGE * window])
+    })
+    try:
+        n_processes = n_processes or os.cpu_count() or 1
+        initargs = (shared.specs, tickers, scenarios, portfolio_config.BOND_SHARE_CORR)
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=_attach_shared_arrays, initargs=initargs) as executor:
+            targets_by_date = list(executor.map(_target_weights, range(len(rebalance_rows)), chunksize=max(len(rebalance_rows) // (4 * n_processes), 1)))
+    finally:
+        shared.close()
+
+    # Replay portfolios (prices of days without trades are the last prices, 0 before the first trade)
+    filled_prices = np.nan_to_num(df_close.ffill().to_numpy(dtype=np.float64), nan=0.0)
+    results = []
+    for i, scenario in enumerate(scenarios):
+        targets = [targets_of_date[i] for targets_of_date in targets_by_date]
+        values, turnover, n_infeasible = _simulate(scenario, targets, filled_prices, days, rebalance_rows, lot_sizes, capital)
+        results.append(WalkForwardResult(scenario=scenario, dates=days[rebalance_rows[0]:].astype('datetime64[D]'), values=values,
+                                         rebalance_dates=stat.dates, turnover=turnover, n_infeasible=n_infeasible))
+    print(f'Walk-forward: {len(scenarios)} scenarios, {len(rebalance_rows)} rebalance dates, {n_processes} processes: {time.time() - start_time:.1f} s')
+    return results
+
+
+def _test_walk_forward():
+    """
+    Backtest the website recommendations for every risk level
+    """
+    from research import load_data
+
+    stat = load_data(with_statistics=False)
+    scenarios = [Scenario.from_answers(risk['value'], bonds_or_shares) for risk in portfolio_config.RISK_VALUES for bonds_or_shares in ['shares', 'both']]
+    for result in run_walk_forward(stat.df_close, scenarios):
+        print(result.scenario, {name: round(value, 2) for name, value in result.metrics.items()}, f'infeasible: {result.n_infeasible}')
+
+
+if __name__ == '__main__':
+    # Run as module: python -m website.library.walk_forward
+    _test_walk_forward()
@@ -0,0 +1,120 @@
+import datetime
+import numpy as np
+from dataclasses import dataclass
+
+###################################################################################
+# Config
+###################################################################################
+
+RATE_LOWER_BOUND_PCT = -10
+RATE_UPPER_BOUND_PCT = 10000
+RATE_EPS_PCT = 0.001  # 0.001%
+
+TAX_RATE_PCT = 13
+
+DAYS_IN_YEAR = 365
+
+###################################################################################
+# Cash flows
+###################################################################################
+
+
+@dataclass
+class BondsCashFlows:
+    """
+    Future cash flows of many bonds packed into padded arrays
+    Times are in years from the fixed reference date
+    """
+    nominal: np.ndarray  # (n_bonds,)
+    aci_value: np.ndarray  # (n_bonds,)
+    maturity_time: np.ndarray  # (n_bonds,)
+    coupon_time: np.ndarray  # (n_bonds, max_coupons), padded with zeros
+    coupon_pay: np.ndarray  # (n_bonds, max_coupons), padded with zeros
+    today: datetime.date = None  # reference date of times
+
+    @classmethod
+    def pack(cls, nominals: list[float], aci_values: list[float], maturity_dates: list[datetime.date],
+             coupon_dates: list[list[datetime.date]], coupon_pays: list[list[float]], today: datetime.date) -> 'BondsCashFlows':
+        n_bonds = len(nominals)
+        max_coupons = max(map(len, coupon_dates), default=0)
+        coupon_time = np.zeros((n_bonds, max_coupons))
+        coupon_pay = np.zeros((n_bonds, max_coupons))
+        for i, (dates, pays) in enumerate(zip(coupon_dates, coupon_pays)):
+            coupon_time[i, :len(dates)] = [(date - today).days / DAYS_IN_YEAR for date in dates]
+            coupon_pay[i, :len(pays)] = pays
+        maturity_time = np.array([(date - today).days / DAYS_IN_YEAR for date in maturity_dates], dtype=float).reshape(-1)
+        assert np.all(maturity_time >= 0) and np.all(coupon_time >= 0)
+        return cls(nominal=np.asarray(nominals, dtype=float).reshape(-1), aci_value=np.asarray(aci_values, dtype=float).reshape(-1),
+                   maturity_time=maturity_time, coupon_time=coupon_time, coupon_pay=coupon_pay, today=today)
+
+    def take(self, indices: np.ndarray) -> 'BondsCashFlows':
+        """
+        Cash flows of the bonds with given indices
+        """
+        return BondsCashFlows(nominal=self.nominal[indices], aci_value=self.aci_value[indices], maturity_time=self.maturity_time[indices],
+                              coupon_time=self.coupon_time[indices], coupon_pay=self.coupon_pay[indices], today=self.today)
+
+    def __len__(self) -> int:
+        return len(self.nominal)
+
+    @staticmethod
+    def _discount_factor(rate_pct: np.ndarray) -> np.ndarray:
+        return (1 / (1 + rate_pct / 100)).reshape(-1, 1)
+
+    def _discounted_coupons(self, rate_pct: np.ndarray) -> np.ndarray:
+        return (self.coupon_pay * self._discount_factor(rate_pct) ** self.coupon_time).sum(axis=1)
+
+    def _discounted_nominal(self, payment: np.ndarray, rate_pct: np.ndarray) -> np.ndarray:
+        return payment * self._discount_factor(rate_pct)[:, 0] ** self.maturity_time
+
+    def raw_present_value(self, rate_pct: np.ndarray) -> np.ndarray:
+        """
+        D(nominal) - aci + D(coupons)
+        """
+        return self._discounted_nominal(self.nominal, rate_pct) - self.aci_value + self._discounted_coupons(rate_pct)
+
+    def real_present_value(self, rate_pct: np.ndarray, prices: np.ndarray) -> np.ndarray:
+        """
+        D(nominal) - aci + (1 - tax) * D(coupons) - tax * D(max(0, nominal - price - aci))
+        """
+        tax_rate = TAX_RATE_PCT / 100
+        tax_base = np.maximum(0.0, self.nominal - prices - self.aci_value)
+        return (-self.aci_value + (1 - tax_rate) * self._discounted_coupons(rate_pct)
+                + self._discounted_nominal(self.nominal, rate_pct) - self._discounted_nominal(tax_rate * tax_base, rate_pct))
+
+
+###################################################################################
+# Yield to maturity
+###################################################################################
+
+
+def _bisect_rate_pct(present_value, prices: np.ndarray) -> np.ndarray:
+    """
+    Find [present_value(rate_pct) == price] for all bonds at once
+    Perform binary search (present value decreases with rate)
+    """
+    # Start conditions
+    lower = np.full(len(prices), float(RATE_LOWER_BOUND_PCT))
+    upper = np.full(len(prices), float(RATE_UPPER_BOUND_PCT))
+
+    # Binary search (the number of iterations is the same for all bonds)
+    while np.any(upper - lower >= RATE_EPS_PCT):
+        middle = (lower + upper) / 2
+        greater = present_value(middle) > prices
+        lower = np.where(greater, middle, lower)
+        upper = np.where(greater, upper, middle)
+
+    # Return middle value
+    return (lower + upper) / 2
+
+
+def get_ytm_pct(cash_flows: BondsCashFlows, prices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return (ytm, real ytm) for all bonds (real ytm is ytm with taxes)
+    """
+    prices = np.asarray(prices, dtype=float)
+    if len(prices) == 0:
+        return np.zeros(0), np.zeros(0)
+    ytm_pct = _bisect_rate_pct(cash_flows.raw_present_value, prices)
+    real_ytm_pct = _bisect_rate_pct(lambda rate_pct: cash_flows.real_present_value(rate_pct, prices), prices)
+    return ytm_pct, real_ytm_pct
@@ -1,11 +1,22 @@
-import datetime
-from flask import Blueprint, render_template, request
+import math
+from flask import Blueprint, render_template, request, jsonify
 
-from website.library import RISK_VALUES, create_portfolio, create_graphs
+from website.library import RISK_VALUES, TIME_VALUES, MAX_INSTRUMENTS_VALUES, BONDS_OR_SHARES_VALUES, create_portfolio, create_portfolios, PortfolioRequest, portfolio_to_dict, create_graphs, parse_time_answer, parse_max_instruments_answer, get_dataset
+from website.library.cache import ResponseCache
 
 # Create /views
 views = Blueprint("views", __name__)
 
+# Cache of rendered portfolios (per server process)
+CAPITAL_DECIMALS = 2  # capital is rounded to kopecks
+CACHED_CAPITAL_STEP = 1000  # only pages for round capitals (multiples of the step in RUB) are cached: other capitals rarely repeat
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL_SECONDS = 10 * 60
+response_cache = ResponseCache(max_size=RESPONSE_CACHE_SIZE, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS)
+
+MAX_BATCH_SIZE = 10_000  # number of answers in one request to the batch API (constructed synchronously in one worker)
+MAX_CAPITAL = 1e12  # RUB
+
 # Define questions in the form
 RISK_QUESTION = "Как я отношусь к риску?"
 TIME_QUESTION = "На какой срок я собираюсь инвестировать?"
@@ -18,48 +29,19 @@ ALL_QUESTIONS = [
     },
     {
         "question": TIME_QUESTION,
-        "options": [
-            {"value": "month_1", "label": "1 месяц"},
-            {"value": "month_6", "label": "6 месяцев"},
-            {"value": "year_1", "label": "1 год"},
-            {"value": "year_2", "label": "2 года"},
-            {"value": "year_3", "label": "3 года"},
-            {"value": "year_more", "label": "больше 3 лет"},
-        ]
+        "options": TIME_VALUES
     },
     {
         "question": MAX_INSTRUMENTS_QUESTION,
-        "options": [
-            {"value": "5", "label": "Не более 5"},
-            {"value": "10", "label": "Не более 10"},
-            {"value": "20", "label": "Не более 20"},
-            {"value": "-1", "label": "Мне не важно"},
-        ]
+        "options": MAX_INSTRUMENTS_VALUES
     },
     {
         "question": BONDS_OR_SHARES_QUESTION,
-        "options": [
-            {"value": "both", "label": "И акции, и облигации"},
-            {"value": "shares", "label": "Только акции"},
-            {"value": "bonds", "label": "Только облигации"},
-        ]
+        "options": BONDS_OR_SHARES_VALUES
     }
 ]
 
 
-def parse_time_answer(time_answer: str) -> datetime.timedelta | None:
-    if time_answer.startswith('month_'):
-        months = int(time_answer.removeprefix('month_'))
-        return datetime.timedelta(days=30 * months)
-    elif time_answer.startswith('year_'):
-        if time_answer == 'year_more':
-            return None
-        years = int(time_answer.removeprefix('year_'))
-        return datetime.timedelta(days=365 * years)
-    else:
-        assert False, 'Unreachable'
-
-
 @views.route("/", methods=["GET"])
 def home_get():
     """
@@ -78,19 +60,131 @@ def home_post():
 
     time_answer = parse_time_answer(request.form.get(TIME_QUESTION))
 
-    capital_answer = float(request.form.get("capital"))
+    capital_answer = round(float(request.form.get("capital")), CAPITAL_DECIMALS)
 
-    max_instruments_answer = int(request.form.get(MAX_INSTRUMENTS_QUESTION))
-    if max_instruments_answer == -1:
-        max_instruments_answer = None
+    max_instruments_answer = parse_max_instruments_answer(request.form.get(MAX_INSTRUMENTS_QUESTION))
 
     bonds_or_shares_answer = request.form.get(BONDS_OR_SHARES_QUESTION)
 
-    # Construct portfolio
-    portfolio = create_portfolio(total_capital=capital_answer, risk=risk_answer, max_instruments=max_instruments_answer, time_answer=time_answer, bonds_or_shares_answer=bonds_or_shares_answer)
+    # Use one dataset for the whole request
+    dataset = get_dataset()
+    if dataset is None:
+        return "Данные загружаются, попробуйте через пару минут", 503
+
+    def render_portfolio() -> str:
+        # Construct portfolio
+        portfolio = create_portfolio(total_capital=capital_answer, risk=risk_answer, max_instruments=max_instruments_answer, time_answer=time_answer, bonds_or_shares_answer=bonds_or_shares_answer, dataset=dataset)
+
+        # Create graphs for portfolio
+        graphs = create_graphs(portfolio, dataset=dataset)
+
+        # Show portfolio
+        return render_template("portfolio.html", portfolio=portfolio, graphs=graphs)
+
+    if capital_answer % CACHED_CAPITAL_STEP != 0:
+        return render_portfolio()
+    key = (risk_answer, time_answer, max_instruments_answer, bonds_or_shares_answer, capital_answer)
+    return response_cache.get_or_create(key, dataset.version, render_portfolio)
+
+
+def _parse_batch_answer(answer: dict) -> PortfolioRequest:
+    """
+    Parse answers of one user of the batch API (values are the same as in the form)
+    Raise ValueError for incorrect answers (explicit checks: the endpoint must work with python -O)
+    """
+    if not isinstance(answer, dict):
+        raise ValueError(f'Incorrect answer: {answer}')
+    values = {}
+    for key, options in [('risk', RISK_VALUES), ('time', TIME_VALUES), ('max_instruments', MAX_INSTRUMENTS_VALUES), ('bonds_or_shares', BONDS_OR_SHARES_VALUES)]:
+        value = answer.get(key)
+        if key == 'max_instruments' and isinstance(value, int) and not isinstance(value, bool):
+            value = str(value)  # number of instruments may be sent as a number
+        if not isinstance(value, str) or value not in [option['value'] for option in options]:
+            raise ValueError(f'Incorrect {key}: {answer.get(key)}')
+        values[key] = value
+
+    capital = answer.get('capital')
+    if isinstance(capital, bool) or not isinstance(capital, (int, float, str)):
+        raise ValueError(f'Incorrect capital: {capital}')
+    try:
+        capital = round(float(capital), CAPITAL_DECIMALS)
+    except OverflowError:
+        raise ValueError(f'Incorrect capital: {capital}')
+    if not (math.isfinite(capital) and 0 < capital <= MAX_CAPITAL):
+        raise ValueError(f'Incorrect capital: {capital}')
+    return PortfolioRequest(total_capital=capital, risk=values['risk'], max_instruments=parse_max_instruments_answer(values['max_instruments']),
+                            time_answer=parse_time_answer(values['time']), bonds_or_shares_answer=values['bonds_or_shares'])
+
+
+@views.route("/api/portfolios", methods=["POST"])
+def portfolios_post():
+    """
+    Construct portfolios for a list of answers
+    Request: {"answers": [{"capital": 100000, "risk": "medium", "time": "year_1", "max_instruments": "10", "bonds_or_shares": "both"}, ...]}
+    Response: {"version": data version, "portfolios": [portfolio for each answer]}
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('answers'), list):
+        return jsonify({'error': 'Expected JSON object with the list "answers"'}), 400
+    if len(body['answers']) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'Too many answers: {len(body["answers"])} > {MAX_BATCH_SIZE}'}), 400
+    try:
+        portfolio_requests = [_parse_batch_answer(answer) for answer in body['answers']]
+    except ValueError as ex:
+        return jsonify({'error': f'Incorrect answers: {ex}'}), 400
+
+    # Use one dataset for the whole request
+    dataset = get_dataset()
+    if dataset is None:
+        return jsonify({'error': 'Данные загружаются, попробуйте через пару минут'}), 503
+
+    portfolios = create_portfolios(portfolio_requests, dataset=dataset)
+    return jsonify({'version': dataset.version, 'portfolios': [portfolio_to_dict(portfolio) for portfolio in portfolios]})
+
+
+@views.route("/stats/cache", methods=["GET"])
+def cache_stats():
+    """
+    Return hit/miss counters of the portfolio cache of this process
+    """
+    return jsonify(response_cache.stats())
 
-    # Create graphs for portfolio
-    graphs = create_graphs(portfolio)
 
-    # Show portfolio
-    return render_template("portfolio.html", portfolio=portfolio, graphs=graphs)
+def _test_portfolios_post():
+    """
+    Check answers of the batch API to incorrect requests and before the data is loaded
+    """
+    from website import create_app
+    client = create_app().test_client()
+    answer = {'capital': 100000, 'risk': RISK_VALUES[0]['value'], 'time': TIME_VALUES[0]['value'],
+              'max_instruments': MAX_INSTRUMENTS_VALUES[0]['value'], 'bonds_or_shares': BONDS_OR_SHARES_VALUES[0]['value']}
+    incorrect_bodies = [
+        None,
+        {'answer': [answer]},
+        {'answers': [answer] * (MAX_BATCH_SIZE + 1)},
+        {'answers': [{**answer, 'capital': 1e400}]},
+        {'answers': [{**answer, 'capital': 'nan'}]},
+        {'answers': [{**answer, 'capital': -1}]},
+        {'answers': [{**answer, 'capital': 10 * MAX_CAPITAL}]},
+        {'answers': [{**answer, 'capital': True}]},
+        {'answers': [{**answer, 'capital': [1]}]},
+        {'answers': [{**answer, 'capital': 10 ** 400}]},
+        {'answers': [{**answer, 'risk': 'x'}]},
+        {'answers': [{**answer, 'max_instruments': True}]},
+        {'answers': [{key: value for key, value in answer.items() if key != 'capital'}]},
+        {'answers': [answer, 'x']},
+    ]
+    for body in incorrect_bodies:
+        response = client.post('/api/portfolios', data='not json', content_type='application/json') if body is None else client.post('/api/portfolios', json=body)
+        assert response.status_code == 400, (response.status_code, response.get_json())
+        assert 'error' in response.get_json()
+
+    # Data is not loaded in this process
+    assert get_dataset() is None
+    response = client.post('/api/portfolios', json={'answers': [answer]})
+    assert response.status_code == 503, response.status_code
+    print('portfolios_post: OK')
+
+
+if __name__ == '__main__':
+    _test_portfolios_post()